@@ -0,0 +1,45 @@
+# coding: utf8
+"""
+Append elements one by one to a list field of a loaded model, the cost per
+element should stay flat when the list grows.
+
+    python benchmarks/bench_containers.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId
+
+from mongotoy.libs.models import Model
+from mongotoy.libs.fields import ListField
+from mongotoy.libs.queue import flush_queue
+
+
+class BenchModel(Model):
+    values = ListField([])
+
+
+def bench_append(count):
+    model = BenchModel(__persistence__=True, _id=ObjectId(), values=[])
+    values = model.values
+    start = time.time()
+    for i in xrange(count):
+        values.append(i)
+    return time.time() - start
+
+
+def main():
+    for count in (12500, 25000, 50000, 100000):
+        cost = bench_append(count)
+        print "append %6d elements: %.3fs, %.2fus per element" % (
+            count, cost, cost * 1000000 / count
+        )
+        flush_queue.clear()
+
+
+if __name__ == "__main__":
+    main()
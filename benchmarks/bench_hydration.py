@@ -0,0 +1,85 @@
+# coding: utf8
+"""
+Compare building models from query results through __init__ and through
+the hydration path used by Query, for documents with 50 fields, and the
+compiled to_dict with the generic one.
+
+    python benchmarks/bench_hydration.py
+"""
+
+import os
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId
+
+from mongotoy.libs.base import MetaClass
+from mongotoy.libs.models import Model, SubModel
+from mongotoy.libs.fields import (
+    IntField, FloatField, UnicodeField, DateTimeField, ListField, ModelField
+)
+
+
+class BenchSubModel(SubModel):
+    name = UnicodeField(u"")
+    count = IntField(0)
+
+
+def _build_model():
+    attrs = dict()
+    for i in range(10):
+        attrs["int%d" % i] = IntField(0)
+        attrs["float%d" % i] = FloatField(0.0)
+        attrs["unicode%d" % i] = UnicodeField(u"")
+        attrs["datetime%d" % i] = DateTimeField(datetime.datetime.now)
+    for i in range(5):
+        attrs["list%d" % i] = ListField([])
+        attrs["sub%d" % i] = ModelField(BenchSubModel)
+    return MetaClass("BenchModel", (Model,), attrs)
+
+
+BenchModel = _build_model()
+
+
+def _build_document():
+    now = datetime.datetime.now()
+    document = dict(_id=ObjectId())
+    for i in range(10):
+        document["int%d" % i] = i
+        document["float%d" % i] = i * 1.5
+        document["unicode%d" % i] = u"value %d" % i
+        document["datetime%d" % i] = now
+    for i in range(5):
+        document["list%d" % i] = range(10)
+        document["sub%d" % i] = dict(name=u"sub", count=i)
+    return document
+
+
+def bench(build, documents):
+    start = time.time()
+    for document in documents:
+        build(document)
+    return time.time() - start
+
+
+def main(count=20000):
+    documents = [_build_document() for i in xrange(count)]
+    init = bench(
+        lambda d: BenchModel(__persistence__=True, **dict(d)), documents
+    )
+    hydrate = bench(BenchModel._from_bson, documents)
+    print "__init__:   %.3fs for %d documents" % (init, count)
+    print "_from_bson: %.3fs for %d documents" % (hydrate, count)
+    print "speedup:    %.1fx" % (init / hydrate)
+    models = [BenchModel._from_bson(document) for document in documents]
+    generic = bench(lambda m: m._to_dict(), models)
+    compiled = bench(lambda m: m.to_dict(), models)
+    print "_to_dict:   %.3fs for %d models" % (generic, count)
+    print "to_dict:    %.3fs for %d models" % (compiled, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# coding: utf8
+"""
+Compare the memory of 1M models loaded from query results, stored in the
+instance __dict__ and in __slots__ (__use_slots__ = True). Every variant
+runs in its own process and reports the growth of its max RSS.
+
+    python benchmarks/bench_memory.py [count]
+"""
+
+import os
+import sys
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId
+
+from mongotoy.libs.models import Model, SubModel
+from mongotoy.libs.fields import IntField, UnicodeField, ModelField
+
+
+class BenchSubModel(SubModel):
+    name = UnicodeField(u"")
+    count = IntField(0)
+
+
+class DictModel(Model):
+    field1 = IntField(0)
+    field2 = IntField(0)
+    field3 = UnicodeField(u"")
+    field4 = ModelField(BenchSubModel)
+
+
+class SlotsSubModel(SubModel):
+    __use_slots__ = True
+    name = UnicodeField(u"")
+    count = IntField(0)
+
+
+class SlotsModel(Model):
+    __use_slots__ = True
+    field1 = IntField(0)
+    field2 = IntField(0)
+    field3 = UnicodeField(u"")
+    field4 = ModelField(SlotsSubModel)
+
+
+MODELS = dict(dict=DictModel, slots=SlotsModel)
+
+
+def _max_rss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(variant, count):
+    model = MODELS[variant]
+    name = u"sub"
+    documents = [
+        dict(_id=ObjectId(), field1=i, field2=i, field3=name,
+             field4=dict(name=name, count=i))
+        for i in xrange(count)
+    ]
+    start = _max_rss()
+    models = [model._from_bson(document) for document in documents]
+    used = _max_rss() - start
+    print "%-6s %8.1f MB, %6.1f bytes per model" % (
+        variant, used / 1024.0, used * 1024.0 / len(models)
+    )
+
+
+def main(count=1000000):
+    for variant in ("dict", "slots"):
+        subprocess.check_call([
+            sys.executable, os.path.abspath(__file__), variant, str(count)
+        ])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        run(sys.argv[1], int(sys.argv[2]))
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,215 @@
+# coding: utf8
+
+from bson.son import SON
+
+from .session import get_session, submit
+from .consts import ASCENDING, DESCENDING
+
+AGGREGATE = "aggregate"
+
+
+class Aggregate(object):
+    """
+    aggregation pipeline of a model collection:
+
+        rows = TestModel.aggregate().match(Gt("field1", 0)).group(
+            "field2.name", total={"$sum": "$field1"}
+        ).sort(total=DESCENDING).limit(10).all()
+
+    The field paths are checked against the model until a project or a
+    group stage reshapes the documents, the fields added by lookup are
+    accepted after it. The results are the raw documents unless as_models
+    is called.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.pipeline = []
+        self.options = dict()
+        self.cursor = None
+        self.row = None
+        self._reshaped = False
+        self._added = set()
+
+    def __iter__(self):
+        if self.cursor is None:
+            self.execute()
+        return self
+
+    def next(self):
+        if self.cursor is None:
+            self.execute()
+        record = next(self.cursor)
+        if self.row is not None:
+            return self.row(record)
+        return record
+
+    def execute(self):
+        options = dict(self.options)
+        options["cursor"] = dict()
+        if "batch_size" in options:
+            options["cursor"]["batchSize"] = options.pop("batch_size")
+        self.cursor = get_session().execute(
+            self.model.__collection__, AGGREGATE,
+            dict(pipeline=list(self.pipeline), **options)
+        )
+        return self.cursor
+
+    def all(self):
+        return list(self)
+
+    def aall(self):
+        """
+        all() in the worker threads of the async session, return a Future
+        """
+        return submit(self.all)
+
+    def _stage(self, operator, value):
+        self.pipeline.append({operator: value})
+        return self
+
+    def _check(self, field):
+        if not self._reshaped and field.split(".", 1)[0] not in self._added:
+            self.model.assert_valid_field(field)
+        return field
+
+    def _check_expression(self, expression):
+        """
+        check the "$field" references of an expression
+        """
+        if isinstance(expression, basestring):
+            if expression.startswith("$") and not expression.startswith("$$"):
+                self._check(expression[1:])
+        elif isinstance(expression, dict):
+            for value in expression.itervalues():
+                self._check_expression(value)
+        elif isinstance(expression, (list, tuple)):
+            for value in expression:
+                self._check_expression(value)
+        return expression
+
+    def match(self, *args, **kwargs):
+        """
+        filter the documents with the arguments of Model.query:
+
+            match(Gt("field1", 0), field2=1)
+        """
+        if self._reshaped or self._added:
+            spec = dict()
+            for arg in args:
+                spec.update(arg.compile())
+            spec.update(kwargs)
+        else:
+            spec = self.model._generate_query_context(*args, **kwargs)
+        return self._stage("$match", spec)
+
+    def project(self, *fields, **expressions):
+        """
+        keep the pass fields and add the computed ones:
+
+            project("field1", "field2.name", double={"$multiply": ["$field1", 2]})
+        """
+        projection = dict((self._check(field), 1) for field in fields)
+        for key, expression in expressions.iteritems():
+            if expression in (0, 1) and not isinstance(expression, float):
+                self._check(key)
+            else:
+                self._check_expression(expression)
+            projection[key] = expression
+        self._reshaped = True
+        return self._stage("$project", projection)
+
+    def group(self, key, **accumulators):
+        """
+        group the documents by a field, a dict of fields or an expression,
+        None for a single group:
+
+            group("field2", total={"$sum": "$field1"}, count={"$sum": 1})
+            group(dict(a="field1", b="field2.name"), first={"$first": "$_id"})
+        """
+        if isinstance(key, basestring) and not key.startswith("$"):
+            key = "$" + key
+        elif isinstance(key, dict):
+            key = dict(
+                (name, "$" + value
+                 if isinstance(value, basestring) and
+                 not value.startswith("$") else value)
+                for name, value in key.iteritems()
+            )
+        group = {"_id": self._check_expression(key)}
+        for name, accumulator in accumulators.iteritems():
+            group[name] = self._check_expression(accumulator)
+        self._reshaped = True
+        return self._stage("$group", group)
+
+    def sort(self, *args, **kwargs):
+        """
+        sort by (field, direction) pairs or keyword arguments, like
+        Query.sort
+        """
+        keys = list(args) + kwargs.items()
+        for key, value in keys:
+            self._check(key)
+            if value not in (DESCENDING, ASCENDING):
+                raise ValueError("sort, invaild key")
+        return self._stage("$sort", SON(keys))
+
+    def limit(self, capicity):
+        assert isinstance(capicity, int), "limit access int argument"
+        return self._stage("$limit", capicity)
+
+    def unwind(self, field, preserve_null=False):
+        """
+        output one document per element of the array field, keep the
+        documents of the empty and missing arrays when preserve_null
+        """
+        path = "$" + self._check(field)
+        if preserve_null:
+            return self._stage("$unwind", dict(
+                path=path, preserveNullAndEmptyArrays=True
+            ))
+        return self._stage("$unwind", path)
+
+    def lookup(self, model, local_field, foreign_field, as_field):
+        """
+        join the documents of another model collection, or of a collection
+        name, whose foreign_field equals local_field into as_field
+        """
+        self._check(local_field)
+        if isinstance(model, basestring):
+            collection = model
+        else:
+            model.assert_valid_field(foreign_field)
+            collection = model.__collection__
+        self._added.add(as_field)
+        return self._stage("$lookup", {
+            "from": collection, "localField": local_field,
+            "foreignField": foreign_field, "as": as_field
+        })
+
+    def allow_disk_use(self, allow=True):
+        """
+        let the stages exceeding the memory limit write temporary files
+        """
+        self.options["allowDiskUse"] = allow
+        return self
+
+    def batch_size(self, size):
+        """
+        fetch size documents per round trip
+        """
+        assert isinstance(size, int), "batch_size access int argument"
+        self.options["batch_size"] = size
+        return self
+
+    def as_models(self, model=None):
+        """
+        build a model of the pass class, the aggregated model by default,
+        from every result. The models are detached, their changes are not
+        tracked.
+        """
+        model = model or self.model
+        if hasattr(model, "__collection__"):
+            self.row = lambda record: model._from_bson(record, detached=True)
+        else:
+            self.row = model._from_bson
+        return self
@@ -0,0 +1,150 @@
+# coding: utf8
+
+import time
+import threading
+
+from .queue import (
+    flush_queue, add_push_callback, remove_push_callback, bind_unit_of_work
+)
+from .session import flush
+from .consts import BULK_BATCH_SIZE
+
+
+class AutoFlusher(object):
+    """
+    flush the process-global flush_queue in a background thread when
+    max_pending models are changed or every interval milliseconds:
+
+        flusher = AutoFlusher(max_pending=1000, interval=1000).start()
+        model.field1 = 2
+        ...
+        flusher.stop()
+
+    The threads changing models block while max_queued models wait for the
+    flush. The models changed in a unit of work are not flushed.
+    """
+    def __init__(self, max_pending=1000, interval=1000, max_queued=10000,
+                 batch_size=BULK_BATCH_SIZE, ordered=True):
+        if max_queued < max_pending:
+            raise ValueError("max_queued must not be less than max_pending")
+        self.max_pending = max_pending
+        self.interval = interval
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.flushes = 0
+        self.models = 0
+        self.errors = 0
+        self.write_errors = 0
+        self.last_size = 0
+        self.last_latency = 0
+        self.max_latency = 0
+        self.total_latency = 0
+        self.last_error = None
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                raise ValueError("auto flusher is already started")
+            self._running = True
+        add_push_callback(self._pushed)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, drain=True):
+        """
+        stop the background thread and release the blocked threads, flush
+        the models left in the queue when drain
+        """
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            self._condition.notify_all()
+        remove_push_callback(self._pushed)
+        self._thread.join()
+        self._thread = None
+        if drain and len(flush_queue):
+            self._flush()
+
+    def stats(self):
+        """
+        the flush counters, latencies in milliseconds
+        """
+        with self._condition:
+            return dict(
+                flushes=self.flushes,
+                models=self.models,
+                errors=self.errors,
+                write_errors=self.write_errors,
+                pending=len(flush_queue),
+                last_size=self.last_size,
+                last_latency=self.last_latency,
+                max_latency=self.max_latency,
+                avg_latency=(
+                    self.total_latency / self.flushes if self.flushes else 0
+                )
+            )
+
+    def _pushed(self, model):
+        with self._condition:
+            if len(flush_queue) >= self.max_pending:
+                self._condition.notify_all()
+            while self._running and len(flush_queue) >= self.max_queued:
+                self._condition.wait()
+
+    def _run(self):
+        # wait the whole interval after a flush which failed to shrink the
+        # queue, instead of retrying the failed models at once
+        backoff = False
+        while True:
+            deadline = time.time() + self.interval / 1000.0
+            with self._condition:
+                while self._running and (
+                    backoff or len(flush_queue) < self.max_pending
+                ):
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+            size = len(flush_queue)
+            if size:
+                self._flush()
+            backoff = size and len(flush_queue) >= size
+
+    def _flush(self):
+        size = len(flush_queue)
+        start = time.time()
+        previous = bind_unit_of_work(None)
+        try:
+            results = flush(self.batch_size, self.ordered)
+        except Exception as e:
+            results = None
+            error = e
+        else:
+            error = None
+        finally:
+            bind_unit_of_work(previous)
+        latency = (time.time() - start) * 1000
+        with self._condition:
+            self.flushes += 1
+            self.models += size
+            self.last_size = size
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+            if error is not None:
+                self.errors += 1
+                self.last_error = error
+            else:
+                for result in results.itervalues():
+                    self.write_errors += len(result["writeErrors"])
+            self._condition.notify_all()
+        return results
@@ -1,26 +1,154 @@
 # coding: utf8
 
-from .fields import Field
+from .fields import Field, ListModelField
 from .util import get_collection_name
+from .indexes import compile_indexes, collection_models
+
+
+class SlotField(object):
+    """
+    store the value of a field in a slot of the models declared
+    __use_slots__, the class attribute still returns the field.
+    """
+    def __init__(self, field, slot):
+        self.field = field
+        self.slot = slot
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.field
+        try:
+            return self.slot.__get__(instance, owner)
+        except AttributeError:
+            return self.field.__get__(instance, owner)
+
+    def __set__(self, instance, value):
+        self.slot.__set__(instance, value)
+
+    def __delete__(self, instance):
+        self.slot.__delete__(instance)
 
 
 class BaseMetaClass(type):
+    """
+    compile the field table of the model class:
+
+        __fields__: the field names in declaration order
+        __field_set__: the field names for membership test
+        __field_table__: the fields by name
+        __scalar_fields__, __submodel_fields__, __list_model_fields__:
+            the field names by the way they are converted by to_dict
+        __valid_paths__: the dotted paths already checked by
+            assert_valid_field
+
+    The values are stored in the instance __dict__, or in __slots__ when
+    the class declares __use_slots__ = True.
+    """
     def __new__(cls, name, bases, attrs):
         fields = []
         for field, value in attrs.iteritems():
             if isinstance(value, Field):
                 value.__field_name__ = field
                 fields.append(field)
+        fields.sort(key=lambda field: attrs[field].__order__)
+        slots = None
+        if attrs.get("__use_slots__") and "__slots__" not in attrs:
+            slots = _compile_slots(bases, attrs, fields)
         new_class = super(BaseMetaClass, cls).__new__(cls, name, bases, attrs)
-        new_class.__fields__ = fields
-        for attr_key, attr_value in attrs.iteritems():
-            if isinstance(attr_value, Field):
-                attr_value.__lord__ = new_class
+        if slots is not None:
+            for field, storage in slots:
+                setattr(new_class, field, SlotField(
+                    _lookup(new_class.__mro__[1:], field, attrs),
+                    new_class.__dict__[storage]
+                ))
+        table = dict((field, attrs[field]) for field in fields)
+        new_class.__fields__ = tuple(fields)
+        new_class.__field_set__ = frozenset(fields)
+        new_class.__field_table__ = table
+        new_class.__list_model_fields__ = tuple(
+            field for field in fields
+            if isinstance(table[field], ListModelField)
+        )
+        new_class.__submodel_fields__ = tuple(
+            field for field in fields
+            if isinstance(table[field].__f_type__, BaseMetaClass)
+        )
+        new_class.__scalar_fields__ = tuple(
+            field for field in fields
+            if field not in new_class.__list_model_fields__ and
+            field not in new_class.__submodel_fields__
+        )
+        new_class.__hydrators__ = tuple(
+            (field, table[field], table[field].__f_type__
+             if type(table[field]).from_bson == Field.from_bson else None)
+            for field in fields if not table[field].lazy
+        )
+        new_class.__lazy_fields__ = tuple(
+            field for field in fields if table[field].lazy
+        )
+        new_class.__valid_paths__ = set()
+        for field in fields:
+            table[field].__lord__ = new_class
         return new_class
 
 
+def _lookup(classes, key, attrs=None):
+    if attrs is not None and key in attrs:
+        return attrs[key]
+    for klass in classes:
+        if key in klass.__dict__:
+            return klass.__dict__[key]
+    return None
+
+
+def _compile_slots(bases, attrs, fields):
+    """
+    declare the slots of the instance state and of the fields not stored
+    in the slots of a base class yet, return the (field, slot) pairs.
+    """
+    classes = []
+    for base in bases:
+        classes.extend(klass for klass in base.__mro__ if klass not in classes)
+    declared = set()
+    for klass in classes:
+        declared.update(klass.__dict__.get("__slots__", ()))
+    state = []
+    defaults = []
+    for klass in classes:
+        for key in klass.__dict__.get("__state_slots__", ()):
+            if key not in declared and key not in state:
+                state.append(key)
+                if key != "__weakref__":
+                    defaults.append((key, _lookup(classes, key)))
+    stored = []
+    for key in list(fields) + [
+        key for klass in reversed(classes)
+        for key, value in klass.__dict__.iteritems()
+        if isinstance(value, Field)
+    ]:
+        if key not in stored and not isinstance(
+            _lookup(classes, key, attrs), SlotField
+        ):
+            stored.append(key)
+    slots = [(key, "_slot_%s" % key) for key in stored]
+    attrs["__slots__"] = tuple(state) + tuple(slot for key, slot in slots)
+    attrs["__slot_defaults__"] = tuple(
+        _lookup(classes, "__slot_defaults__") or ()
+    ) + tuple(defaults)
+    return slots
+
+
 class MetaClass(BaseMetaClass):
+    """
+    name the collection of the model class and check its __indexes__
+    """
     def __new__(cls, name, bases, attrs):
         if "__collection__" not in attrs:
             attrs["__collection__"] = get_collection_name(name)
-        return super(MetaClass, cls).__new__(cls, name, bases, attrs)
+        new_class = super(MetaClass, cls).__new__(cls, name, bases, attrs)
+        if "__indexes__" in attrs:
+            new_class.__indexes__ = compile_indexes(
+                new_class, attrs["__indexes__"]
+            )
+        collection_models[new_class.__collection__] = new_class
+        return new_class
@@ -0,0 +1,116 @@
+# coding: utf8
+
+import time
+import threading
+from collections import OrderedDict
+
+from .util import get_spec_ids
+
+
+class BaseCache(object):
+    """
+    read cache of the documents loaded by Model.get, declared on the model:
+
+        class TestModel(Model):
+            __cache__ = LRUCache(max_entries=10000, ttl=30)
+
+    Backends implement get/set/delete/clear on string keys and keep the
+    hit, miss and eviction counters.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        return the cached document of the key, None if missing
+        """
+        raise NotImplementedError()
+
+    def set(self, key, document):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def stats(self):
+        return dict(
+            hits=self.hits, misses=self.misses, evictions=self.evictions
+        )
+
+
+class LRUCache(BaseCache):
+    """
+    in-process cache keeps at most max_entries documents for ttl seconds,
+    the least recently used documents are evicted first.
+    """
+    def __init__(self, max_entries=10000, ttl=None):
+        super(LRUCache, self).__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (
+                entry[1] is not None and entry[1] < time.time()
+            ):
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, document):
+        expire = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (document, expire)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        stats = super(LRUCache, self).stats()
+        stats["entries"] = len(self._entries)
+        return stats
+
+
+def get_cache_key(model, model_id):
+    return "%s:%s" % (model.__collection__, model_id)
+
+
+def invalidate(model, spec):
+    """
+    drop the cached documents of model which could match spec, all cached
+    documents are dropped when the matched ids are unknown.
+    """
+    cache = model.__cache__
+    if cache is None:
+        return
+    ids = get_spec_ids(spec)
+    if ids is None:
+        cache.clear()
+    else:
+        for model_id in ids:
+            cache.delete(get_cache_key(model, model_id))
@@ -0,0 +1,200 @@
+# coding: utf8
+
+import itertools
+
+from .fields import ModelField, ListModelField
+from .containers import ToyList
+from .consts import ID
+
+# the embedded models deeper than it are serialized by their own functions
+MAX_INLINE_DEPTH = 4
+
+MISSING = object()
+
+
+class Source(object):
+    """
+    the lines and the globals of a generated function
+    """
+    def __init__(self):
+        self.lines = []
+        self.namespace = dict(MISSING=MISSING, ToyList=ToyList)
+        self._counter = itertools.count()
+
+    def name(self, prefix):
+        return "%s%d" % (prefix, next(self._counter))
+
+    def constant(self, prefix, value):
+        name = self.name(prefix)
+        self.namespace[name] = value
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def build(self, name, filename):
+        code = compile("\n".join(self.lines), filename, "exec")
+        exec code in self.namespace
+        return self.namespace[name]
+
+
+def compile_serializer(cls, inline):
+    """
+    generate the to_dict function of cls: the fields are read in line and
+    the embedded models of the classes inline(class) accepts are serialized
+    in line too. The models with lazy or unloaded fields are left to their
+    _to_dict method.
+    """
+    source = Source()
+    source.emit(0, "def serialize(m):")
+    source.emit(1, "if m.__lazy__ or m.__unloaded__:")
+    source.emit(2, "return m._to_dict()")
+    result = _emit_serializer(source, cls, "m", 1, (cls,), inline)
+    source.emit(1, "return %s" % result)
+    return source.build("serialize", "<%s.to_dict>" % cls.__name__)
+
+
+def _emit_serializer(source, cls, model, indent, stack, inline):
+    result = source.name("r")
+    source.emit(indent, "%s = {%s}" % (result, ", ".join(
+        "%r: %s.%s" % (field, model, field) for field in cls.__scalar_fields__
+    )))
+    if hasattr(cls, "__collection__"):
+        source.emit(indent, "%s[%r] = str(%s._id) if %s._id else None" % (
+            result, ID, model, model
+        ))
+    for field in cls.__submodel_fields__:
+        submodel = cls.__field_table__[field].__f_type__
+        value = source.name("v")
+        source.emit(indent, "%s = %s.%s" % (value, model, field))
+        source.emit(indent, "if %s is None:" % value)
+        source.emit(indent + 1, "%s[%r] = None" % (result, field))
+        if _inlined(submodel, stack, inline):
+            source.emit(indent, "elif %s:" % _exact(source, value, submodel))
+            sub_result = _emit_serializer(
+                source, submodel, value, indent + 1, stack + (submodel,),
+                inline
+            )
+            source.emit(indent + 1, "%s[%r] = %s" % (result, field, sub_result))
+        source.emit(indent, "else:")
+        source.emit(indent + 1, "%s[%r] = %s.to_dict()" % (result, field, value))
+    for field in cls.__list_model_fields__:
+        submodel = cls.__field_table__[field].submodel
+        values = source.name("l")
+        value = source.name("v")
+        source.emit(indent, "%s = []" % values)
+        source.emit(indent, "for %s in %s.%s:" % (value, model, field))
+        if _inlined(submodel, stack, inline):
+            source.emit(indent + 1, "if %s:" % _exact(source, value, submodel))
+            sub_result = _emit_serializer(
+                source, submodel, value, indent + 2, stack + (submodel,),
+                inline
+            )
+            source.emit(indent + 2, "%s.append(%s)" % (values, sub_result))
+            source.emit(indent + 1, "else:")
+            source.emit(indent + 2, "%s.append(%s.to_dict())" % (values, value))
+        else:
+            source.emit(indent + 1, "%s.append(%s.to_dict())" % (values, value))
+        source.emit(indent, "%s[%r] = %s" % (result, field, values))
+    return result
+
+
+def _inlined(submodel, stack, inline):
+    return (
+        len(stack) < MAX_INLINE_DEPTH and submodel not in stack and
+        inline(submodel)
+    )
+
+
+def _exact(source, value, submodel):
+    return "%s.__class__ is %s and not (%s.__lazy__ or %s.__unloaded__)" % (
+        value, source.constant("c", submodel), value, value
+    )
+
+
+def compile_hydrator(cls, inline):
+    """
+    generate the function building a cls model from a whole document,
+    hydrate(document, kwargs), the same as _from_bson without projection.
+    The embedded documents of the classes inline(class) accepts are built
+    in line.
+    """
+    source = Source()
+    source.emit(0, "def hydrate(document, kwargs):")
+    model = _emit_hydrator(
+        source, cls, "document", 1, (cls,), inline, "%s.update(kwargs)"
+    )
+    source.emit(1, "return %s" % model)
+    return source.build("hydrate", "<%s._from_bson>" % cls.__name__)
+
+
+def _emit_hydrator(source, cls, document, indent, stack, inline, head):
+    model = source.name("m")
+    values = source.name("d")
+    get = source.name("g")
+    source.emit(indent, "%s = object.__new__(%s)" % (
+        model, source.constant("c", cls)
+    ))
+    source.emit(indent, "%s = %s.__dict__" % (values, model))
+    source.emit(indent, head % values)
+    source.emit(indent, "%s = %s.get" % (get, document))
+    for key, field, f_type in cls.__hydrators__:
+        name = source.constant("f", field)
+        value = source.name("v")
+        target = "%s[%r]" % (values, key)
+        source.emit(indent, "%s = %s(%r, MISSING)" % (value, get, key))
+        source.emit(indent, "if %s is MISSING:" % value)
+        source.emit(indent + 1, "%s = %s.get_default(%s, True)" % (
+            target, name, model
+        ))
+        submodel = getattr(field, "submodel", field.__f_type__)
+        sub_head = "%%s.update(__lord__=%s, __fieldname__=%r)" % (model, key)
+        if type(field) is ModelField and _inlined(submodel, stack, inline):
+            source.emit(indent, "elif isinstance(%s, dict):" % value)
+            sub_model = _emit_hydrator(
+                source, submodel, value, indent + 1, stack + (submodel,),
+                inline, sub_head
+            )
+            source.emit(indent + 1, "%s = %s" % (target, sub_model))
+        elif type(field) is ListModelField and _inlined(
+            submodel, stack, inline
+        ):
+            source.emit(indent, (
+                "elif isinstance(%s, list) and "
+                "all(isinstance(v, dict) for v in %s):"
+            ) % (value, value))
+            elements = source.name("l")
+            element = source.name("e")
+            source.emit(indent + 1, "%s = []" % elements)
+            source.emit(indent + 1, "for %s in %s:" % (element, value))
+            sub_model = _emit_hydrator(
+                source, submodel, element, indent + 2, stack + (submodel,),
+                inline, sub_head
+            )
+            source.emit(indent + 2, "%s.append(%s)" % (elements, sub_model))
+            source.emit(indent + 1, "%s = ToyList(%s, %s, %r)" % (
+                target, model, elements, key
+            ))
+        if f_type is not None:
+            source.emit(indent, "elif %s.__class__ is %s:" % (
+                value, source.constant("t", f_type)
+            ))
+            source.emit(indent + 1, "%s = %s" % (target, value))
+        source.emit(indent, "else:")
+        source.emit(indent + 1, "%s = %s.from_bson(%s, %s, None)" % (
+            target, name, value, model
+        ))
+    if cls.__lazy_fields__:
+        lazy = source.name("z")
+        source.emit(indent, "%s = %s['__lazy__'] = {}" % (lazy, values))
+        for key in cls.__lazy_fields__:
+            value = source.name("v")
+            source.emit(indent, "%s = %s(%r, MISSING)" % (value, get, key))
+            source.emit(indent, "if %s is MISSING:" % value)
+            source.emit(indent + 1, "%s[%r] = %s.get_default(%s, True)" % (
+                values, key,
+                source.constant("f", cls.__field_table__[key]), model
+            ))
+            source.emit(indent, "else:")
+            source.emit(indent + 1, "%s[%r] = %s" % (lazy, key, value))
+    return model
@@ -8,3 +8,10 @@ DELETE = "remove"
 ID = "_id"
 ASCENDING = 1
 DESCENDING = -1
+CHANGE_SET = "$set"
+CHANGE_UNSET = "$unset"
+CHANGE_PUSH = "$push"
+BULK_ORDERED = "initialize_ordered_bulk_op"
+BULK_UNORDERED = "initialize_unordered_bulk_op"
+BULK_BATCH_SIZE = 1000
+IN_CHUNK_SIZE = 1000
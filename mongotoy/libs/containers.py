@@ -1,38 +1,94 @@
 # coding: utf8
 
-import copy
+from .consts import CHANGE_SET, CHANGE_PUSH
 
-from queue import push_flush_queue
+
+def mark_changed(container, op=CHANGE_SET, values=None):
+    """
+    report the change of container to the model which holds it
+    """
+    lord = container.__lord__
+    if lord is not None and not isinstance(lord, type):
+        lord._mark_changed(container.__fieldname__, op, values)
 
 
 def modified(func):
+    """
+    mark the container changed whenever the mutator is called
+    """
+    def _(self, *args, **kwargs):
+        ret = func(self, *args, **kwargs)
+        mark_changed(self)
+        return ret
+    return _
+
+
+def resized(func):
+    """
+    mark the container changed when the mutator changed its size, used by
+    the mutators which could only add or only remove elements.
+    """
+    def _(self, *args):
+        length = len(self)
+        ret = func(self, *args)
+        if len(self) != length:
+            mark_changed(self)
+        return ret
+    return _
+
+
+def pushed(func):
+    """
+    mark the elements appended to the end of the list
+    """
     def _(self, *args):
-        origin = copy.copy(self)
+        length = len(self)
         ret = func(self, *args)
-        if origin != self:
-            push_flush_queue(self.__lord__)
+        if len(self) != length:
+            mark_changed(self, CHANGE_PUSH, self[length:])
         return ret
     return _
 
 
 class ToyList(list):
-    def __init__(self, lord, l):
+    # unpickling appends the elements before restoring the lord
+    __lord__ = None
+    __fieldname__ = None
+
+    def __init__(self, lord, l, fieldname=None):
         super(ToyList, self).__init__(l)
         self.__lord__ = lord
+        self.__fieldname__ = fieldname
+
+    @modified
+    def __setitem__(self, index, obj):
+        super(ToyList, self).__setitem__(index, obj)
+
+    @modified
+    def __setslice__(self, i, j, objs):
+        super(ToyList, self).__setslice__(i, j, objs)
 
     @modified
     def __delitem__(self, index):
         super(ToyList, self).__delitem__(index)
 
     @modified
-    def __imul__(self, multiply):
-        super(ToyList, self).__imul__(multiply)
+    def __delslice__(self, i, j):
+        super(ToyList, self).__delslice__(i, j)
+
+    @pushed
+    def __iadd__(self, objs):
+        return super(ToyList, self).__iadd__(objs)
 
     @modified
+    def __imul__(self, multiply):
+        return super(ToyList, self).__imul__(multiply)
+
+    @pushed
     def append(self, obj):
         super(ToyList, self).append(obj)
 
-    @modified
+    @pushed
     def extend(self, objs):
         super(ToyList, self).extend(objs)
 
@@ -40,44 +96,80 @@ class ToyList(list):
     def insert(self, index, obj):
         super(ToyList, self).insert(index, obj)
 
+    @modified
+    def pop(self, *args):
+        return super(ToyList, self).pop(*args)
+
+    @modified
+    def remove(self, obj):
+        super(ToyList, self).remove(obj)
+
     @modified
     def reverse(self):
         super(ToyList, self).reverse()
 
+    @modified
+    def sort(self, *args, **kwargs):
+        super(ToyList, self).sort(*args, **kwargs)
+
 
 class ToySet(set):
-    def __init__(self, lord, s):
+    def __init__(self, lord, s, fieldname=None):
         super(ToySet, self).__init__(s)
         self.__lord__ = lord
+        self.__fieldname__ = fieldname
 
-    @modified
-    def __delitem__(self, obj):
-        super(ToySet, self).__delitem__(obj)
+    def __reduce__(self):
+        return (self.__class__, (None, list(self)), self.__dict__)
 
-    @modified
+    @resized
     def __iand__(self, s):
-        super(ToySet, self).__iand__(s)
+        return super(ToySet, self).__iand__(s)
 
-    @modified
+    @resized
     def __ior__(self, s):
-        super(ToySet, self).__ior__(s)
+        return super(ToySet, self).__ior__(s)
 
-    @modified
+    @resized
     def __isub__(self, s):
-        super(ToySet, self).__isub__(s)
+        return super(ToySet, self).__isub__(s)
 
     @modified
     def __ixor__(self, s):
-        super(ToySet, self).__ixor__(s)
+        return super(ToySet, self).__ixor__(s)
 
-    @modified
+    @resized
     def add(self, obj):
         super(ToySet, self).add(obj)
 
-    @modified
+    @resized
     def clear(self):
         super(ToySet, self).clear()
 
+    @resized
+    def discard(self, obj):
+        super(ToySet, self).discard(obj)
+
+    @resized
+    def remove(self, obj):
+        super(ToySet, self).remove(obj)
+
+    @resized
+    def pop(self):
+        return super(ToySet, self).pop()
+
+    @resized
+    def update(self, *s):
+        super(ToySet, self).update(*s)
+
+    @resized
+    def difference_update(self, *s):
+        super(ToySet, self).difference_update(*s)
+
+    @resized
+    def intersection_update(self, *s):
+        super(ToySet, self).intersection_update(*s)
+
     @modified
-    def update(self, s):
-        super(ToySet, self).update(s)
+    def symmetric_difference_update(self, s):
+        super(ToySet, self).symmetric_difference_update(s)
@@ -0,0 +1,126 @@
+# coding: utf8
+
+import Queue
+import logging
+import threading
+
+_logger = logging.getLogger("mongotoy")
+
+
+class FutureTimeout(Exception):
+    pass
+
+
+class Future(object):
+    """
+    result of a call running in the executor
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        wait for the call and return its result, raise the exception raised
+        by the call
+        """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise FutureTimeout()
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        callback(future) is called in the worker thread when the call is
+        done, or immediately when it is already done. The exceptions of
+        the callbacks are logged and ignored.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            _logger.exception("future callback %r failed", callback)
+
+
+class Executor(object):
+    """
+    run blocking calls in a pool of worker threads. At most max_in_flight
+    calls are queued or running, submit blocks until one of them is done.
+    """
+    def __init__(self, workers=10, max_in_flight=100):
+        self._tasks = Queue.Queue()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        self._in_flight.acquire()
+        future = Future()
+        self._tasks.put((future, func, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            future, func, args, kwargs = task
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                finish, value = future.set_exception, e
+            else:
+                finish, value = future.set_result, result
+            self._in_flight.release()
+            try:
+                finish(value)
+            except Exception:
+                # keep the worker alive, the pool would run out of threads
+                _logger.exception("executor failed to finish %r", future)
+
+    def shutdown(self, wait=True):
+        """
+        stop the workers after the submitted calls are done
+        """
+        for thread in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
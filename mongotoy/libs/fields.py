@@ -4,6 +4,7 @@ import copy
 import numbers
 import inspect
 import datetime
+import itertools
 
 from .containers import ToyList
 
@@ -11,8 +12,11 @@ from .containers import ToyList
 class Field(object):
 
     __f_type__ = None
+    lazy = False
+    _counter = itertools.count()
 
     def __init__(self, f_type=None, default=None, allow_none=True):
+        self.__order__ = next(Field._counter)
         if f_type is not None:
             self.__f_type__ = f_type
 
@@ -26,6 +30,26 @@ class Field(object):
         else:
             self.default = default
 
+    def __get__(self, instance, owner):
+        """
+        materialize the raw value kept by a lazy loaded field on first access,
+        raise AttributeError for the fields not loaded by the projection.
+        """
+        if instance is not None:
+            lazy = instance.__lazy__
+            if lazy and self.__field_name__ in lazy:
+                value = self.from_bson(
+                    lazy.pop(self.__field_name__), instance
+                )
+                object.__setattr__(instance, self.__field_name__, value)
+                return value
+            unloaded = instance.__unloaded__
+            if unloaded and self.__field_name__ in unloaded:
+                raise AttributeError("%s.%s is not loaded" % (
+                    owner.__name__, self.__field_name__
+                ))
+        return self
+
     def _return_none(self):
         if not self._allow_none:
             raise ValueError(
@@ -44,6 +68,16 @@ class Field(object):
             return value
         return self._convert_to_f_type(value, lord, presistence)
 
+    def from_bson(self, value, lord=None, projection=None):
+        """
+        convert the value loaded from mongo, values already of the field
+        type are trusted as is. projection is the projection of the embedded
+        documents when they are partially loaded.
+        """
+        if isinstance(value, self.__f_type__):
+            return value
+        return self._convert_to_f_type(value, lord, True)
+
     def _convert_to_f_type(self, value, lord=None, persistence=False):
         if value is None:
             return self._return_none()
@@ -158,12 +192,17 @@ class ListField(Field):
     def __init__(self, default=None, allow_none=True):
         super(ListField, self).__init__(default=default, allow_none=allow_none)
 
+    def from_bson(self, value, lord=None, projection=None):
+        if isinstance(value, list):
+            return ToyList(lord, value, self.__field_name__)
+        return self._convert_to_f_type(value, lord, True)
+
     def _convert_to_f_type(self, value, lord=None, persistence=False):
         if value is None:
             return self._return_none()
         elif isinstance(value, (tuple, set, list)):
-            return ToyList(lord, value)
-        return ToyList(lord, [value])
+            return ToyList(lord, value, self.__field_name__)
+        return ToyList(lord, [value], self.__field_name__)
 
 
 class SetField(Field):
@@ -172,19 +211,29 @@ class SetField(Field):
 
     def normalize_value(self, value, lord=None, presistence=False):
         if isinstance(value, set):
-            return ToyList(lord, value)
-        return ToyList(lord, self._convert_to_f_type(value, lord, presistence))
+            return ToyList(lord, value, self.__field_name__)
+        return ToyList(
+            lord, self._convert_to_f_type(value, lord, presistence),
+            self.__field_name__
+        )
+
+    def from_bson(self, value, lord=None, projection=None):
+        if isinstance(value, list):
+            return ToyList(lord, value, self.__field_name__)
+        return self.normalize_value(value, lord, True)
 
 
 class ModelField(Field):
 
-    def __init__(self, submodel, default=None, allow_none=True):
+    def __init__(self, submodel, default=None, allow_none=True, lazy=False):
         super(ModelField, self).__init__(submodel, default, allow_none)
+        self.lazy = lazy
 
     def get_default(self, lord, persistence):
         if self.default:
             value = copy.deepcopy(self.default)
             value.__lord__ = lord
+            value.__fieldname__ = self.__field_name__
         else:
             value = self.__f_type__(
                 __lord__=lord, __persistence__=persistence,
@@ -192,6 +241,21 @@ class ModelField(Field):
             )
         return value
 
+    def normalize_value(self, value, lord=None, presistence=False):
+        if isinstance(value, self.__f_type__):
+            if not isinstance(lord, type):
+                value.__lord__ = lord
+                value.__fieldname__ = self.__field_name__
+            return value
+        return self._convert_to_f_type(value, lord, presistence)
+
+    def from_bson(self, value, lord=None, projection=None):
+        if isinstance(value, dict):
+            return self.__f_type__._from_bson(
+                value, lord, self.__field_name__, projection
+            )
+        return self.normalize_value(value, lord, True)
+
     def _convert_to_f_type(self, value, lord, persistence=False):
         if isinstance(value, dict):
             return self.__f_type__(
@@ -205,9 +269,10 @@ class ModelField(Field):
 
 
 class ListModelField(ListField):
-    def __init__(self, submodel, default=None, allow_none=True):
+    def __init__(self, submodel, default=None, allow_none=True, lazy=False):
         self.submodel = submodel
         super(ListModelField, self).__init__(default, allow_none)
+        self.lazy = lazy
 
     def get_default(self, lord, persistence):
         if self.default:
@@ -219,20 +284,34 @@ class ListModelField(ListField):
             )]
         return value
 
+    def from_bson(self, value, lord=None, projection=None):
+        if isinstance(value, list) and all(
+            isinstance(v, dict) for v in value
+        ):
+            return ToyList(lord, [
+                self.submodel._from_bson(
+                    v, lord, self.__field_name__, projection
+                ) for v in value
+            ], self.__field_name__)
+        return self._convert_to_f_type(value, lord, True)
+
     def _convert_to_f_type(self, value, lord, persistence=False):
         if value is None:
             return self._return_none()
-        values = ToyList(lord, [])
+        values = ToyList(lord, [], self.__field_name__)
         for model_instance in super(ListModelField, self)._convert_to_f_type(
             value, lord, persistence
         ):
-            if not isinstance(model_instance, self.submodel):
-                if isinstance(model_instance, dict):
-                    model_instance = self.submodel(
-                        __lord__=lord, __persistence__=persistence,
-                        __fieldname__=self.__field_name__, **model_instance
-                    )
-                else:
-                    raise ValueError()
+            if isinstance(model_instance, self.submodel):
+                if not isinstance(lord, type):
+                    model_instance.__lord__ = lord
+                    model_instance.__fieldname__ = self.__field_name__
+            elif isinstance(model_instance, dict):
+                model_instance = self.submodel(
+                    __lord__=lord, __persistence__=persistence,
+                    __fieldname__=self.__field_name__, **model_instance
+                )
+            else:
+                raise ValueError()
             values.append(model_instance)
         return values
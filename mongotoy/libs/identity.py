@@ -0,0 +1,63 @@
+# coding: utf8
+
+import weakref
+
+
+class IdentityMap(object):
+    """
+    keep one model instance for every loaded document, keyed by collection
+    and _id. The models are held by weak references so they are reclaimed
+    once they are no longer referenced. The expired models are still
+    returned by get, Model.get reloads them instead of using them as is.
+    """
+    def __init__(self):
+        self.models = weakref.WeakValueDictionary()
+        self.expired = set()
+
+    def get(self, collection, model_id):
+        if model_id is None:
+            return None
+        return self.models.get((collection, model_id))
+
+    def is_expired(self, model):
+        return (model.__collection__, model._id) in self.expired
+
+    def add(self, model):
+        if model._id:
+            key = (model.__collection__, model._id)
+            self.models[key] = model
+            self.expired.discard(key)
+
+    def remove(self, model):
+        if model._id:
+            key = (model.__collection__, model._id)
+            self.models.pop(key, None)
+            self.expired.discard(key)
+
+    def expire(self, collection, model_ids=None):
+        """
+        mark the loaded models of the ids, all the ones of the collection
+        when the ids are unknown, as possibly changed in the database
+        """
+        keys = self.models.keys()
+        self.expired = set(key for key in self.expired if key in self.models)
+        if model_ids is None:
+            self.expired.update(key for key in keys if key[0] == collection)
+        else:
+            self.expired.update(
+                (collection, model_id) for model_id in model_ids
+                if (collection, model_id) in self.models
+            )
+
+    def clear(self):
+        self.models.clear()
+        self.expired.clear()
+
+
+class NullIdentityMap(IdentityMap):
+    """
+    the identity map of the session when it is not enabled, it keeps
+    nothing so every query builds its own models
+    """
+    def add(self, model):
+        pass
@@ -0,0 +1,221 @@
+# coding: utf8
+
+import warnings
+
+from .consts import ID, ASCENDING, DESCENDING
+
+WARN = "warn"
+RAISE = "raise"
+
+# the debug mode of the queries not covered by an index, see set_index_check
+index_check = None
+
+# the model classes by collection, to ensure the indexes of the mapper
+collection_models = dict()
+
+
+class UnindexedQueryWarning(UserWarning):
+    pass
+
+
+class Index(object):
+    """
+    index declared on the model, the keys are a field name or a list of
+    field names and (field, direction) pairs:
+
+        class TestModel(Model):
+            __indexes__ = [
+                "field1",
+                Index([("field1", ASCENDING), ("field2.name", DESCENDING)],
+                      unique=True),
+                Index("created", expire_after_seconds=3600),
+                Index("field3", partial={"field3": {"$gt": 0}}),
+            ]
+
+    The declarations are checked against the fields when the class is
+    created, Model.ensure_indexes creates them.
+    """
+    def __init__(self, keys, unique=False, sparse=False,
+                 expire_after_seconds=None, partial=None, name=None):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        self.keys = [
+            (key, ASCENDING) if isinstance(key, basestring) else tuple(key)
+            for key in keys
+        ]
+        self.unique = unique
+        self.sparse = sparse
+        self.expire_after_seconds = expire_after_seconds
+        self.partial = partial
+        self.name = name or "_".join(
+            "%s_%s" % (key, direction) for key, direction in self.keys
+        )
+
+    def __repr__(self):
+        return "Index(%r)" % self.keys
+
+    def check(self, model):
+        """
+        raise KeyError on the unknown fields, ValueError on the options
+        mongodb rejects
+        """
+        if not self.keys:
+            raise ValueError("%s: index without keys" % model.__name__)
+        names = [key for key, direction in self.keys]
+        if len(set(names)) != len(names):
+            raise ValueError("%s: duplicate keys in %r" % (
+                model.__name__, self
+            ))
+        for key, direction in self.keys:
+            model.assert_valid_field(key)
+            if direction not in (ASCENDING, DESCENDING) and not isinstance(
+                direction, basestring
+            ):
+                raise ValueError("%s: invalid direction of %s in %r" % (
+                    model.__name__, key, self
+                ))
+        if self.expire_after_seconds is not None:
+            if len(self.keys) > 1:
+                raise ValueError("%s: TTL index on several keys %r" % (
+                    model.__name__, self
+                ))
+            if not isinstance(self.expire_after_seconds, (int, long)) or (
+                self.expire_after_seconds < 0
+            ):
+                raise ValueError("%s: invalid expire_after_seconds of %r" % (
+                    model.__name__, self
+                ))
+        if self.partial is not None:
+            if self.sparse:
+                raise ValueError("%s: index both sparse and partial %r" % (
+                    model.__name__, self
+                ))
+            if not isinstance(self.partial, dict) or not self.partial:
+                raise ValueError("%s: invalid partial filter of %r" % (
+                    model.__name__, self
+                ))
+            for key in self.partial:
+                if not key.startswith("$"):
+                    model.assert_valid_field(key)
+
+    def options(self):
+        """
+        the create_index arguments
+        """
+        options = dict(key_or_list=self.keys, name=self.name)
+        if self.unique:
+            options["unique"] = True
+        if self.sparse:
+            options["sparse"] = True
+        if self.expire_after_seconds is not None:
+            options["expireAfterSeconds"] = self.expire_after_seconds
+        if self.partial is not None:
+            options["partialFilterExpression"] = self.partial
+        return options
+
+
+def compile_indexes(model, declarations):
+    indexes = tuple(
+        index if isinstance(index, Index) else Index(index)
+        for index in declarations
+    )
+    for index in indexes:
+        index.check(model)
+    return indexes
+
+
+def create_indexes(session, model):
+    """
+    create the indexes declared on the model, return their names
+    """
+    return [
+        session.execute(model.__collection__, "create_index", index.options())
+        for index in model.__indexes__
+    ]
+
+
+def set_index_check(mode):
+    """
+    check the spec and the sort of every query against the indexes declared
+    on the model, WARN issues an UnindexedQueryWarning and RAISE raises
+    ValueError when no index prefix covers them, None turns it off.
+    """
+    if mode not in (None, WARN, RAISE):
+        raise ValueError("unknown index check mode: %s" % mode)
+    global index_check
+    index_check = mode
+
+
+def check_query(model, spec, sort):
+    indexes = [[(ID, ASCENDING)]] + [
+        index.keys for index in model.__indexes__
+    ]
+    if _is_covered(indexes, spec or dict(), sort):
+        return
+    message = "%s query not covered by an index: spec=%s, sort=%s" % (
+        model.__name__, spec, sort
+    )
+    if index_check == RAISE:
+        raise ValueError(message)
+    warnings.warn(message, UnindexedQueryWarning, stacklevel=4)
+
+
+def _fields(spec):
+    """
+    the fields compared by equality, the fields in range and the $or
+    branches of the spec
+    """
+    equal, ranged, branches = set(), set(), []
+    for key, value in spec.iteritems():
+        if key == "$and":
+            for sub_spec in value:
+                sub_equal, sub_ranged, sub_branches = _fields(sub_spec)
+                equal |= sub_equal
+                ranged |= sub_ranged
+                branches.extend(sub_branches)
+        elif key == "$or":
+            branches.extend(value)
+        elif key.startswith("$"):
+            continue
+        elif isinstance(value, dict) and value.keys() != ["$eq"] and any(
+            k.startswith("$") for k in value
+        ):
+            ranged.add(key)
+        else:
+            equal.add(key)
+    return equal, ranged, branches
+
+
+def _is_covered(indexes, spec, sort):
+    equal, ranged, branches = _fields(spec)
+    if equal or ranged or sort:
+        if any(_covers(keys, equal, ranged, sort) for keys in indexes):
+            return True
+        if sort or not branches:
+            return False
+    return all(_is_covered(indexes, branch, None) for branch in branches)
+
+
+def _covers(keys, equal, ranged, sort):
+    """
+    whether the index keys have a prefix on the queried fields, followed by
+    the sort keys after the fields compared by equality
+    """
+    names = [key for key, direction in keys]
+    if (equal or ranged) and names[0] not in equal | ranged:
+        return False
+    if not sort:
+        return True
+    sort_names = [key for key, direction in sort]
+    position = 0
+    while position < len(names) and names[position] in equal and (
+        names[position] not in sort_names
+    ):
+        position += 1
+    tail = keys[position:position + len(sort)]
+    if [key for key, direction in tail] != sort_names:
+        return False
+    return len(set(
+        direction == sort_direction
+        for (key, direction), (sort_key, sort_direction) in zip(tail, sort)
+    )) == 1
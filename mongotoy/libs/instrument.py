@@ -0,0 +1,279 @@
+# coding: utf8
+
+import time
+import bisect
+import logging
+import threading
+
+from bson import BSON
+
+EXECUTE = "execute"
+HYDRATE = "hydrate"
+FLUSH = "flush"
+BULK_WRITE = "bulk_write"
+
+REDACTED = "?"
+
+# the registered listeners, the instrumented paths test it before timing
+listeners = []
+
+_measure_bytes = [False]
+_logger = logging.getLogger("mongotoy")
+
+
+def add_listener(listener):
+    """
+    listener(event) is called after every operation sent to mongo, flush
+    and model built from a query result. The event is a dict:
+
+        kind: "execute", "hydrate" or "flush"
+        collection, operation: eg. "test_model", "find"
+        spec: the spec, the filter or the pipeline with the values redacted
+        duration: milliseconds, a cursor is timed until it is exhausted
+        documents: the documents read or written, None if unknown
+        bytes: the BSON size of the documents read or written when a
+            listener has measure_bytes = True, otherwise None
+        error: the exception raised, None on success
+
+    The listeners run in the thread of the operation, their exceptions are
+    logged and ignored.
+    """
+    if listener not in listeners:
+        listeners.append(listener)
+    _measure_bytes[0] = any(
+        getattr(listener, "measure_bytes", False) for listener in listeners
+    )
+
+
+def remove_listener(listener):
+    if listener in listeners:
+        listeners.remove(listener)
+    _measure_bytes[0] = any(
+        getattr(listener, "measure_bytes", False) for listener in listeners
+    )
+
+
+def emit(event):
+    for listener in list(listeners):
+        try:
+            listener(event)
+        except Exception:
+            _logger.exception("instrument listener %r failed", listener)
+
+
+def redact(spec):
+    """
+    replace the values of a spec, a document or a pipeline by "?", keep the
+    field names and the operators:
+
+        redact({"a": 1, "b": {"$in": [1, 2]}}) -> {"a": "?", "b": {"$in": "?"}}
+    """
+    if isinstance(spec, dict):
+        return dict((key, _redact_value(value)) for key, value in spec.items())
+    elif isinstance(spec, (list, tuple)):
+        return [redact(value) for value in spec]
+    elif spec is None:
+        return None
+    return REDACTED
+
+
+def _redact_value(value):
+    if isinstance(value, dict):
+        return redact(value)
+    elif isinstance(value, (list, tuple)) and value and all(
+        isinstance(v, dict) for v in value
+    ):
+        return [redact(v) for v in value]
+    return REDACTED
+
+
+def _spec(fields):
+    for key in ("spec", "spec_or_id", "query", "pipeline"):
+        if key in fields:
+            return redact(fields[key])
+    return None
+
+
+def _event(kind, collection, operation, spec, start, documents=None,
+           size=None, error=None):
+    return dict(
+        kind=kind, collection=collection, operation=operation, spec=spec,
+        duration=(time.time() - start) * 1000, documents=documents,
+        bytes=size, error=error
+    )
+
+
+def _size(documents):
+    return sum(len(BSON.encode(document)) for document in documents)
+
+
+def traced(collection, operation, fields, call):
+    """
+    run call(**fields) and report it, the cursors returned are traced
+    until they are exhausted or released
+    """
+    spec = _spec(fields)
+    start = time.time()
+    try:
+        result = call(**fields)
+    except Exception as e:
+        emit(_event(EXECUTE, collection, operation, spec, start, error=e))
+        raise
+    if hasattr(result, "next"):
+        return TracedCursor(result, collection, operation, spec, start)
+    written = None
+    if "doc_or_docs" in fields:
+        written = fields["doc_or_docs"]
+        if isinstance(written, dict):
+            written = [written]
+    elif "document" in fields:
+        written = [fields["document"]]
+    if written is not None and operation != "update":
+        documents = len(written)
+    elif isinstance(result, dict) and "n" in result:
+        documents = result["n"]
+    elif isinstance(result, dict) and "values" in result:
+        documents = len(result["values"])
+    else:
+        documents = None
+    size = _size(written) if written and _measure_bytes[0] else None
+    emit(_event(
+        EXECUTE, collection, operation, spec, start, documents, size
+    ))
+    return result
+
+
+class TracedCursor(object):
+    """
+    proxy of a cursor counting the documents read, the execute event is
+    reported when the cursor is exhausted, closed or released.
+    """
+    def __init__(self, cursor, collection, operation, spec, start):
+        self._cursor = cursor
+        self._context = (collection, operation, spec, start)
+        self._documents = 0
+        self._bytes = 0 if _measure_bytes[0] else None
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            document = next(self._cursor)
+        except StopIteration:
+            self._finish()
+            raise
+        except Exception as e:
+            self._finish(e)
+            raise
+        self._documents += 1
+        if self._bytes is not None:
+            self._bytes += len(BSON.encode(document))
+        return document
+
+    def __getattr__(self, name):
+        value = getattr(self._cursor, name)
+        if not callable(value):
+            return value
+
+        def method(*args, **kwargs):
+            result = value(*args, **kwargs)
+            return self if result is self._cursor else result
+        return method
+
+    def close(self):
+        self._finish()
+        return self._cursor.close()
+
+    def __del__(self):
+        if "_context" in self.__dict__:
+            self._finish()
+
+    def _finish(self, error=None):
+        if self._done:
+            return
+        self._done = True
+        collection, operation, spec, start = self._context
+        emit(_event(
+            EXECUTE, collection, operation, spec, start, self._documents,
+            self._bytes, error
+        ))
+
+
+def hydrated(model, start):
+    emit(_event(HYDRATE, model.__collection__, HYDRATE, None, start, 1))
+
+
+class SlowOperationLogger(object):
+    """
+    listener logging the events lasting threshold milliseconds or more:
+
+        add_listener(SlowOperationLogger(threshold=100))
+    """
+    def __init__(self, threshold=100, logger=None):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger("mongotoy.slow")
+
+    def __call__(self, event):
+        if event["duration"] >= self.threshold:
+            self.logger.warning(
+                "slow %s %s.%s %.1fms documents=%s bytes=%s spec=%s",
+                event["kind"], event["collection"], event["operation"],
+                event["duration"], event["documents"], event["bytes"],
+                event["spec"]
+            )
+
+
+class MetricsRegistry(object):
+    """
+    listener counting the events, documents, bytes and errors, and the
+    histogram of the durations in milliseconds, by kind, collection and
+    operation:
+
+        metrics = MetricsRegistry()
+        add_listener(metrics)
+        metrics.snapshot()
+        {("execute", "test_model", "find"): {
+            "count": 2, "errors": 0, "documents": 10, "bytes": 0,
+            "duration": 3.2, "histogram": [2, 0, 0, 0, 0, 0, 0, 0, 0]}}
+
+    histogram[i] counts the durations up to buckets[i], the last one the
+    longer durations.
+    """
+    BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self, buckets=BUCKETS, measure_bytes=False):
+        self.buckets = tuple(buckets)
+        self.measure_bytes = measure_bytes
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = (event["kind"], event["collection"], event["operation"])
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = dict(
+                    count=0, errors=0, documents=0, bytes=0, duration=0.0,
+                    histogram=[0] * (len(self.buckets) + 1)
+                )
+            metric["count"] += 1
+            metric["errors"] += event["error"] is not None
+            metric["documents"] += event["documents"] or 0
+            metric["bytes"] += event["bytes"] or 0
+            metric["duration"] += event["duration"]
+            metric["histogram"][
+                bisect.bisect_left(self.buckets, event["duration"])
+            ] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                (key, dict(metric, histogram=list(metric["histogram"])))
+                for key, metric in self._metrics.iteritems()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
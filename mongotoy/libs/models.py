@@ -1,20 +1,46 @@
 # coding: utf8
 
+import copy
+
 from bson.objectid import ObjectId
 
 from .queue import push_flush_queue, pop_from_queue
-from .session import get_session
+from .session import (
+    get_session, get_identity_map, submit, bulk_insert, bulk_upsert
+)
+from .executor import Executor
 from .fields import Field, ListModelField
-from .query import BaseQuery, Query, QueryOne
+from .util import is_projected, sub_projection, get_spec_ids
+from .cache import get_cache_key, invalidate
+from .codegen import compile_serializer, compile_hydrator
+from .query import BaseQuery, Query, QueryOne, PreparedQuery, Update
 from .base import MetaClass, BaseMetaClass
+from .indexes import create_indexes
+from .aggregate import Aggregate
 from .consts import (
-    INSERT, ID, DELETE
+    INSERT, ID, DELETE, CHANGE_SET, CHANGE_UNSET, CHANGE_PUSH, IN_CHUNK_SIZE,
+    BULK_BATCH_SIZE
+)
+from .operators import (
+    QueryOperator, LogicalOperator, Not, Param, Set, SetOnInsert,
+    update_operator_compiler
 )
-from .operators import QueryOperator, LogicalOperator, Not
 
 
 class BaseModel(object):
+    __slots__ = ()
+    __state_slots__ = ("__persistence__", "__lazy__", "__unloaded__")
+    __slot_defaults__ = ()
+    __use_slots__ = False
     __persistence__ = False
+    __lazy__ = None
+    __unloaded__ = None
+
+    def __new__(cls, *args, **kwargs):
+        model = super(BaseModel, cls).__new__(cls)
+        for key, value in cls.__slot_defaults__:
+            object.__setattr__(model, key, value)
+        return model
 
     def __init__(self, *args, **kwargs):
         self.__persistence__ = kwargs.get("__persistence__", False)
@@ -31,8 +57,8 @@ class BaseModel(object):
         self.__persistence__ = False
 
     def __setattr__(self, key, value):
-        if key in self.__fields__:
-            field = getattr(self.__class__, key)
+        if key in self.__field_set__:
+            field = self.__field_table__[key]
             try:
                 value = field.normalize_value(
                     value, self, self.__persistence__
@@ -42,19 +68,120 @@ class BaseModel(object):
                     self.__class__.__name__,
                     key, value, field.__f_type__
                 ))
+            super(BaseModel, self).__setattr__(key, value)
+            self._mark_loaded(key)
             if not self.__persistence__:
-                push_flush_queue(self)
-        super(BaseModel, self).__setattr__(key, value)
+                self._mark_changed(key)
+        else:
+            super(BaseModel, self).__setattr__(key, value)
+
+    def __delattr__(self, key):
+        """
+        reset the field to its default value and unset it in mongo
+        """
+        if key in self.__field_set__:
+            field = self.__field_table__[key]
+            super(BaseModel, self).__setattr__(
+                key, field.get_default(self, True)
+            )
+            self._mark_loaded(key)
+            self._mark_changed(key, CHANGE_UNSET)
+        else:
+            super(BaseModel, self).__delattr__(key)
+
+    def _mark_loaded(self, key):
+        lazy = self.__lazy__
+        if lazy:
+            lazy.pop(key, None)
+        unloaded = self.__unloaded__
+        if unloaded:
+            unloaded.discard(key)
+
+    def _mark_changed(self, path, op=CHANGE_SET, values=None):
+        """
+        record the dotted path changed since load or last flush
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def _from_bson(cls, document, projection=None, **kwargs):
+        """
+        build a model from a document loaded from mongo without running the
+        validation of __setattr__, values already typed by bson are trusted.
+        The documents of lazy fields are kept raw until first access, the
+        fields excluded by projection are recorded as unloaded.
+
+        The whole documents are built by the hydrator compiled for the
+        class on first use.
+        """
+        if not projection and not cls.__use_slots__:
+            hydrator = cls.__dict__.get("__hydrator__")
+            if hydrator is None:
+                hydrator = cls.__hydrator__ = compile_hydrator(
+                    cls, _inline_from_bson
+                )
+            return hydrator(document, kwargs)
+        model = object.__new__(cls)
+        if cls.__use_slots__:
+            for key, value in cls.__slot_defaults__:
+                object.__setattr__(model, key, value)
+            values = dict()
+        else:
+            values = model.__dict__
+        values.update(kwargs)
+        unloaded = set()
+        for key, field, f_type in cls.__hydrators__:
+            if key in document:
+                value = document[key]
+                if value.__class__ is not f_type:
+                    value = field.from_bson(
+                        value, model,
+                        projection and sub_projection(projection, key)
+                    )
+                values[key] = value
+            elif projection and not is_projected(projection, key):
+                unloaded.add(key)
+            else:
+                values[key] = field.get_default(model, True)
+        if cls.__lazy_fields__:
+            lazy = values["__lazy__"] = dict()
+            for key in cls.__lazy_fields__:
+                field = cls.__field_table__[key]
+                if key in document:
+                    sub = projection and sub_projection(projection, key)
+                    if sub:
+                        values[key] = field.from_bson(document[key], model, sub)
+                    else:
+                        lazy[key] = document[key]
+                elif projection and not is_projected(projection, key):
+                    unloaded.add(key)
+                else:
+                    values[key] = field.get_default(model, True)
+        if unloaded:
+            values["__unloaded__"] = unloaded
+        if cls.__use_slots__:
+            for key, value in values.iteritems():
+                object.__setattr__(model, key, value)
+        return model
 
     @classmethod
     def assert_valid_field(cls, field):
+        if field in cls.__valid_paths__:
+            return
         fields = field.split(".", 1)
-        if fields[0] not in cls.__fields__:
+        if fields[0] not in cls.__field_set__:
             raise KeyError("Model %s does not has field named %s" % (
-                cls.__name__, field[0]
+                cls.__name__, fields[0]
             ))
         if len(fields) > 1:
-            getattr(cls, field[0]).assert_valid_field(fields[1])
+            embedded = cls.__field_table__[fields[0]]
+            submodel = getattr(embedded, "submodel", embedded.__f_type__)
+            if not issubclass(submodel, BaseModel):
+                raise KeyError("%s.%s is not an embedded document" % (
+                    cls.__name__, fields[0]
+                ))
+            submodel.assert_valid_field(fields[1])
+        cls.__valid_paths__.add(field)
 
     @classmethod
     def _generate_query_context(cls, *args, **kwargs):
@@ -103,6 +230,32 @@ class BaseModel(object):
         """
         return Query(cls, spec=cls._generate_query_context(*args, **kwargs))
 
+    @classmethod
+    def prepare(cls, *args, **kwargs):
+        """
+        build the spec of a parameterized query once, the Param values are
+        bound at every call without running the query builder again:
+
+            by_field1 = TestModel.prepare(
+                Gt("field2", Param("low")), field1=Param("value")
+            )
+            models = by_field1(value=1, low=0).all()
+            model = by_field1.get(value=1, low=0)
+        """
+        params = dict(
+            (key, value) for key, value in kwargs.iteritems()
+            if isinstance(value, Param)
+        )
+        for key in params:
+            del kwargs[key]
+        spec = cls._generate_query_context(*args, **kwargs)
+        fields = dict()
+        for key, param in params.iteritems():
+            cls.assert_valid_field(key)
+            spec[key] = param
+            fields[param.name] = getattr(cls, key)
+        return PreparedQuery(cls, spec, fields)
+
     @classmethod
     def get_by(cls, *args, **kwargs):
         """
@@ -121,22 +274,50 @@ class BaseModel(object):
 
     def to_dict(self):
         """
-        gather all field values into a dict
+        gather all field values into a dict, the untouched lazy fields reuse
+        the raw documents and the unloaded fields are left out.
+
+        It runs the serializer compiled for the class on first use.
         """
+        serializer = self.__class__.__dict__.get("__serializer__")
+        if serializer is None:
+            serializer = self.__class__.__serializer__ = compile_serializer(
+                self.__class__, _inline_to_dict
+            )
+        return serializer(self)
+
+    def _to_dict(self):
         res = dict()
-        for field, v in self.__class__.__dict__.iteritems():
-            if isinstance(v, ListModelField):
-                res[field] = [
-                    value.to_dict() for value in getattr(self, field)
-                ]
-            elif isinstance(v, Field):
-                value = getattr(self, field)
-                if issubclass(v.__f_type__, SubModel):
-                    res[field] = value.to_dict()
+        lazy = self.__lazy__
+        unloaded = self.__unloaded__
+        if lazy or unloaded:
+            lazy = lazy or dict()
+            unloaded = unloaded or set()
+            for field in self.__fields__:
+                if field in unloaded:
+                    continue
+                elif field in lazy:
+                    res[field] = lazy[field]
                 else:
-                    res[field] = value
+                    res[field] = self._field_to_dict(field)
+            return res
+        for field in self.__scalar_fields__:
+            res[field] = getattr(self, field)
+        for field in self.__submodel_fields__:
+            value = getattr(self, field)
+            res[field] = value if value is None else value.to_dict()
+        for field in self.__list_model_fields__:
+            res[field] = [value.to_dict() for value in getattr(self, field)]
         return res
 
+    def _field_to_dict(self, field):
+        value = getattr(self, field)
+        if field in self.__list_model_fields__:
+            return [v.to_dict() for v in value]
+        elif field in self.__submodel_fields__ and value is not None:
+            return value.to_dict()
+        return value
+
 
 class Model(BaseModel):
     """
@@ -156,27 +337,277 @@ class Model(BaseModel):
 
     __collection__ = None
     __metaclass__ = MetaClass
+    __slots__ = ()
+    __state_slots__ = (
+        "__changes__", "__partial__", "__detached__", "__weakref__"
+    )
     __engine__ = None
     _id = Field(ObjectId, None)
 
     def __new__(cls, **kwargs):
         return super(Model, cls).__new__(cls)
 
+    __diff_ratio__ = 0.5
+    __cache__ = None
+    __indexes__ = ()
+    __partial__ = False
+    __detached__ = False
+
     def __init__(self, *args, **kwargs):
+        self.__changes__ = dict()
         value = kwargs.pop(ID, self._id.get_default())
         self._id = self._id.normalize_value(
             value, self, self.__persistence__
         )
         super(Model, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def _from_bson(cls, document, projection=None, detached=False):
+        """
+        the changes of a detached model are not tracked, it is never put
+        in the flush queue.
+        """
+        if detached:
+            return super(Model, cls)._from_bson(
+                document, projection, __changes__=dict(),
+                __partial__=bool(projection), __detached__=True,
+                _id=document.get(ID)
+            )
+        return super(Model, cls)._from_bson(
+            document, projection, __changes__=dict(),
+            __partial__=bool(projection), _id=document.get(ID)
+        )
+
+    def _mark_changed(self, path, op=CHANGE_SET, values=None):
+        if self.__persistence__ or self.__detached__:
+            return
+        if op == CHANGE_PUSH:
+            change = self.__changes__.get(path)
+            if change is None:
+                self.__changes__[path] = (CHANGE_PUSH, list(values))
+            elif change[0] == CHANGE_PUSH:
+                change[1].extend(values)
+            elif change[0] == CHANGE_UNSET:
+                self.__changes__[path] = (CHANGE_SET, None)
+        else:
+            self.__changes__[path] = (op, None)
+        push_flush_queue(self)
+
+    def _get_path_value(self, path):
+        value = self
+        for key in path.split("."):
+            value = getattr(value, key)
+        return _to_mongo(value)
+
+    def compile_changes(self, changes=None):
+        """
+        build the minimal update document for the changes since load or
+        last flush, fall back to a full $set when the diff is too large and
+        the model is not partially loaded. changes are the ones returned by
+        take_changes, the recorded ones by default.
+        """
+        if changes is None:
+            changes = self.__changes__
+        changes = dict(
+            (path, change) for path, change in changes.iteritems()
+            if not _has_parent(path, changes)
+        )
+        if not changes:
+            return dict()
+        if not self.__partial__ and (
+            len(changes) > len(self.__fields__) * self.__diff_ratio__
+        ):
+            command = self.to_dict()
+            del command[ID]
+            return {CHANGE_SET: command}
+        document = dict()
+        for path, (op, values) in changes.iteritems():
+            if op == CHANGE_UNSET:
+                value = ""
+            elif op == CHANGE_PUSH:
+                value = {"$each": [_to_mongo(v) for v in values]}
+            else:
+                value = self._get_path_value(path)
+            document.setdefault(op, dict())[path] = value
+        return document
+
+    def clear_changes(self):
+        self.__changes__ = dict()
+
+    def _load(self, document, projection=None):
+        """
+        set the fields of the document loaded from mongo without recording
+        changes, the fields excluded or partially loaded by projection are
+        kept as they are.
+        """
+        self.__persistence__ = True
+        try:
+            for key in self.__fields__:
+                if key == ID or projection and (
+                    not is_projected(projection, key) or
+                    sub_projection(projection, key)
+                ):
+                    continue
+                field = self.__field_table__[key]
+                if key in document:
+                    value = field.from_bson(document[key], self)
+                else:
+                    value = field.get_default(self, True)
+                setattr(self, key, value)
+        finally:
+            self.__persistence__ = False
+        if not projection:
+            self.__partial__ = False
+        self.__changes__ = dict()
+
+    def refresh(self):
+        """
+        reload the fields from the database, the pending changes are
+        dropped. Raise ValueError when the document is deleted.
+        """
+        records = Query(
+            self.__class__, spec={ID: self._id}
+        ).as_dicts().limit(1).all()
+        invalidate(self.__class__, {ID: self._id})
+        identity_map = get_identity_map()
+        if not records:
+            identity_map.remove(self)
+            raise ValueError("%s %s is deleted" % (
+                self.__class__.__name__, self._id
+            ))
+        pop_from_queue(self)
+        self._load(records[0])
+        identity_map.add(self)
+        return self
+
+    def expire(self):
+        """
+        mark the model as changed in the database: the next get reloads it
+        instead of returning it as is, and drops its cached document
+        """
+        get_identity_map().expire(self.__collection__, [self._id])
+        invalidate(self.__class__, {ID: self._id})
+
+    def take_changes(self):
+        """
+        take the recorded changes away to write them, the changes made
+        meanwhile are recorded apart.
+        """
+        changes, self.__changes__ = self.__changes__, dict()
+        return changes
+
+    def restore_changes(self, changes):
+        """
+        put back the changes taken by take_changes when they failed to write
+        """
+        changes = dict(changes)
+        for path, change in self.__changes__.iteritems():
+            origin = changes.get(path)
+            if change[0] != CHANGE_PUSH or origin is None:
+                changes[path] = change
+            elif origin[0] == CHANGE_PUSH:
+                changes[path] = (CHANGE_PUSH, origin[1] + change[1])
+            elif origin[0] == CHANGE_UNSET:
+                changes[path] = (CHANGE_SET, None)
+        self.__changes__ = changes
+
     @classmethod
     def get(cls, model_id):
         """
-        get a model instance by id
+        get a model instance by id, the instance already loaded in the
+        session is returned without querying the database.
         """
-        return QueryOne(cls, spec=cls._generate_query_context(
-            _id=model_id
-        ))()
+        spec = cls._generate_query_context(_id=model_id)
+        identity_map = get_identity_map()
+        model = identity_map.get(cls.__collection__, spec[ID])
+        if model is not None and not model.__partial__ and (
+            not identity_map.is_expired(model)
+        ):
+            return model
+        return QueryOne(cls, spec=spec)()
+
+    @classmethod
+    def aget(cls, model_id):
+        """
+        get in the worker threads of the async session, return a Future
+        """
+        return submit(cls.get, model_id)
+
+    @classmethod
+    def aget_by(cls, *args, **kwargs):
+        return submit(cls.get_by, *args, **kwargs)
+
+    @classmethod
+    def aget_many(cls, model_ids, ordered=True, chunk_size=IN_CHUNK_SIZE):
+        return submit(cls.get_many, model_ids, ordered, chunk_size)
+
+    @classmethod
+    def get_many(cls, model_ids, ordered=True, chunk_size=IN_CHUNK_SIZE):
+        """
+        get the model instances of the ids with one $in query per chunk_size
+        ids, the instances already loaded in the session or cached are not
+        queried again. Return the models in the order of model_ids with None
+        for the missing ones, or the found models in any order when ordered
+        is False.
+        """
+        model_ids = [cls._id.normalize_value(i, cls) for i in model_ids]
+        identity_map = get_identity_map()
+        models = dict()
+        missing = []
+        for model_id in model_ids:
+            if model_id in models:
+                continue
+            model = identity_map.get(cls.__collection__, model_id)
+            if model is not None and identity_map.is_expired(model):
+                model = None
+            if (model is None or model.__partial__) and (
+                cls.__cache__ is not None
+            ):
+                document = cls.__cache__.get(get_cache_key(cls, model_id))
+                if document is not None:
+                    model = Query(cls)._hydrate(copy.deepcopy(document))
+            if model is None or model.__partial__:
+                missing.append(model_id)
+                models[model_id] = None
+            else:
+                models[model_id] = model
+        for start in xrange(0, len(missing), chunk_size):
+            query = Query(cls, spec={
+                ID: {"$in": missing[start:start + chunk_size]}
+            })
+            for record in query.as_dicts():
+                if cls.__cache__ is not None:
+                    cls.__cache__.set(
+                        get_cache_key(cls, record[ID]), copy.deepcopy(record)
+                    )
+                models[record[ID]] = query._hydrate(record)
+        if ordered:
+            return [models[model_id] for model_id in model_ids]
+        return [model for model in models.itervalues() if model is not None]
+
+    @classmethod
+    def assert_valid_field(cls, field):
+        if field != ID:
+            super(Model, cls).assert_valid_field(field)
+
+    @classmethod
+    def aggregate(cls):
+        """
+        build an aggregation pipeline of the collection, see Aggregate
+
+        eg:
+            TestModel.aggregate().match(field1=1).group(
+                "field2", total={"$sum": "$field3"}
+            ).all()
+        """
+        return Aggregate(cls)
+
+    @classmethod
+    def ensure_indexes(cls):
+        """
+        create the indexes declared in __indexes__, return their names
+        """
+        return create_indexes(get_session(), cls)
 
     @classmethod
     def get_by(cls, *args, **kwargs):
@@ -205,14 +636,250 @@ class Model(BaseModel):
             self.__collection__, INSERT, dict(doc_or_docs=command)
         )
         self._id = _id
+        self.clear_changes()
+        invalidate(self.__class__, {ID: _id})
+        get_identity_map().add(self)
 
-    def delete(self):
-        get_session().execute(
-            self.__collection__, DELETE, dict(spec_or_id={ID: self._id})
+    @classmethod
+    def insert_many(cls, records, chunk_size=BULK_BATCH_SIZE, ordered=False,
+                    validate=True):
+        """
+        insert the documents or the new models of records, any iterable,
+        chunk_size at a time in bulk operations, eg:
+
+            result = TestModel.insert_many(
+                (dict(field1=i) for i in xrange(1000000)), validate=False
+            )
+
+        validate builds a model of every document to check and convert its
+        fields, the unknown fields are errors. Without it the documents are
+        inserted as they are. An ordered insert stops at the first error.
+        Return the inserted _ids and the errors, the index of a row is its
+        position in records:
+
+            {"nInserted": 2, "insertedIds": [ObjectId(..), ObjectId(..)],
+             "writeErrors": [{"index": 1, "errmsg": "..."}]}
+        """
+        result = dict(nInserted=0, insertedIds=[], writeErrors=[])
+        for indexes, rows in _iter_chunks(
+            records, chunk_size, ordered, result["writeErrors"],
+            lambda record: cls._insert_document(record, validate)
+        ):
+            documents = [document for document, model in rows]
+            try:
+                details, failed = bulk_insert(
+                    cls.__collection__, documents, ordered
+                )
+            except Exception:
+                for document, model in rows:
+                    if model is not None:
+                        push_flush_queue(model)
+                raise
+            for error in details["writeErrors"]:
+                error["index"] = indexes[error["index"]]
+                result["writeErrors"].append(error)
+            for position, (document, model) in enumerate(rows):
+                if position in failed:
+                    # the model keeps its changes for the next flush
+                    if model is not None:
+                        push_flush_queue(model)
+                    continue
+                result["insertedIds"].append(document[ID])
+                if model is not None:
+                    model._id = document[ID]
+                    model.clear_changes()
+                    get_identity_map().add(model)
+            result["nInserted"] += details["nInserted"]
+            if ordered and failed:
+                break
+        result["writeErrors"].sort(key=lambda error: error["index"])
+        return result
+
+    @classmethod
+    def _insert_document(cls, record, validate):
+        """
+        get the document to insert of the record, and the model passed.
+        The model is taken out of the flush queue while it is inserted,
+        insert_many puts it back when its insert fails.
+        """
+        if isinstance(record, cls):
+            document = record.to_dict()
+            del document[ID]
+            if record._id:
+                document[ID] = record._id
+            pop_from_queue(record)
+            return document, record
+        elif not isinstance(record, dict):
+            raise TypeError("%s can not insert %r" % (cls.__name__, record))
+        elif not validate:
+            return dict(record), None
+        unknown = [
+            key for key in record if key != ID and key not in cls.__field_set__
+        ]
+        if unknown:
+            raise KeyError("Model %s does not has field named %s" % (
+                cls.__name__, ", ".join(unknown)
+            ))
+        model = cls(__persistence__=True, **record)
+        document = model.to_dict()
+        del document[ID]
+        if model._id:
+            document[ID] = model._id
+        return document, None
+
+    @classmethod
+    def upsert_many(cls, records, key=(ID, ), on_insert=None, on_update=None,
+                    chunk_size=BULK_BATCH_SIZE, ordered=False, workers=1):
+        """
+        update the documents matching the key fields of the records, insert
+        the missing ones, chunk_size records per bulk operation:
+
+            result = TestModel.upsert_many(
+                records, key=("tenant", "external_id"),
+                on_insert=lambda record: dict(created=datetime.now())
+            )
+
+        The fields of a record but the key are set. on_update replaces
+        them, it is a dict of fields to set or a function of the record
+        returning one, an update operator or a list of them. on_insert is a
+        dict of fields, or a function of the record returning one, set only
+        when the document is inserted, the fields also set by the update are
+        left out. workers writes the chunks of an unordered upsert in
+        parallel threads. Return the counts of the created and the updated
+        documents and the errors by record index:
+
+            {"nUpserted": 1, "nMatched": 2, "nModified": 1,
+             "writeErrors": [{"index": 1, "errmsg": "..."}]}
+        """
+        if isinstance(key, basestring):
+            key = (key, )
+        for field in key:
+            cls.assert_valid_field(field)
+        if ordered and workers > 1:
+            raise ValueError("an ordered upsert runs in one worker")
+        result = dict(nUpserted=0, nMatched=0, nModified=0, writeErrors=[])
+        chunks = _iter_chunks(
+            records, chunk_size, ordered, result["writeErrors"],
+            lambda record: cls._upsert_document(
+                record, key, on_insert, on_update
+            )
         )
+        if workers > 1:
+            executor = Executor(workers, workers)
+            submitted = []
+            try:
+                for indexes, updates in chunks:
+                    submitted.append((updates, executor.submit(
+                        cls._upsert_chunk, indexes, updates, False
+                    )))
+                for updates, future in submitted:
+                    _merge_upserts(result, future.result()[0])
+            finally:
+                executor.shutdown()
+                for updates, future in submitted:
+                    cls._expire_upserts(updates)
+        else:
+            for indexes, updates in chunks:
+                try:
+                    details, failed = cls._upsert_chunk(
+                        indexes, updates, ordered
+                    )
+                finally:
+                    cls._expire_upserts(updates)
+                _merge_upserts(result, details)
+                if ordered and failed:
+                    break
+        result["writeErrors"].sort(key=lambda error: error["index"])
+        return result
 
-    def to_dict(self):
-        res = super(Model, self).to_dict()
+    @classmethod
+    def _upsert_chunk(cls, indexes, updates, ordered):
+        try:
+            details, failed = bulk_upsert(
+                cls.__collection__, updates, ordered
+            )
+        finally:
+            for spec, document in updates:
+                invalidate(cls, spec)
+        for error in details["writeErrors"]:
+            error["index"] = indexes[error["index"]]
+        return details, failed
+
+    @classmethod
+    def _expire_upserts(cls, updates):
+        """
+        expire the loaded models the upserts could match, in the thread of
+        the caller whose identity map they are kept in
+        """
+        model_ids = []
+        for spec, document in updates:
+            ids = get_spec_ids(spec)
+            if ids is None:
+                model_ids = None
+                break
+            model_ids.extend(ids)
+        get_identity_map().expire(cls.__collection__, model_ids)
+
+    @classmethod
+    def _upsert_document(cls, record, key, on_insert, on_update):
+        """
+        get the spec and the update document of the record
+        """
+        if not isinstance(record, dict):
+            raise TypeError("%s can not upsert %r" % (cls.__name__, record))
+        missing = [field for field in key if field not in record]
+        if missing:
+            raise KeyError("record has no key field %s" % ", ".join(missing))
+        spec = update_operator_compiler(cls, Set(
+            (field, record[field]) for field in key
+        ))["$set"]
+        if on_update is None:
+            operators = Set(
+                (field, value) for field, value in record.iteritems()
+                if field not in spec
+            )
+        elif callable(on_update):
+            operators = on_update(record)
+        else:
+            operators = on_update
+        if isinstance(operators, dict):
+            operators = Set(operators)
+        if not isinstance(operators, (list, tuple)):
+            operators = [operators]
+        document = Update(cls, spec, operators, False, True).get_commands()[
+            "document"
+        ]
+        document = dict(
+            (op, values) for op, values in document.iteritems() if values
+        )
+        if on_insert is not None:
+            values = on_insert(record) if callable(on_insert) else on_insert
+            updated = set(
+                path for op, fields in document.iteritems() for path in fields
+            )
+            values = dict(
+                (path, value) for path, value in values.iteritems()
+                if path not in updated
+            )
+            if values:
+                document.update(update_operator_compiler(
+                    cls, SetOnInsert(values)
+                ))
+        if not document:
+            document = {"$setOnInsert": spec}
+        return spec, document
+
+    def delete(self):
+        try:
+            get_session().execute(
+                self.__collection__, DELETE, dict(spec_or_id={ID: self._id})
+            )
+        finally:
+            invalidate(self.__class__, {ID: self._id})
+        get_identity_map().remove(self)
+
+    def _to_dict(self):
+        res = super(Model, self)._to_dict()
         res[ID] = str(self._id) if self._id else None
         return res
 
@@ -222,8 +889,96 @@ class SubModel(BaseModel):
     __fieldname__ = None
 
     __metaclass__ = BaseMetaClass
+    __slots__ = ()
+    __state_slots__ = ("__lord__", "__fieldname__")
 
     def __init__(self, *args, **kwargs):
         self.__lord__ = kwargs.pop("__lord__", None)
         self.__fieldname__ = kwargs.pop("__fieldname__", None)
         super(SubModel, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def _from_bson(cls, document, lord=None, fieldname=None, projection=None):
+        return super(SubModel, cls)._from_bson(
+            document, projection, __lord__=lord, __fieldname__=fieldname
+        )
+
+    def _mark_changed(self, path, op=CHANGE_SET, values=None):
+        lord = self.__lord__
+        if self.__persistence__ or not isinstance(lord, BaseModel):
+            return
+        if self.__fieldname__ in lord.__list_model_fields__:
+            lord._mark_changed(self.__fieldname__)
+        else:
+            lord._mark_changed(
+                "%s.%s" % (self.__fieldname__, path), op, values
+            )
+
+
+def _inline_to_dict(model):
+    return model.to_dict.__func__ is BaseModel.to_dict.__func__
+
+
+def _inline_from_bson(model):
+    return (
+        not model.__use_slots__ and
+        model._from_bson.__func__ is SubModel._from_bson.__func__
+    )
+
+
+def _has_parent(path, paths):
+    while "." in path:
+        path = path.rsplit(".", 1)[0]
+        if path in paths:
+            return True
+    return False
+
+
+def _iter_chunks(records, chunk_size, ordered, errors, build):
+    """
+    yield the indexes and the results of build(record) of the records
+    chunk_size at a time. The records build fails on are added to errors,
+    an ordered iteration stops at the first one.
+    """
+    indexes, rows = [], []
+    for index, record in enumerate(records):
+        try:
+            row = build(record)
+        except Exception as e:
+            errors.append(dict(
+                index=index, errmsg="%s: %s" % (e.__class__.__name__, e)
+            ))
+            if ordered:
+                break
+            continue
+        indexes.append(index)
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield indexes, rows
+            indexes, rows = [], []
+    if rows:
+        yield indexes, rows
+
+
+def _merge_upserts(result, details):
+    for key in ("nUpserted", "nMatched"):
+        result[key] += details[key]
+    if result["nModified"] is not None:
+        if details["nModified"] is None:
+            result["nModified"] = None
+        else:
+            result["nModified"] += details["nModified"]
+    result["writeErrors"].extend(details["writeErrors"])
+
+
+def _to_mongo(value):
+    if isinstance(value, BaseModel):
+        if value.__unloaded__:
+            raise ValueError(
+                "%s is partially loaded and can not be written back" %
+                value.__class__.__name__
+            )
+        return value.to_dict()
+    elif isinstance(value, list):
+        return [_to_mongo(v) for v in value]
+    return value
@@ -16,6 +16,18 @@ class Operator(object):
         pass
 
 
+class Param(object):
+    """
+    placeholder of a value bound when a prepared query runs, see
+    Model.prepare
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "Param(%r)" % self.name
+
+
 class QueryOperator(Operator):
     def __init__(self, field=None, value=None):
         if field is not None:
@@ -24,8 +36,13 @@ class QueryOperator(Operator):
 
 
 class UpdateOperator(Operator):
-    def __init__(self, value):
-        super(UpdateOperator, self).__init__(value)
+    """
+    the fields are passed as a dict or as keyword arguments:
+
+        Set(dict(field1=1)), Set(field1=1)
+    """
+    def __init__(self, value=None, **kwargs):
+        super(UpdateOperator, self).__init__(dict(value or (), **kwargs))
 
 
 class LogicalOperator(Operator):
@@ -290,37 +307,41 @@ class Size(Array):
 
 
 def _assert_vaild_field(model, key):
-    fields = key.split(".")
+    model.assert_valid_field(key)
+
+
+def _get_field(model, key):
+    """
+    get the field of the dotted path
+    """
     submodel = model
-    for field in fields:
-        if hasattr(model, field):
-            submodel = getattr(submodel, field)
-        else:
-            raise KeyError(
-                "%s doesn't has field named %s" % (submodel.__name__, field)
-            )
+    for name in key.split("."):
+        field = getattr(submodel, name)
+        submodel = getattr(field, "submodel", field.__f_type__)
+    return field
 
 
-def _get_field_type(model, key):
-    fields = key.split(".")
-    real_field = model
-    for field in fields:
-        real_field = getattr(real_field, key)
-    return real_field.field_type
+def _to_value(value):
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    return value
 
 
 def update_operator_compiler(model, instance):
-    for key, value in instance.command.iteritems():
+    values = dict()
+    for key, value in instance.value.iteritems():
         _assert_vaild_field(model, key)
-        field_type = _get_field_type(model, key)
+        field = _get_field(model, key)
+        field_type = field.__f_type__
         if (
-            isinstance(instance, (Inc, Mul)) and not isinstance(field_type, numbers.Number)
+            isinstance(instance, (Inc, Mul)) and
+            not issubclass(field_type, numbers.Number)
         ) or (
-            isinstance(instance, (Min, Max)) and not isinstance(
+            isinstance(instance, (Min, Max)) and not issubclass(
                 field_type, (numbers.Number, datetime.datetime, datetime.date)
             )
         ) or (
-            isinstance(instance, CurrentDate) and not isinstance(
+            isinstance(instance, CurrentDate) and not issubclass(
                 field_type, (datetime.datetime, datetime.date)
             )
         ) or (
@@ -332,13 +353,17 @@ def update_operator_compiler(model, instance):
                     instance.__class__.__name__
                 )
             )
-        if isinstance(instance, Set) and not isinstance(value, field_type):
+        if isinstance(instance, (Set, SetOnInsert)):
             try:
-                instance[key] = field_type.normalize_vlaue(value)
-            except:
+                value = field.normalize_value(value, model, False)
+            except Exception:
                 raise SyntaxError(
                     "%s.%s, wrong field type. %s expected, %s gived" % (
                         model.__name__, key, field_type.__name__, type(value)
                     )
                 )
-    return instance.compile()
+            if isinstance(value, list):
+                value = [_to_value(v) for v in value]
+            value = _to_value(value)
+        values[key] = value
+    return instance.__class__(values).compile()
@@ -1,13 +1,22 @@
 # coding: utf8
 
 import copy
-
-from .session import get_session
-from .util import generate_field
-from .operators import Set, update_operator_compiler
+import time
+import base64
+
+from bson import BSON
+from bson.son import SON
+
+from .session import get_session, get_identity_map, submit
+from .util import generate_field, get_spec_ids
+from .cache import get_cache_key, invalidate
+from .scan import ParallelScan, THREAD
+from . import indexes
+from .instrument import listeners, hydrated
+from .operators import Set, Param, update_operator_compiler
 from .consts import (
     QUERY_FIND, ASCENDING, DESCENDING,
-    DELETE, UPDATE
+    DELETE, UPDATE, ID
 )
 
 
@@ -20,10 +29,15 @@ class BaseQuery(object):
                  fields=None, skip=0, *args, **kwargs):
         self.parent = None
         self.model = model
+        self._compiled = None
         self.commands = dict()
         self.commands["spec"] = spec or dict()
-        self.commands["sort"] = sort or dict()
-        self.commands["fields"] = fields or list()
+        if isinstance(sort, dict):
+            sort = sort.items()
+        self.commands["sort"] = sort or None
+        if isinstance(fields, (list, tuple)):
+            fields = dict((field, 1) for field in fields)
+        self.commands["fields"] = fields or None
         try:
             self.commands["skip"] = int(skip)
         except ValueError:
@@ -39,7 +53,31 @@ class BaseQuery(object):
         )
 
     def get_commands(self):
-        commands = copy.deepcopy(self.commands)
+        """
+        compile the find arguments once per query, the specs are treated as
+        immutable once built: the returned dict is shared, never change it.
+        """
+        if self._compiled is None or self._compiled[0] is not self.parent:
+            self._compiled = (self.parent, self._compile_commands())
+        return self._compiled[1]
+
+    def _set_command(self, key, value):
+        self.commands[key] = value
+        self._compiled = None
+        return self
+
+    def _derive(self, **commands):
+        """
+        copy the query with the pass commands replaced
+        """
+        query = copy.copy(self)
+        query.cursor = None
+        query._compiled = None
+        query.commands = dict(self.commands, **commands)
+        return query
+
+    def _compile_commands(self):
+        commands = dict(self.commands)
         if self.parent:
             for key in ("spec", "fields", "sort"):
                 values = commands[key]
@@ -73,23 +111,59 @@ class BaseQuery(object):
     def _compile_context(self):
         raise NotImplementedError()
 
+    def _hydrate(self, record):
+        """
+        get the model of the record, reuse the instance already loaded in
+        the identity map: it is refreshed from the record unless it has
+        pending changes, a partially loaded one with pending changes is
+        replaced by the record of a whole document.
+        """
+        projection = self.commands["fields"]
+        identity_map = get_identity_map()
+        model = identity_map.get(self.model.__collection__, record.get(ID))
+        if model is not None and model.__changes__ and (
+            not model.__partial__ or projection
+        ):
+            return model
+        start = time.time() if listeners else None
+        if model is None or model.__changes__:
+            model = self.model._from_bson(record, projection)
+        else:
+            model._load(record, projection)
+        identity_map.add(model)
+        if start is not None:
+            hydrated(self.model, start)
+        return model
+
     def execute_context(self, context):
         raise NotImplementedError()
 
-    def sort(self, **kwargs):
+    def _check_indexes(self, spec, sort=None):
+        """
+        the debug check of the unindexed queries, see set_index_check
+        """
+        if indexes.index_check is not None and not self.parent:
+            indexes.check_query(self.model, spec, sort)
+
+    def sort(self, *args, **kwargs):
         """
         Sorts this cursor’s results.
 
         Pass a field name and a direction, either ASCENDING or DESCENDING:
 
         query().sort(field_one=ASCENDING, field_two=DESCENDING, ...)
+
+        keyword arguments have no order, pass (field, direction) pairs to sort
+        by several keys:
+
+        query().sort(("field_one", ASCENDING), ("field_two", DESCENDING))
         """
-        for key, value in kwargs.iteritems():
-            self.model.assert_vaild_field(key)
+        keys = list(args) + kwargs.items()
+        for key, value in keys:
+            self.model.assert_valid_field(key)
             if value not in (DESCENDING, ASCENDING):
                 raise ValueError("sort, invaild key")
-        self.commands["sort"] = kwargs
-        return self
+        return self._set_command("sort", keys)
 
     def skip(self, num):
         """
@@ -104,22 +178,51 @@ class BaseQuery(object):
             query().skip(number)
         """
         try:
-            self.commands["skip"] = int(num)
+            return self._set_command("skip", int(num))
         except ValueError:
             raise ValueError("skip must be int")
 
     def filters(self, fields):
         """
+        same as only(*fields)
+        """
+        return self.only(*fields)
+
+    def only(self, *fields):
+        """
+        Only load the pass fields, dotted paths load part of embedded
+        documents. The models are partially loaded: reading the fields not
+        loaded raises AttributeError and they are never written back.
+
+        eg:
+            query().only("field1", "field3.sub_field1")
+        """
+        return self._project(fields, 1)
+
+    def exclude(self, *fields):
         """
+        Load all fields except the pass ones, see only()
+
+        eg:
+            query().exclude("field2")
+        """
+        return self._project(fields, 0)
+
+    def _project(self, fields, value):
         for field in fields:
-            self.model.assert_vaild_field(field)
-        self.commands["fields"] = fields
+            self.model.assert_valid_field(field)
+        return self._set_command(
+            "fields", dict((field, value) for field in fields)
+        )
 
 
 class Query(BaseQuery):
     def __init__(self, model, **kwargs):
         super(Query, self).__init__(model, **kwargs)
         self.cursor = None
+        self.row = None
+        self.streaming = False
+        self.options = dict()
         self.commands["limit"] = kwargs.get("limit", 0)
 
     def __getitem__(self, item):
@@ -135,15 +238,160 @@ class Query(BaseQuery):
         if self.cursor is None:
             context = self._compile_context()
             self.execute_context(context)
-        record = next(self.cursor)
-        return self.model(__persistence__=True, **record)
+        return self._load(next(self.cursor))
+
+    def _load(self, record):
+        if self.row is not None:
+            return self.row(record)
+        elif self.streaming:
+            start = time.time() if listeners else None
+            model = self.model._from_bson(
+                record, self.commands["fields"], detached=True
+            )
+            if start is not None:
+                hydrated(self.model, start)
+            return model
+        return self._hydrate(record)
 
     def _compile_context(self, operation=QUERY_FIND):
         collection = self.model.__collection__
         return (collection, operation, self.get_commands())
 
     def execute_context(self, context):
+        self._check_indexes(context[2]["spec"], context[2]["sort"])
         self.cursor = get_session().execute(*context)
+        for option, value in self.options.iteritems():
+            getattr(self.cursor, option)(value)
+
+    def _set_option(self, option, value):
+        self.options[option] = value
+        if self.cursor is not None:
+            getattr(self.cursor, option)(value)
+        return self
+
+    def batch_size(self, size):
+        """
+        fetch size documents per round trip
+
+        eg:
+            query().batch_size(500)
+        """
+        assert isinstance(size, int), "batch_size access int argument"
+        return self._set_option("batch_size", size)
+
+    def max_time_ms(self, ms):
+        """
+        abort the query on the server when it runs more than ms milliseconds,
+        pymongo raises ExecutionTimeout.
+        """
+        assert isinstance(ms, int), "max_time_ms access int argument"
+        return self._set_option("max_time_ms", ms)
+
+    def stream(self):
+        """
+        yield detached models: they are not kept in the identity map and
+        their changes are not tracked, so nothing keeps the models already
+        yielded alive.
+
+        eg:
+            for models in query().stream().iter_chunks(1000):
+                export(models)
+        """
+        self.streaming = True
+        return self
+
+    def iter_chunks(self, size):
+        """
+        yield lists of at most size results, the models or the rows of
+        as_dicts/values_list/scalar. One chunk is fetched per round trip.
+        """
+        self.batch_size(size)
+        chunk = []
+        for result in self:
+            chunk.append(result)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def parallel_scan(self, workers=4, mode=THREAD, ordered=True,
+                      chunk_size=100, queue_size=10):
+        """
+        scan the query with workers threads, or forked processes when mode
+        is "process", reading disjoint _id ranges, see ParallelScan.
+
+        eg:
+            scan = query().parallel_scan(workers=8, ordered=False)
+            for model in scan:
+                pass
+            print scan.stats
+        """
+        return ParallelScan(
+            self, workers, mode, ordered, chunk_size, queue_size
+        )
+
+    def _split(self, workers, ordered):
+        """
+        split the query into at most workers queries of disjoint _id ranges,
+        the split points are sampled from the _id index.
+        """
+        spec = self.commands["spec"]
+        count = Query(self.model, spec=spec).count()
+        points = []
+        for index in xrange(1, workers):
+            query = Query(self.model, spec=spec).sort((ID, ASCENDING))
+            for point in query.skip(count * index // workers).limit(
+                    1).scalar(ID):
+                if not points or point > points[-1]:
+                    points.append(point)
+        bounds = [None] + points + [None]
+        queries = []
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            id_range = dict()
+            if low is not None:
+                id_range["$gte"] = low
+            if high is not None:
+                id_range["$lt"] = high
+            range_spec = spec
+            if id_range:
+                range_spec = (
+                    {"$and": [spec, {ID: id_range}]} if spec
+                    else {ID: id_range}
+                )
+            queries.append(self._derive(
+                spec=range_spec, sort=[(ID, ASCENDING)] if ordered else None
+            ))
+        return queries
+
+    def _convert(self, record):
+        """
+        convert the record without the identity map, safe in the workers
+        """
+        if self.row is not None:
+            return self.row(record)
+        return self.model._from_bson(
+            record, self.commands["fields"], detached=self.streaming
+        )
+
+    def _adopt(self, result):
+        """
+        get the model already loaded in the session instead of the one
+        converted by a worker
+        """
+        if self.row is not None or self.streaming:
+            return result
+        identity_map = get_identity_map()
+        model = identity_map.get(self.model.__collection__, result._id)
+        if model is None or model.__changes__ and model.__partial__ and (
+            not result.__partial__
+        ):
+            identity_map.add(result)
+            return result
+        if not model.__changes__:
+            model._load(result.to_dict(), self.commands["fields"])
+            identity_map.add(model)
+        return model
 
     def all(self):
         """
@@ -151,42 +399,297 @@ class Query(BaseQuery):
         """
         return list(self)
 
+    def aall(self):
+        """
+        all() in the worker threads of the async session, return a Future
+        """
+        return submit(self.all)
+
+    def as_dicts(self):
+        """
+        yield the raw documents instead of models
+
+        eg:
+            query().sort(field1=ASCENDING).as_dicts()
+        """
+        self.row = _document
+        return self
+
+    def values_list(self, *fields):
+        """
+        yield a tuple of the pass field values for every document, dotted
+        paths read embedded documents and missing values are None.
+
+        eg:
+            for field1, sub_field1 in query().values_list(
+                    "field1", "field3.sub_field1"):
+                pass
+        """
+        self.only(*fields)
+        self.row = lambda record: tuple(
+            _get_value(record, field) for field in fields
+        )
+        return self
+
+    def scalar(self, field):
+        """
+        yield the value of the pass field for every document
+
+        eg:
+            ids = list(query().scalar("_id"))
+        """
+        self.only(field)
+        self.row = lambda record: _get_value(record, field)
+        return self
+
+    def paginate_after(self, last=None, page_size=20):
+        """
+        get the page of page_size results following last, which is a model
+        or raw document of the previous page, its sort key values or the
+        token of the previous page, None for the first page. Return the
+        results and the token of the next page, None after the last page:
+
+            query = TestModel.query().sort(field1=DESCENDING)
+            models, token = query.paginate_after(None, 20)
+            models, token = query.paginate_after(token, 20)
+
+        The page is selected by a range predicate on the sort keys and _id
+        instead of skip, so every page costs the same at any depth.
+        """
+        keys = self._keyset()
+        spec = self.commands["spec"]
+        if last is not None:
+            spec = _seek(spec, keys, self._key_values(last, keys))
+        fields = self.commands["fields"]
+        if fields and any(fields.itervalues()):
+            fields = dict(fields)
+            fields.update((key, 1) for key, direction in keys)
+        query = self._derive(
+            spec=spec, fields=fields, sort=keys, limit=page_size, skip=0
+        )
+        query.execute_context(query._compile_context())
+        records = list(query.cursor)
+        token = None
+        if records and len(records) == page_size:
+            token = _encode_token(
+                keys, [_get_value(records[-1], key) for key, d in keys]
+            )
+        return [query._load(record) for record in records], token
+
+    def iter_pages(self, page_size=20):
+        """
+        yield the results page by page, see paginate_after
+
+        eg:
+            for models in query().sort(field1=ASCENDING).iter_pages(100):
+                pass
+        """
+        token = None
+        while True:
+            results, token = self.paginate_after(token, page_size)
+            if results:
+                yield results
+            if token is None:
+                return
+
+    def _keyset(self):
+        """
+        the sort keys of the pages, _id breaks the ties
+        """
+        keys = list(self.commands["sort"] or [])
+        if ID not in [key for key, direction in keys]:
+            keys.append((ID, keys[-1][1] if keys else ASCENDING))
+        return keys
+
+    def _key_values(self, last, keys):
+        if isinstance(last, basestring):
+            return _decode_token(last, keys)
+        elif isinstance(last, self.model):
+            values = []
+            for key, direction in keys:
+                value = last
+                for k in key.split("."):
+                    value = getattr(value, k, None)
+                values.append(value)
+            return values
+        elif isinstance(last, dict):
+            return [_get_value(last, key) for key, direction in keys]
+        elif isinstance(last, (list, tuple)):
+            if len(last) != len(keys):
+                raise ValueError("need the values of %s" % keys)
+            return list(last)
+        elif len(keys) == 1:
+            return [last]
+        raise ValueError("need the values of %s" % keys)
+
     def limit(self, capicity):
         """
         query().limit(count)
         """
         assert isinstance(capicity, int), "limit access int argument"
-        self.commands["limit"] = capicity
-        return self
+        return self._set_command("limit", capicity)
 
-    def update(self, if_not_create=False, multi=True, *args, **kwargs):
+    def update(self, *args, **kwargs):
         """
-        update model
+        update the matched documents with the update operators, the keyword
+        arguments are set, if_not_create upserts and multi updates all the
+        matched documents:
+
+            query(field1=1).update(Inc(field2=1), field3=2, multi=False)
         """
+        if_not_create = kwargs.pop("if_not_create", False)
+        multi = kwargs.pop("multi", True)
         args = list(args)
         if kwargs and not any(isinstance(x, Set) for x in args):
             args.append(Set(kwargs))
+        spec = self.get_commands()["spec"]
+        self._check_indexes(spec)
         update = Update(self.model,
-                        spec=self.get_commands()["spec"],
+                        spec=spec,
                         document=args,
                         multi=multi,
                         upsert=if_not_create)
-        return get_session().execute(*update.compile_context())
+        try:
+            return get_session().execute(*update.compile_context())
+        finally:
+            # after the write, a concurrent get would cache the old document
+            invalidate(self.model, spec)
+            get_identity_map().expire(
+                self.model.__collection__, get_spec_ids(spec)
+            )
 
     def delete(self):
         collection = self.model.__collection__
-        get_session().execute(
-            collection, DELETE, dict(spec_or_id=self.get_commands()["spec"])
-        )
+        spec = self.get_commands()["spec"]
+        self._check_indexes(spec)
+        try:
+            get_session().execute(collection, DELETE, dict(spec_or_id=spec))
+        finally:
+            invalidate(self.model, spec)
+            get_identity_map().expire(collection, get_spec_ids(spec))
 
-    def count(self):
+    def count(self, fast=False, limit=None, hint=None, estimated=False):
         """
-        get the records count in this query operator
+        get the records count in this query operator. fast runs the count
+        command without opening a cursor, it stops counting at limit,
+        the limit of the query by default, and uses the hint index, a name
+        or (field, direction) pairs. estimated reads the count from the
+        collection metadata, only for the queries without spec.
+
+        eg:
+            query(field1=1).count(fast=True, limit=1000, hint="field1_1")
+            query().count(estimated=True)
         """
-        if self.cursor is None:
-            context = self._compile_context()
-            self.execute_context(context)
-        return self.cursor.count()
+        if estimated:
+            if self.commands["spec"]:
+                raise ValueError("estimated count of a query with spec")
+            return int(get_session().command(
+                self.model.__collection__, "count"
+            )["n"])
+        elif not fast:
+            if self.cursor is None:
+                context = self._compile_context()
+                self.execute_context(context)
+            return self.cursor.count()
+        commands = self.get_commands()
+        self._check_indexes(commands["spec"])
+        options = dict(query=commands["spec"])
+        limit = commands["limit"] if limit is None else limit
+        if limit:
+            options["limit"] = limit
+        if commands["skip"]:
+            options["skip"] = commands["skip"]
+        if hint is not None:
+            options["hint"] = hint if isinstance(hint, basestring) else SON(
+                hint
+            )
+        if "max_time_ms" in self.options:
+            options["maxTimeMS"] = self.options["max_time_ms"]
+        return int(get_session().command(
+            self.model.__collection__, "count", **options
+        )["n"])
+
+    def exists(self):
+        """
+        whether the query matches a document, only the _id of the first
+        one is loaded and no model is built
+        """
+        query = self._derive(fields={ID: 1}, limit=-1, sort=None)
+        query.row = _document
+        return next(query, None) is not None
+
+    def distinct(self, field):
+        """
+        get the distinct values of the field in the documents of the query
+        """
+        self.model.assert_valid_field(field)
+        commands = self.get_commands()
+        self._check_indexes(commands["spec"])
+        options = dict(key=field)
+        if commands["spec"]:
+            options["query"] = commands["spec"]
+        if "max_time_ms" in self.options:
+            options["maxTimeMS"] = self.options["max_time_ms"]
+        return get_session().command(
+            self.model.__collection__, "distinct", **options
+        )["values"]
+
+
+def _document(record):
+    return record
+
+
+def _seek(spec, keys, values):
+    """
+    build the spec of the documents sorted after values. The null and
+    missing values sort before the others like in mongo: the documents
+    with a value follow null in ascending order, the null ones follow the
+    values in descending order.
+    """
+    clauses = []
+    for index, (key, direction) in enumerate(keys):
+        prefix = dict(
+            (k, v) for (k, d), v in zip(keys[:index], values[:index])
+        )
+        value = values[index]
+        if direction == ASCENDING:
+            after = [{"$ne": None} if value is None else {"$gt": value}]
+        elif value is None:
+            after = []
+        else:
+            after = [{"$lt": value}, None]
+        for condition in after:
+            clause = dict(prefix)
+            clause[key] = condition
+            clauses.append(clause)
+    seek = clauses[0] if len(clauses) == 1 else {"$or": clauses}
+    if not spec:
+        return seek
+    return {"$and": [spec, seek]}
+
+
+def _encode_token(keys, values):
+    return base64.urlsafe_b64encode(
+        BSON.encode(dict(keys=[list(key) for key in keys], values=values))
+    )
+
+
+def _decode_token(token, keys):
+    try:
+        document = BSON(base64.urlsafe_b64decode(str(token))).decode()
+    except Exception:
+        raise ValueError("invalid page token: %s" % token)
+    if [tuple(key) for key in document["keys"]] != keys:
+        raise ValueError("the page token is built for another sort")
+    return document["values"]
+
+
+def _get_value(record, field):
+    for key in field.split("."):
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+    return record
 
 
 class QueryOne(BaseQuery):
@@ -195,14 +698,88 @@ class QueryOne(BaseQuery):
         collection = self.model.__collection__
         return (collection, QUERY_FIND, self.get_commands())
 
+    def _cache_key(self):
+        """
+        get the key of the cached document when the query is a plain get
+        by _id of a model declared __cache__
+        """
+        spec = self.commands["spec"]
+        if (self.model.__cache__ is None or self.parent or
+                self.commands["fields"] or spec.keys() != [ID] or
+                isinstance(spec[ID], dict)):
+            return None
+        return get_cache_key(self.model, spec[ID])
+
     def execute_context(self, context):
+        key = self._cache_key()
+        if key is not None:
+            document = self.model.__cache__.get(key)
+            if document is not None:
+                return self._hydrate(copy.deepcopy(document))
+        self._check_indexes(context[2]["spec"])
         for result in get_session().execute(*context).limit(-1):
-            return self.model(__persistence__=True, **result)
+            if key is not None:
+                self.model.__cache__.set(key, copy.deepcopy(result))
+            return self._hydrate(result)
 
     def __call__(self):
         return self.execute_context(self._compile_context())
 
 
+class PreparedQuery(object):
+    """
+    a query spec built once with Param placeholders, see Model.prepare.
+    fields are the fields compared to the params directly, their values are
+    normalized like the query builder does.
+    """
+    def __init__(self, model, spec, fields):
+        self.model = model
+        self.spec = spec
+        self.fields = fields
+
+    def bind(self, **params):
+        """
+        get the spec with the params bound
+        """
+        values = dict()
+        for name, value in params.iteritems():
+            field = self.fields.get(name)
+            if field is not None:
+                try:
+                    value = field.normalize_value(value, self.model, False)
+                except Exception:
+                    raise TypeError(
+                        "ValueTypeError: %s.%s  value: %s, except %s" % (
+                            self.model.__name__, field.__field_name__,
+                            value, field.__f_type__
+                        )
+                    )
+                if isinstance(value, list) and len(value) == 1:
+                    value = value[0]
+            values[name] = value
+        return _bind(self.spec, values)
+
+    def __call__(self, **params):
+        return Query(self.model, spec=self.bind(**params))
+
+    def get(self, **params):
+        return QueryOne(self.model, spec=self.bind(**params))()
+
+
+def _bind(template, values):
+    if isinstance(template, Param):
+        if template.name not in values:
+            raise KeyError("missing query parameter %s" % template.name)
+        return values[template.name]
+    elif isinstance(template, dict):
+        return dict(
+            (key, _bind(value, values)) for key, value in template.iteritems()
+        )
+    elif isinstance(template, list):
+        return [_bind(value, values) for value in template]
+    return template
+
+
 class Update(object):
     """
     Update object, wrap the params of find method in pymongo
@@ -2,7 +2,10 @@
 
 import threading
 
-_queue_lock = threading.Lock()
+# reentrant, the global flush holds it and takes it again to update the queue
+_queue_lock = threading.RLock()
+_local = threading.local()
+_push_callbacks = []
 
 
 class Queue(object):
@@ -19,9 +22,8 @@ class Queue(object):
 
     def pop(self, obj):
         if obj._id and obj._id in self.obj_ids:
-            self.obj_ids.remove(obj)
-        if self.objs:
-            self.objs.remove(obj)
+            self.obj_ids.remove(obj._id)
+        self.objs.discard(obj)
 
     def exists(self, obj):
         return (obj._id and obj._id in self.obj_ids) or (obj in self.objs)
@@ -29,6 +31,9 @@ class Queue(object):
     def get_all(self):
         return self.objs
 
+    def __len__(self):
+        return len(self.objs)
+
     def clear(self):
         self.obj_ids = set()
         self.objs = set()
@@ -37,10 +42,31 @@ class Queue(object):
 flush_queue = Queue()
 
 
+def get_unit_of_work():
+    """
+    get the unit of work bound to the current thread, None when the models
+    are tracked by the process-global flush_queue.
+    """
+    return getattr(_local, "unit", None)
+
+
+def bind_unit_of_work(unit):
+    """
+    bind unit to the current thread, return the unit bound before
+    """
+    previous = getattr(_local, "unit", None)
+    _local.unit = unit
+    return previous
+
+
 def pop_from_queue(model):
     model = _get_parent(model)
     if model is not None:
-        if flush_queue.exists(model):
+        unit = get_unit_of_work()
+        if unit is not None:
+            with unit.lock:
+                unit.queue.pop(model)
+        elif flush_queue.exists(model):
             with _queue_lock:
                 if flush_queue.exists(model):
                     flush_queue.pop(model)
@@ -49,9 +75,28 @@ def pop_from_queue(model):
 def push_flush_queue(model):
     model = _get_parent(model)
     if model is not None:
-        if not flush_queue.exists(model):
+        unit = get_unit_of_work()
+        if unit is not None:
+            with unit.lock:
+                unit.queue.push(model)
+        elif not flush_queue.exists(model):
             with _queue_lock:
                 flush_queue.push(model)
+            for callback in _push_callbacks:
+                callback(model)
+
+
+def add_push_callback(callback):
+    """
+    callback(model) is called in the changing thread after a model is
+    pushed to the process-global flush_queue
+    """
+    _push_callbacks.append(callback)
+
+
+def remove_push_callback(callback):
+    if callback in _push_callbacks:
+        _push_callbacks.remove(callback)
 
 
 def _get_parent(model):
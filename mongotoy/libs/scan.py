@@ -0,0 +1,155 @@
+# coding: utf8
+
+import time
+import Queue
+import threading
+import traceback
+import multiprocessing
+
+from .consts import ID, ASCENDING
+
+THREAD = "thread"
+PROCESS = "process"
+
+_CHUNK, _DONE, _ERROR = range(3)
+
+
+class ParallelScan(object):
+    """
+    the results of a query scanned by several workers, every worker reads
+    and converts the documents of one _id range:
+
+        scan = TestModel.query().parallel_scan(workers=4)
+        for model in scan:
+            pass
+        scan.stats
+
+    The results are passed in chunks of chunk_size through queues holding
+    at most queue_size chunks. Ordered scans yield the ranges one after
+    another in _id order, the others yield the chunks as they come. The
+    process workers are forked, they need picklable results.
+    """
+    def __init__(self, query, workers=4, mode=THREAD, ordered=True,
+                 chunk_size=100, queue_size=10):
+        if mode not in (THREAD, PROCESS):
+            raise ValueError("unknown parallel scan mode: %s" % mode)
+        commands = query.commands
+        if commands["skip"] or commands["limit"]:
+            raise ValueError("parallel scan does not support skip and limit")
+        if commands["sort"] and commands["sort"] != [(ID, ASCENDING)]:
+            raise ValueError("parallel scan only sorts by _id")
+        self.query = query
+        self.workers = workers
+        self.mode = mode
+        self.ordered = ordered
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.stats = []
+
+    def __iter__(self):
+        queries = self.query._split(self.workers, self.ordered)
+        if self.mode == THREAD:
+            queue_class, worker_class = Queue.Queue, threading.Thread
+            stopped = threading.Event()
+        else:
+            queue_class = multiprocessing.Queue
+            worker_class = multiprocessing.Process
+            stopped = multiprocessing.Event()
+        if self.ordered:
+            queues = [queue_class(self.queue_size) for query in queries]
+        else:
+            queues = [queue_class(self.queue_size)] * len(queries)
+        workers = []
+        for index, query in enumerate(queries):
+            worker = worker_class(
+                target=_scan,
+                args=(index, query, queues[index], stopped, self.chunk_size,
+                      self.mode == PROCESS)
+            )
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        self.stats = []
+        try:
+            if self.ordered:
+                for queue in queues:
+                    for results in self._receive(queue, 1):
+                        yield results
+            else:
+                for results in self._receive(queues[0], len(workers)):
+                    yield results
+        finally:
+            stopped.set()
+            if self.mode == PROCESS:
+                _drain(workers, set(queues))
+            for worker in workers:
+                worker.join()
+            self.stats.sort(key=lambda stats: stats["worker"])
+
+    def _receive(self, queue, workers):
+        while workers:
+            kind, index, value = queue.get()
+            if kind == _CHUNK:
+                for result in value:
+                    yield self.query._adopt(result)
+            elif kind == _DONE:
+                self.stats.append(value)
+                workers -= 1
+            elif isinstance(value, Exception):
+                raise value
+            else:
+                raise RuntimeError(
+                    "parallel scan worker %d failed:\n%s" % (index, value)
+                )
+
+
+def _drain(workers, queues):
+    """
+    empty the queues until the workers exit, a process does not exit
+    before the messages it put are read.
+    """
+    while any(worker.is_alive() for worker in workers):
+        for queue in queues:
+            try:
+                while True:
+                    queue.get(timeout=0.01)
+            except Queue.Empty:
+                pass
+
+
+def _put(queue, stopped, message):
+    while not stopped.is_set():
+        try:
+            queue.put(message, timeout=0.1)
+            return True
+        except Queue.Full:
+            continue
+    return False
+
+
+def _scan(index, query, queue, stopped, chunk_size, forked):
+    start = time.time()
+    documents = 0
+    chunk = []
+    try:
+        query.execute_context(query._compile_context())
+        for record in query.cursor:
+            chunk.append(query._convert(record))
+            if len(chunk) == chunk_size:
+                if not _put(queue, stopped, (_CHUNK, index, chunk)):
+                    return
+                documents += len(chunk)
+                chunk = []
+        if chunk and not _put(queue, stopped, (_CHUNK, index, chunk)):
+            return
+        documents += len(chunk)
+    except Exception as e:
+        _put(queue, stopped, (
+            _ERROR, index, traceback.format_exc() if forked else e
+        ))
+        return
+    seconds = time.time() - start
+    _put(queue, stopped, (_DONE, index, dict(
+        worker=index, documents=documents, seconds=seconds,
+        rate=documents / seconds if seconds else 0
+    )))
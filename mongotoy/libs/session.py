@@ -1,17 +1,26 @@
 # coding: utf8
 
+import time
 import threading
 
 import pymongo
+from pymongo.errors import BulkWriteError
 
 from .util import get_collection_name
-from .queue import flush_queue, get_lock
-from .consts import ID, UPDATE, INSERT
-from .operators import Set
+from .queue import (
+    Queue, flush_queue, get_lock, get_unit_of_work, bind_unit_of_work
+)
+from .identity import IdentityMap, NullIdentityMap
+from .cache import invalidate
+from .executor import Executor
+from .indexes import create_indexes, collection_models
+from .instrument import listeners, traced, emit, FLUSH, BULK_WRITE, EXECUTE
+from .consts import ID, BULK_ORDERED, BULK_UNORDERED, BULK_BATCH_SIZE
 
 
 _lock = threading.Lock()
 session = None
+executor = None
 
 
 class Session(object):
@@ -19,6 +28,7 @@ class Session(object):
         self._lookup_table = {}
         self.mapper = dict()
         self.session = None
+        self.identity_map = NullIdentityMap()
         self.load_table_mapper(kwargs.get("collection_mapper", dict()))
 
     def load_table_mapper(self, mapper):
@@ -41,8 +51,41 @@ class Session(object):
 
     def execute(self, collection, func, fields):
         db = self._search_propable_db(collection)
-        func = getattr(self.session[db][collection], func)
-        return func(**fields)
+        call = getattr(self.session[db][collection], func)
+        if not listeners or func in (BULK_ORDERED, BULK_UNORDERED):
+            return call(**fields)
+        return traced(collection, func, fields, call)
+
+    def command(self, collection, name, **options):
+        """
+        run the database command on the collection, eg: count, distinct
+        """
+        db = self._search_propable_db(collection)
+        if not listeners:
+            return self.session[db].command(name, collection, **options)
+        return traced(
+            collection, name, options,
+            lambda **options: self.session[db].command(
+                name, collection, **options
+            )
+        )
+
+    def ensure_indexes(self):
+        """
+        create the indexes declared on the models of the collection mapper,
+        return their names by collection
+        """
+        names = dict()
+        for collections in self.mapper.itervalues():
+            for collection in collections:
+                if collection not in collection_models:
+                    raise ValueError(
+                        "not get the model of the collection %s" % collection
+                    )
+                names[collection] = create_indexes(
+                    self, collection_models[collection]
+                )
+        return names
 
     def close(self):
         """
@@ -99,6 +142,55 @@ def create_session(host, port=27017, max_pool_size=100,
         )
 
 
+def ensure_indexes():
+    """
+    create the indexes declared on the models of the session mapper
+    """
+    return session.ensure_indexes()
+
+
+def create_async_session(host, port=27017, max_pool_size=100,
+                         collection_mapper=None, workers=10,
+                         max_in_flight=100, **kwargs):
+    """
+    Create a new connection like create_session, and a pool of worker
+    threads running the a* methods (Model.aget, Query.aall, aflush...) which
+    return a Future instead of blocking. At most max_in_flight calls are
+    queued or running, the callers block until one of them is done.
+    """
+    create_session(host, port, max_pool_size, collection_mapper, **kwargs)
+    start_executor(workers, max_in_flight)
+
+
+def start_executor(workers=10, max_in_flight=100):
+    """
+    start the worker threads of the a* methods, replace the running ones
+    """
+    with _lock:
+        global executor
+        if executor:
+            executor.shutdown(wait=False)
+        executor = Executor(workers, max_in_flight)
+
+
+def submit(func, *args, **kwargs):
+    """
+    run func in the worker threads with the unit of work of the caller,
+    return a Future of its result
+    """
+    if executor is None:
+        raise ValueError("async session is not created")
+    unit = get_unit_of_work()
+
+    def _():
+        previous = bind_unit_of_work(unit)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            bind_unit_of_work(previous)
+    return executor.submit(_)
+
+
 def loads_db_mapper(mapper):
     with _lock:
         if not session:
@@ -110,47 +202,284 @@ def get_session():
     return session
 
 
-def _insert(session, models):
-    for collection, contexts in models.iteritems():
-        commands = [m.to_dict() for m in contexts]
-        for command in commands:
-            del command[ID]
-        ids = session.execute(
-            collection, INSERT, dict(doc_or_docs=commands)
-        )
-        for model, model_id in zip(contexts, ids):
-            model._id = model_id
-
-
-def _update(session, models):
-    for model in models:
-        update_command = model.to_dict()
-        del update_command[ID]
-        session.execute(
-            model.__collection__, UPDATE,
-            dict(
-                spec={ID: model._id},
-                document=Set(update_command).compile()
-            )
+class UnitOfWork(object):
+    """
+    the models changed and loaded in one unit of work, eg. one request:
+
+        with unit_of_work() as uow:
+            model = TestModel.get(_id)
+            model.field1 = 2
+            uow.flush()
+
+    While it is bound to the thread, the changes are tracked in its own
+    queue under its own lock instead of the global one, the loaded models
+    are kept in its own identity map and flush only writes the models
+    changed in it. The models changed while an aflush of the unit is
+    running stay queued for the next flush.
+    """
+    def __init__(self):
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.identity_map = IdentityMap()
+        self._previous = []
+
+    def __enter__(self):
+        self._previous.append(bind_unit_of_work(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        bind_unit_of_work(self._previous.pop())
+
+    def flush(self, batch_size=BULK_BATCH_SIZE, ordered=True):
+        with self:
+            return flush(batch_size, ordered)
+
+
+def unit_of_work():
+    """
+    create a unit of work, bind it to the thread with the with statement
+    """
+    return UnitOfWork()
+
+
+def use_identity_map(enabled=True):
+    """
+    keep the models loaded outside the units of work in an identity map of
+    the session. It is off by default: the models of the session map are
+    shared by all the threads and only reloaded on the queries, see
+    Model.expire.
+    """
+    if not session:
+        raise ValueError("session is not created")
+    session.identity_map = IdentityMap() if enabled else NullIdentityMap()
+
+
+def get_identity_map():
+    """
+    get the identity map of the unit of work bound to the current thread,
+    the one of the session in global mode, which keeps nothing unless
+    use_identity_map is called.
+    """
+    unit = get_unit_of_work()
+    if unit is None:
+        return session.identity_map
+    return unit.identity_map
+
+
+def _insert_operation(model):
+    document = model.to_dict()
+    del document[ID]
+
+    def _(bulk):
+        bulk.insert(document)
+        model._id = document[ID]
+    return _
+
+
+def _update_operation(model, document):
+    def _(bulk):
+        bulk.find({ID: model._id}).update_one(document)
+    return _
+
+
+def _bulk_write(session, collection, operations, batch_size, ordered):
+    """
+    execute the operations of one collection in batches, return the merged
+    result and the indexes of the failed or unexecuted operations.
+    """
+    result = dict(
+        nInserted=0, nMatched=0, nModified=0, nUpserted=0, writeErrors=[]
+    )
+    failed = set()
+    for start in xrange(0, len(operations), batch_size):
+        batch = operations[start:start + batch_size]
+        bulk = session.execute(
+            collection, BULK_ORDERED if ordered else BULK_UNORDERED, dict()
         )
+        for operation in batch:
+            operation(bulk)
+        started = time.time() if listeners else None
+        error = None
+        try:
+            details = bulk.execute()
+        except BulkWriteError as e:
+            details = e.details
+            error = e
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if started is not None:
+                emit(dict(
+                    kind=EXECUTE, collection=collection, operation=BULK_WRITE,
+                    spec=None, duration=(time.time() - started) * 1000,
+                    documents=len(batch), bytes=None, error=error
+                ))
+        for key in ("nInserted", "nMatched", "nUpserted"):
+            result[key] += details.get(key, 0)
+        if result["nModified"] is not None:
+            if details.get("nModified") is None:
+                result["nModified"] = None
+            else:
+                result["nModified"] += details["nModified"]
+        for error in details.get("writeErrors", []):
+            error["index"] += start
+            failed.add(error["index"])
+            result["writeErrors"].append(error)
+        if ordered and failed:
+            failed.update(xrange(min(failed), len(operations)))
+            break
+    return result, failed
+
+
+def bulk_insert(collection, documents, ordered=False):
+    """
+    insert the documents in one bulk operation, the documents get their
+    _id. Return the result summary and the indexes of the documents not
+    inserted.
+    """
+    def _insert(document):
+        return lambda bulk: bulk.insert(document)
+    return _bulk_write(
+        get_session(), collection, [_insert(d) for d in documents],
+        max(len(documents), 1), ordered
+    )
+
+
+def bulk_upsert(collection, updates, ordered=False):
+    """
+    upsert the (spec, document) pairs in one bulk operation, return the
+    result summary and the indexes of the updates not written.
+    """
+    def _upsert(spec, document):
+        return lambda bulk: bulk.find(spec).upsert().update_one(document)
+    return _bulk_write(
+        get_session(), collection, [_upsert(s, d) for s, d in updates],
+        max(len(updates), 1), ordered
+    )
 
 
-def flush():
+def flush(batch_size=BULK_BATCH_SIZE, ordered=True):
     """
     push all change to mongo db. It is a block operator so would be takes some time.
+
+    The changes are grouped by collection and sent as bulk operations of at
+    most batch_size documents, an ordered bulk stops at the first error.
+    Return the result summary of every collection, eg:
+
+        {"collection": {"nInserted": 1, "nMatched": 2, "nModified": 2,
+                        "nUpserted": 0, "writeErrors": []}}
+
+    Models failed to write stay in the flush queue.
+
+    Flush the models changed in the unit of work bound to the current
+    thread, or all models changed in global mode.
     """
+    if not listeners:
+        return _flush_bound(batch_size, ordered)
+    start = time.time()
+    error = documents = None
+    try:
+        results = _flush_bound(batch_size, ordered)
+        documents = sum(
+            result["nInserted"] + result["nMatched"] + result["nUpserted"]
+            for result in results.itervalues()
+        )
+        return results
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        emit(dict(
+            kind=FLUSH, collection=None, operation=FLUSH, spec=None,
+            duration=(time.time() - start) * 1000, documents=documents,
+            bytes=None, error=error
+        ))
+
+
+def _flush_bound(batch_size, ordered):
+    unit = get_unit_of_work()
+    if unit is not None:
+        return _flush(
+            unit.queue, unit.lock, unit.identity_map, batch_size, ordered
+        )
     with get_lock():
-        session = get_session()
-        insert_models = {}
-        update_models = []
-        for model in flush_queue.get_all():
-            if model._id:
-                update_models.append(model)
+        return _flush(
+            flush_queue, get_lock(), get_session().identity_map, batch_size,
+            ordered
+        )
+
+
+def _flush(queue, lock, identity_map, batch_size, ordered):
+    """
+    write the models of the queue, lock guards the queue against the models
+    pushed meanwhile: only the models taken from the queue are removed.
+    """
+    results = dict()
+    session = get_session()
+    models = dict()
+    with lock:
+        pending_models = list(queue.get_all())
+    for model in pending_models:
+        collection = model.__collection__
+        if collection not in models:
+            models[collection] = ([], [])
+        inserts, updates = models[collection]
+        if model._id:
+            updates.append(model)
+        else:
+            inserts.append(model)
+    failed_models = []
+    for collection, (inserts, updates) in models.iteritems():
+        contexts = []
+        operations = []
+        try:
+            for model in inserts:
+                contexts.append((model, model.take_changes()))
+                operations.append(_insert_operation(model))
+            for model in updates:
+                changes = model.take_changes()
+                contexts.append((model, changes))
+                document = model.compile_changes(changes)
+                if document:
+                    operations.append(_update_operation(model, document))
+                else:
+                    contexts.pop()
+            if not operations:
+                continue
+            results[collection], failed = _bulk_write(
+                session, collection, operations, batch_size, ordered
+            )
+        except Exception:
+            # the models stay in the queue with the changes taken back
+            for index, (model, changes) in enumerate(contexts):
+                if index < len(inserts):
+                    model._id = None
+                model.restore_changes(changes)
+            raise
+        for index, (model, changes) in enumerate(contexts):
+            if index >= len(inserts):
+                invalidate(model.__class__, {ID: model._id})
+            if index in failed:
+                if index < len(inserts):
+                    model._id = None
+                model.restore_changes(changes)
+                failed_models.append(model)
             else:
-                collection = model.__collection__
-                if collection not in insert_models:
-                    insert_models[collection] = []
-                insert_models[collection].append(model)
-        _insert(session, insert_models)
-        _update(session, update_models)
-        flush_queue.clear()
+                identity_map.add(model)
+    with lock:
+        for model in pending_models:
+            queue.pop(model)
+        for model in failed_models:
+            queue.push(model)
+        for model in pending_models:
+            if model.__changes__:
+                queue.push(model)
+    return results
+
+
+def aflush(batch_size=BULK_BATCH_SIZE, ordered=True):
+    """
+    flush in the worker threads, return a Future of the flush result
+    """
+    return submit(flush, batch_size, ordered)
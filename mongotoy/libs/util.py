@@ -2,6 +2,8 @@
 
 import copy
 
+from .consts import ID
+
 
 def generate_field(parent, field):
     return "%s.%s" % (parent, field)
@@ -16,3 +18,45 @@ def get_collection_name(model_name):
                 character, "_" + character.lower()
             )
     return collection_name
+
+
+def get_spec_ids(spec):
+    """
+    get the _id values a spec is restricted to, None when they are unknown:
+
+        get_spec_ids({"_id": {"$in": [1, 2]}}) -> [1, 2]
+        get_spec_ids({"field1": 1}) -> None
+    """
+    model_id = spec.get(ID)
+    if isinstance(model_id, dict):
+        return model_id.get("$in") if len(model_id) == 1 else None
+    elif model_id is not None:
+        return [model_id]
+    return None
+
+
+def is_projected(projection, field):
+    """
+    check whether mongo returns the field under the projection, eg:
+
+        is_projected({"a": 1, "b.c": 1}, "b") -> True
+        is_projected({"a": 0}, "a") -> False
+    """
+    if any(v for k, v in projection.iteritems() if k != ID):
+        if field in projection:
+            return bool(projection[field])
+        prefix = field + "."
+        return any(key.startswith(prefix) for key in projection)
+    return projection.get(field, 1) != 0
+
+
+def sub_projection(projection, field):
+    """
+    get the projection of the embedded document, None if it is fully loaded
+    """
+    prefix = field + "."
+    projection = dict(
+        (key[len(prefix):], value) for key, value in projection.iteritems()
+        if key.startswith(prefix)
+    )
+    return projection or None
@@ -0,0 +1,275 @@
+# coding: utf8
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+from mongotoy.libs.session import Session
+
+
+class FakeBulk(object):
+    def __init__(self, collection, ordered):
+        self.collection = collection
+        self.ordered = ordered
+        self.operations = []
+
+    def insert(self, document):
+        document.setdefault("_id", ObjectId())
+        self.operations.append(("insert", document))
+
+    def find(self, spec):
+        bulk = self
+
+        class _(object):
+            def upsert(self):
+                class _(object):
+                    def update_one(self, document):
+                        bulk.operations.append(("upsert", spec, document))
+                return _()
+
+            def update_one(self, document):
+                bulk.operations.append(("update", spec, document))
+        return _()
+
+    def execute(self):
+        self.collection.bulks.append(self)
+        details = dict(
+            nInserted=0, nMatched=0, nModified=0, nUpserted=0,
+            writeErrors=[]
+        )
+        ids = set(d["_id"] for d in self.collection.documents)
+        for index, operation in enumerate(self.operations):
+            if operation[0] == "insert" and operation[1]["_id"] in ids:
+                details["writeErrors"].append(
+                    dict(index=index, code=11000, errmsg="duplicate key")
+                )
+                if self.ordered:
+                    break
+            elif operation[0] == "insert":
+                ids.add(operation[1]["_id"])
+                details["nInserted"] += 1
+            elif operation[0] == "upsert" and operation[1] in (
+                self.collection.rejected
+            ):
+                details["writeErrors"].append(
+                    dict(index=index, code=2, errmsg="rejected")
+                )
+                if self.ordered:
+                    break
+            elif operation[0] == "upsert":
+                if any(
+                    _match(d, operation[1]) for d in self.collection.documents
+                ):
+                    details["nMatched"] += 1
+                    details["nModified"] += 1
+                else:
+                    details["nUpserted"] += 1
+            elif operation[1]["_id"] in self.collection.missing:
+                details["writeErrors"].append(
+                    dict(index=index, code=1, errmsg="missing")
+                )
+                if self.ordered:
+                    break
+            else:
+                details["nMatched"] += 1
+                details["nModified"] += 1
+        if details["writeErrors"]:
+            raise BulkWriteError(details)
+        return details
+
+
+_OPERATORS = {
+    "$in": lambda value, operand: value in operand,
+    "$ne": lambda value, operand: value != operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+}
+
+
+def _get(document, key):
+    for k in key.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(k)
+    return document
+
+
+def _match(document, spec):
+    for key, value in spec.iteritems():
+        if key == "$or":
+            if not any(_match(document, s) for s in value):
+                return False
+        elif key == "$and":
+            if not all(_match(document, s) for s in value):
+                return False
+        elif isinstance(value, dict) and value and all(
+            k in _OPERATORS for k in value
+        ):
+            if not all(
+                _OPERATORS[k](_get(document, key), v)
+                for k, v in value.iteritems()
+            ):
+                return False
+        elif _get(document, key) != value:
+            return False
+    return True
+
+
+def _group(documents, group):
+    groups = dict()
+    for document in documents:
+        key = _get(document, group["_id"][1:]) if group["_id"] else None
+        result = groups.setdefault(key, dict(_id=key))
+        for name, accumulator in group.iteritems():
+            if name != "_id":
+                value = accumulator["$sum"]
+                if isinstance(value, basestring):
+                    value = _get(document, value[1:])
+                result[name] = result.get(name, 0) + value
+    return [groups[key] for key in sorted(groups)]
+
+
+def _unwind(documents, path):
+    key = path[1:]
+    return [
+        dict(document, **{key: value})
+        for document in documents for value in document.get(key) or []
+    ]
+
+
+_STAGES = {
+    "$match": lambda documents, spec: [
+        d for d in documents if _match(d, spec)
+    ],
+    "$sort": lambda documents, keys: sorted(
+        documents, key=lambda d: [
+            _get(d, k) if v == 1 else -_get(d, k) for k, v in keys.items()
+        ]
+    ),
+    "$limit": lambda documents, limit: documents[:limit],
+    "$project": lambda documents, projection: [
+        dict((k, _get(d, k)) for k in ["_id"] + projection.keys())
+        for d in documents
+    ],
+    "$group": _group,
+    "$unwind": _unwind,
+}
+
+
+class FakeCursor(object):
+    def __init__(self, documents, limit=0):
+        self.documents = documents
+        self.options = dict()
+        self.limit(limit)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.documents is not None:
+            self.iterator = iter([dict(d) for d in self.documents])
+            self.documents = None
+        return next(self.iterator)
+
+    def limit(self, limit):
+        if limit:
+            self.documents = self.documents[:abs(limit)]
+        return self
+
+    def count(self):
+        return len(self.documents)
+
+    def batch_size(self, size):
+        self.options["batch_size"] = size
+        return self
+
+    def max_time_ms(self, ms):
+        self.options["max_time_ms"] = ms
+        return self
+
+
+class FakeCollection(object):
+    def __init__(self):
+        self.bulks = []
+        self.missing = set()
+        self.rejected = []
+        self.documents = []
+        self.calls = []
+        self.indexes = []
+
+    def find(self, spec=None, skip=0, limit=0, sort=None, **kwargs):
+        kwargs.update(spec=spec, skip=skip, limit=limit, sort=sort)
+        self.calls.append(("find", kwargs))
+        documents = [
+            d for d in self.documents if _match(d, spec or dict())
+        ]
+        for key, direction in reversed(sort or []):
+            documents.sort(
+                key=lambda d: _get(d, key), reverse=direction == -1
+            )
+        return FakeCursor(documents[skip:], limit)
+
+    def aggregate(self, pipeline, **kwargs):
+        kwargs.update(pipeline=pipeline)
+        self.calls.append(("aggregate", kwargs))
+        documents = [dict(d) for d in self.documents]
+        for stage in pipeline:
+            (operator, value), = stage.items()
+            documents = _STAGES[operator](documents, value)
+        return FakeCursor(documents)
+
+    def update(self, **kwargs):
+        self.calls.append(("update", kwargs))
+
+    def remove(self, spec_or_id):
+        self.calls.append(("remove", dict(spec_or_id=spec_or_id)))
+        self.documents = [
+            d for d in self.documents if not _match(d, spec_or_id)
+        ]
+
+    def create_index(self, key_or_list, **kwargs):
+        self.indexes.append((key_or_list, kwargs))
+        return kwargs.get("name")
+
+    def initialize_ordered_bulk_op(self):
+        return FakeBulk(self, True)
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self, False)
+
+
+class FakeDatabase(dict):
+
+    def command(self, name, collection, **options):
+        collection = self[collection]
+        collection.calls.append((name, options))
+        documents = [
+            d for d in collection.documents
+            if _match(d, options.get("query") or dict())
+        ][options.get("skip", 0):]
+        if name == "count":
+            limit = options.get("limit")
+            return dict(n=len(documents[:limit] if limit else documents))
+        values = []
+        for document in documents:
+            value = _get(document, options["key"])
+            if value not in values:
+                values.append(value)
+        return dict(values=values)
+
+
+class FakeSession(Session):
+    """
+    session keeps the collections in memory, created with the same mapper
+    as create_session, eg: FakeSession(db=["TestModel"])
+    """
+    def __init__(self, **collection_mapper):
+        super(FakeSession, self).__init__(collection_mapper=collection_mapper)
+        self.collections = dict()
+        self.session = dict()
+        for db, collections in self.mapper.iteritems():
+            self.session[db] = FakeDatabase()
+            for collection in collections:
+                self.collections[collection] = FakeCollection()
+                self.session[db][collection] = self.collections[collection]
@@ -0,0 +1,132 @@
+# coding: utf8
+
+import unittest
+
+from bson.objectid import ObjectId
+
+from mongotoy.libs import session as session_module
+from mongotoy.libs.models import Model, SubModel
+from mongotoy.libs.fields import IntField, StrField, ListField, ModelField
+from mongotoy.libs.consts import DESCENDING
+from mongotoy.libs.operators import Gt
+from mongotoy.libs.queue import flush_queue
+
+from fakes import FakeSession
+
+
+class AggregateSubModel(SubModel):
+    name = StrField("")
+
+
+class AggregateModel(Model):
+    field1 = IntField(0)
+    field2 = ModelField(AggregateSubModel)
+    tags = ListField()
+
+
+class AggregateJoinModel(Model):
+    model_id = IntField(0)
+
+
+class TotalSubModel(SubModel):
+    _id = StrField("")
+    total = IntField(0)
+
+
+class TestAggregate(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["AggregateModel", "AggregateJoinModel"]
+        )
+        self.collection = self.session.collections["aggregate_model"]
+        self.collection.documents = [
+            dict(_id=ObjectId(), field1=i, tags=range(i),
+                 field2=dict(name=u"n%d" % (i % 2)))
+            for i in range(5)
+        ]
+
+    def tearDown(self):
+        session_module.session = self.origin
+        flush_queue.clear()
+
+    def test_group(self):
+        rows = AggregateModel.aggregate().match(Gt("field1", 0)).group(
+            "field2.name", total={"$sum": "$field1"}, count={"$sum": 1}
+        ).sort(total=DESCENDING).all()
+        self.assertEqual(rows, [
+            dict(_id=u"n0", total=6, count=2),
+            dict(_id=u"n1", total=4, count=2),
+        ])
+        name, kwargs = self.collection.calls[-1]
+        self.assertEqual(kwargs["pipeline"][0], {
+            "$match": {"field1": {"$gt": 0}}
+        })
+        self.assertEqual(kwargs["cursor"], {})
+
+    def test_options(self):
+        query = AggregateModel.aggregate().match(field1=1).allow_disk_use()
+        self.assertEqual(len(query.batch_size(2).all()), 1)
+        name, kwargs = self.collection.calls[-1]
+        self.assertEqual(kwargs["pipeline"], [{"$match": {"field1": 1}}])
+        self.assertEqual(kwargs["cursor"], dict(batchSize=2))
+        self.assertTrue(kwargs["allowDiskUse"])
+
+    def test_unwind_and_lookup(self):
+        query = AggregateModel.aggregate().unwind("tags").lookup(
+            AggregateJoinModel, "field1", "model_id", "joined"
+        ).match(joined=[])
+        self.assertEqual(query.pipeline[1], {"$lookup": {
+            "from": "aggregate_join_model", "localField": "field1",
+            "foreignField": "model_id", "as": "joined"
+        }})
+        self.assertEqual(query.pipeline[2], {"$match": {"joined": []}})
+        rows = AggregateModel.aggregate().unwind("tags").all()
+        self.assertEqual(
+            [row["tags"] for row in rows], [0, 0, 1, 0, 1, 2, 0, 1, 2, 3]
+        )
+        self.assertEqual(
+            AggregateModel.aggregate().unwind("tags", True).pipeline,
+            [{"$unwind": dict(path="$tags", preserveNullAndEmptyArrays=True)}]
+        )
+
+    def test_hydration(self):
+        models = AggregateModel.aggregate().sort(
+            field1=DESCENDING
+        ).limit(2).as_models().all()
+        self.assertEqual([m.field1 for m in models], [4, 3])
+        self.assertEqual(models[0].field2.name, u"n0")
+        models[0].field1 = 10
+        self.assertEqual(flush_queue.get_all(), set())
+        totals = AggregateModel.aggregate().group(
+            "field2.name", total={"$sum": "$field1"}
+        ).as_models(TotalSubModel).all()
+        self.assertEqual(
+            [(m._id, m.total) for m in totals], [(u"n0", 6), (u"n1", 4)]
+        )
+
+    def test_invalid_paths(self):
+        with self.assertRaises(KeyError):
+            AggregateModel.aggregate().match(missing=1)
+        with self.assertRaises(KeyError):
+            AggregateModel.aggregate().group("field2.missing")
+        with self.assertRaises(KeyError):
+            AggregateModel.aggregate().group(
+                None, total={"$sum": "$missing"}
+            )
+        with self.assertRaises(KeyError):
+            AggregateModel.aggregate().sort(missing=DESCENDING)
+        with self.assertRaises(KeyError):
+            AggregateModel.aggregate().lookup(
+                AggregateJoinModel, "field1", "missing", "joined"
+            )
+        AggregateModel.aggregate().project(
+            "field1", double={"$multiply": ["$field1", 2]}
+        ).sort(double=DESCENDING).group(
+            "$double", total={"$sum": "$$ROOT.double"}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
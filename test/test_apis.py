@@ -5,6 +5,7 @@ sys.path.append("/Users/zhuoliu/works/mongotoy")
 import unittest
 import datetime
 
+from bson.objectid import ObjectId
 #import mock
 
 from mongotoy.libs.models import Model, SubModel
@@ -14,6 +15,7 @@ from mongotoy.libs.fields import (
     FloatField, ListField, ModelField, DateTimeField
 )
 from mongotoy.libs.operators import And, Or, Gt, Lt, Type
+from mongotoy.libs.queue import flush_queue
 
 
 class TestModel(Model):
@@ -107,6 +109,317 @@ class TestModelApi(unittest.TestCase):
         pass
 
 
+class TestModelChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.model = TestModel(
+            __persistence__=True, _id=ObjectId(), field1=2.0,
+            field2=[1, 2], field3=dict(sub_field1="a", sub_field2=[{}])
+        )
+
+    def tearDown(self):
+        flush_queue.clear()
+
+    def test_loaded_model_is_clean(self):
+        self.assertEqual(self.model.compile_changes(), {})
+        self.assertFalse(flush_queue.exists(self.model))
+
+    def test_set_field(self):
+        self.model.field1 = 3
+        self.assertEqual(
+            self.model.compile_changes(), {"$set": {"field1": 3.0}}
+        )
+        self.assertTrue(flush_queue.exists(self.model))
+
+    def test_set_sub_field(self):
+        self.model.field3.sub_field1 = "b"
+        self.assertEqual(
+            self.model.compile_changes(), {"$set": {"field3.sub_field1": "b"}}
+        )
+        self.model.field3.sub_field2[0].sub_field1 = 5
+        self.assertEqual(
+            self.model.compile_changes(),
+            {"$set": {"field3.sub_field1": "b",
+                      "field3.sub_field2": [{"sub_field1": 5}]}}
+        )
+
+    def test_parent_path_wins(self):
+        self.model.field3.sub_field1 = "b"
+        self.model.field3 = dict(sub_field1="c")
+        self.assertEqual(
+            self.model.compile_changes(),
+            {"$set": {"field3": {"sub_field1": "c",
+                                 "sub_field2": [{"sub_field1": 10}]}}}
+        )
+
+    def test_push_and_unset(self):
+        self.model.field2.append(3)
+        self.model.field2.extend([4, 5])
+        del self.model.field4
+        self.assertEqual(
+            self.model.compile_changes(),
+            {"$push": {"field2": {"$each": [3, 4, 5]}},
+             "$unset": {"field4": ""}}
+        )
+        self.model.field2.reverse()
+        self.assertEqual(
+            self.model.compile_changes()["$set"], {"field2": [5, 4, 3, 2, 1]}
+        )
+
+    def test_fallback_to_full_set(self):
+        self.model.field1 = 3
+        self.model.field2 = [3]
+        self.model.field4 = datetime.datetime(2015, 1, 1)
+        command = self.model.to_dict()
+        del command["_id"]
+        self.assertEqual(self.model.compile_changes(), {"$set": command})
+
+    def test_clear_changes(self):
+        self.model.field1 = 3
+        self.model.clear_changes()
+        self.assertEqual(self.model.compile_changes(), {})
+
+
+class TestHydration(unittest.TestCase):
+
+    def test_from_bson(self):
+        _id = ObjectId()
+        document = dict(
+            _id=_id, field1=2, field2=[1, 2],
+            field3=dict(sub_field1=u"a", sub_field2=[{"sub_field1": 3}])
+        )
+        model = TestModel._from_bson(document)
+        self.assertEqual(
+            model.to_dict(),
+            TestModel(__persistence__=True, **document).to_dict()
+        )
+        self.assertEqual(model._id, _id)
+        self.assertIsInstance(model.field1, float)
+        self.assertIsInstance(model.field3.sub_field1, str)
+        self.assertEqual(model.field4, datetime.datetime(2014, 8, 4))
+        self.assertIs(model.field3.__lord__, model)
+        self.assertIs(model.field3.sub_field2[0].__lord__, model.field3)
+
+    def test_from_bson_is_clean(self):
+        model = TestModel._from_bson(dict(_id=ObjectId(), field2=[1]))
+        self.assertEqual(model.compile_changes(), {})
+        self.assertFalse(flush_queue.exists(model))
+        model.field2.append(2)
+        model.field3.sub_field1 = "b"
+        self.assertEqual(model.compile_changes(), {
+            "$push": {"field2": {"$each": [2]}},
+            "$set": {"field3.sub_field1": "b"}
+        })
+        flush_queue.clear()
+
+
+    def test_compiled(self):
+        document = dict(
+            _id=ObjectId(), field1=2, field2=[1, 2],
+            field3=dict(sub_field1=u"a", sub_field2=[{"sub_field1": 3}])
+        )
+        model = TestModel._from_bson(document)
+        self.assertIn("__hydrator__", TestModel.__dict__)
+        self.assertIsInstance(model.field3.sub_field2, list)
+        self.assertIs(model.field3.sub_field2[0].__lord__, model.field3)
+        self.assertEqual(model.field3.sub_field2.__fieldname__, "sub_field2")
+        self.assertEqual(model.to_dict(), model._to_dict())
+        self.assertIn("__serializer__", TestModel.__dict__)
+        self.assertEqual(model.to_dict()["field3"], dict(
+            sub_field1="a", sub_field2=[{"sub_field1": 3}]
+        ))
+        model.field3.sub_field2[0].sub_field1 = 4
+        self.assertEqual(
+            model.to_dict()["field3"]["sub_field2"], [{"sub_field1": 4}]
+        )
+        partial = TestModel._from_bson(
+            dict(_id=document["_id"], field3=dict(sub_field1=u"a")),
+            {"field3.sub_field1": 1}
+        )
+        self.assertEqual(partial.to_dict(), dict(
+            _id=str(document["_id"]), field3=dict(sub_field1="a")
+        ))
+        flush_queue.clear()
+
+
+class LazyModel(Model):
+    field1 = IntField(0)
+    field2 = ListModelField(TestModel.SubModel1, [], lazy=True)
+    field3 = ModelField(TestModel.SubModel1, lazy=True)
+
+
+class TestLazyField(unittest.TestCase):
+
+    def setUp(self):
+        self.document = dict(
+            _id=ObjectId(), field1=1,
+            field2=[dict(sub_field1="a"), dict(sub_field1="b")],
+            field3=dict(sub_field1="c", sub_field2=[]),
+        )
+        self.model = LazyModel._from_bson(self.document)
+
+    def tearDown(self):
+        flush_queue.clear()
+
+    def test_raw_until_access(self):
+        self.assertEqual(
+            sorted(self.model.__lazy__), ["field2", "field3"]
+        )
+        self.assertIs(
+            self.model.to_dict()["field2"], self.document["field2"]
+        )
+        self.assertEqual(self.model.field1, 1)
+        self.assertEqual(sorted(self.model.__lazy__), ["field2", "field3"])
+
+    def test_materialize(self):
+        self.assertEqual(
+            [m.sub_field1 for m in self.model.field2], ["a", "b"]
+        )
+        self.assertIsInstance(self.model.field2[0], TestModel.SubModel1)
+        self.assertEqual(self.model.field3.sub_field1, "c")
+        self.assertEqual(self.model.__lazy__, {})
+        self.model.field3.sub_field1 = "d"
+        self.assertEqual(
+            self.model.compile_changes(), {"$set": {"field3.sub_field1": "d"}}
+        )
+
+    def test_set_before_access(self):
+        self.model.field3 = dict(sub_field1="e")
+        self.assertEqual(self.model.to_dict()["field3"]["sub_field1"], "e")
+        self.assertEqual(self.model.field3.sub_field1, "e")
+
+
+class TestPartialModel(unittest.TestCase):
+
+    def tearDown(self):
+        flush_queue.clear()
+
+    def test_only(self):
+        model = TestModel._from_bson(
+            dict(_id=ObjectId(), field1=2.0, field3=dict(sub_field1="a")),
+            dict(field1=1, **{"field3.sub_field1": 1})
+        )
+        self.assertEqual(model.field1, 2.0)
+        self.assertEqual(model.field3.sub_field1, "a")
+        with self.assertRaises(AttributeError):
+            model.field2
+        with self.assertRaises(AttributeError):
+            model.field3.sub_field2
+        self.assertEqual(
+            sorted(model.to_dict()), ["_id", "field1", "field3"]
+        )
+        self.assertEqual(model.to_dict()["field3"], dict(sub_field1="a"))
+
+    def test_exclude(self):
+        model = TestModel._from_bson(
+            dict(_id=ObjectId(), field1=2.0), dict(field2=0, field4=0)
+        )
+        self.assertEqual(model.field3.sub_field1, "unknown")
+        with self.assertRaises(AttributeError):
+            model.field4
+
+    def test_flush_partial(self):
+        model = TestModel._from_bson(
+            dict(_id=ObjectId(), field1=2.0), dict(field1=1)
+        )
+        model.field1 = 3
+        model.field2 = [1]
+        self.assertEqual(model.field2, [1])
+        self.assertEqual(
+            model.compile_changes(), {"$set": {"field1": 3.0, "field2": [1]}}
+        )
+
+    def test_write_partial_submodel(self):
+        model = TestModel._from_bson(
+            dict(_id=ObjectId(), field3=dict(sub_field1="a")),
+            {"field3.sub_field1": 1}
+        )
+        model.field3.sub_field1 = "b"
+        self.assertEqual(
+            model.compile_changes(), {"$set": {"field3.sub_field1": "b"}}
+        )
+        model.field3 = model.field3
+        with self.assertRaises(ValueError):
+            model.compile_changes()
+
+    def test_query_projection(self):
+        query = TestModel.query().only("field1", "field3.sub_field1")
+        self.assertEqual(
+            query.get_commands()["fields"],
+            {"field1": 1, "field3.sub_field1": 1}
+        )
+        self.assertEqual(
+            TestModel.query().exclude("field2").get_commands()["fields"],
+            {"field2": 0}
+        )
+        with self.assertRaises(KeyError):
+            TestModel.query().only("field3.sub_field3")
+
+
+class SlotsModel(Model):
+    __use_slots__ = True
+
+    class SlotsSubModel(SubModel):
+        __use_slots__ = True
+        sub_field1 = StrField("unknown")
+
+    field1 = IntField(0)
+    field2 = ModelField(SlotsSubModel)
+    field3 = ListModelField(SlotsSubModel, [])
+    field4 = ModelField(SlotsSubModel, lazy=True)
+
+
+class TestFieldTable(unittest.TestCase):
+
+    def tearDown(self):
+        flush_queue.clear()
+
+    def test_table(self):
+        self.assertEqual(
+            TestModel.__fields__, ("field1", "field2", "field3", "field4")
+        )
+        self.assertEqual(
+            TestModel.__scalar_fields__, ("field1", "field2", "field4")
+        )
+        self.assertEqual(TestModel.__submodel_fields__, ("field3",))
+        self.assertEqual(
+            TestModel.SubModel1.__list_model_fields__, ("sub_field2",)
+        )
+        self.assertIn("field4", TestModel.__field_set__)
+        self.assertIs(TestModel.__field_table__["field1"], TestModel.field1)
+
+    def test_slots(self):
+        model = SlotsModel(field1=1)
+        self.assertFalse(hasattr(model, "__dict__"))
+        self.assertFalse(hasattr(model.field2, "__dict__"))
+        self.assertIsInstance(SlotsModel.field1, IntField)
+        self.assertIsInstance(SlotsModel._id, Field)
+        model.field2.sub_field1 = "a"
+        document = model.to_dict()
+        self.assertEqual(document["field2"], dict(sub_field1="a"))
+        self.assertEqual(document["field4"], dict(sub_field1="unknown"))
+        self.assertEqual(document["field1"], 1)
+
+    def test_slots_from_bson(self):
+        document = dict(
+            _id=ObjectId(), field1=2, field2=dict(sub_field1="b"),
+            field3=[dict(sub_field1="c")], field4=dict(sub_field1="d")
+        )
+        model = SlotsModel._from_bson(document)
+        self.assertEqual(model.__lazy__, dict(field4=document["field4"]))
+        self.assertEqual(model.compile_changes(), {})
+        self.assertEqual(model.field4.sub_field1, "d")
+        model.field3[0].sub_field1 = "e"
+        self.assertEqual(model.compile_changes(), {
+            "$set": {"field3": [dict(sub_field1="e")]}
+        })
+        partial = SlotsModel._from_bson(
+            dict(_id=ObjectId(), field1=1), dict(field1=1)
+        )
+        with self.assertRaises(AttributeError):
+            partial.field2
+
+
 class TestQuery(unittest.TestCase):
     def test_query_get_command(self):
         query = Query(TestModel, spec=dict(field1=2), sort=dict(field1=1), filter=["field3"])
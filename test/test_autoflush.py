@@ -0,0 +1,131 @@
+# coding: utf8
+
+import time
+import threading
+import unittest
+
+from bson.objectid import ObjectId
+
+from mongotoy.libs import session as session_module
+from mongotoy.libs.models import Model
+from mongotoy.libs.fields import IntField
+from mongotoy.libs.queue import flush_queue
+from mongotoy.libs.session import flush
+from mongotoy.libs.autoflush import AutoFlusher
+
+from fakes import FakeSession
+
+
+class FlushedModel(Model):
+    field1 = IntField(0)
+
+
+def _wait(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.005)
+    return predicate()
+
+
+class TestAutoFlusher(unittest.TestCase):
+
+    def setUp(self):
+        flush_queue.clear()
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["FlushedModel"]
+        )
+        self.collection = self.session.collections["flushed_model"]
+        self.flusher = None
+
+    def tearDown(self):
+        if self.flusher is not None:
+            self.flusher.stop(drain=False)
+        flush_queue.clear()
+        session_module.session = self.origin
+
+    def _load(self):
+        return FlushedModel(__persistence__=True, _id=ObjectId())
+
+    def test_flush_pending(self):
+        self.flusher = AutoFlusher(max_pending=2, interval=60000).start()
+        models = [self._load() for i in range(2)]
+        models[0].field1 = 1
+        time.sleep(0.05)
+        self.assertEqual(self.flusher.stats()["flushes"], 0)
+        models[1].field1 = 1
+        self.assertTrue(_wait(lambda: self.flusher.stats()["flushes"] == 1))
+        stats = self.flusher.stats()
+        self.assertEqual(stats["models"], 2)
+        self.assertEqual(stats["last_size"], 2)
+        self.assertEqual(stats["pending"], 0)
+        self.assertEqual(len(self.collection.bulks[0].operations), 2)
+
+    def test_flush_interval(self):
+        self.flusher = AutoFlusher(max_pending=100, interval=20).start()
+        model = self._load()
+        model.field1 = 1
+        self.assertTrue(_wait(lambda: not len(flush_queue)))
+        self.assertEqual(model.compile_changes(), {})
+
+    def test_stop_drain(self):
+        self.flusher = AutoFlusher(max_pending=100, interval=60000).start()
+        FlushedModel(field1=1)
+        self.flusher.stop()
+        self.assertEqual(len(flush_queue), 0)
+        self.assertEqual(self.collection.bulks[0].operations[0][0], "insert")
+        self.assertEqual(self.flusher.stats()["flushes"], 1)
+
+    def test_stop_without_drain(self):
+        self.flusher = AutoFlusher(max_pending=100, interval=60000).start()
+        FlushedModel(field1=1)
+        self.flusher.stop(drain=False)
+        self.assertEqual(len(flush_queue), 1)
+        self.assertEqual(self.collection.bulks, [])
+
+    def test_backpressure(self):
+        release = threading.Event()
+        execute = self.collection.initialize_ordered_bulk_op
+
+        def _():
+            bulk = execute()
+            origin = bulk.execute
+
+            def blocked():
+                release.wait()
+                return origin()
+            bulk.execute = blocked
+            return bulk
+        self.collection.initialize_ordered_bulk_op = _
+        self.flusher = AutoFlusher(
+            max_pending=1, interval=60000, max_queued=1
+        ).start()
+        done = []
+
+        def produce():
+            self._load().field1 = 1
+            done.append(True)
+        thread = threading.Thread(target=produce)
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(done, [])
+        release.set()
+        thread.join(2)
+        self.assertEqual(done, [True])
+
+    def test_changes_during_flush(self):
+        model = self._load()
+        model.field1 = 1
+        changes = model.take_changes()
+        model.field1 = 2
+        model.restore_changes(changes)
+        self.assertEqual(model.compile_changes(), {"$set": {"field1": 2}})
+        flush()
+        self.assertEqual(model.compile_changes(), {})
+
+    def test_max_queued(self):
+        self.assertRaises(ValueError, AutoFlusher, 10, 1000, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
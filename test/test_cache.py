@@ -0,0 +1,139 @@
+# coding: utf8
+
+import time
+import unittest
+
+from mongotoy.libs import session as session_module
+from mongotoy.libs.cache import LRUCache, BaseCache, invalidate
+from mongotoy.libs.models import Model
+from mongotoy.libs.fields import IntField
+from mongotoy.libs.queue import flush_queue
+from mongotoy.libs.session import flush
+
+from bson.objectid import ObjectId
+from fakes import FakeSession
+
+
+class CacheModel(Model):
+    __cache__ = LRUCache(max_entries=2)
+
+    field1 = IntField(0)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(
+            cache.stats(), dict(hits=2, misses=1, evictions=1, entries=2)
+        )
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_interface(self):
+        with self.assertRaises(NotImplementedError):
+            BaseCache().get("a")
+
+
+class TestModelCache(unittest.TestCase):
+
+    def setUp(self):
+        CacheModel.__cache__.clear()
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["CacheModel"]
+        )
+        self.collection = self.session.collections["cache_model"]
+        self.collection.documents = [
+            dict(_id=ObjectId(), field1=i) for i in range(3)
+        ]
+        self._id = self.collection.documents[0]["_id"]
+
+    def tearDown(self):
+        session_module.session = self.origin
+        flush_queue.clear()
+
+    def test_get_cached(self):
+        self.assertEqual(CacheModel.get(self._id).field1, 0)
+        self.session.identity_map.clear()
+        model = CacheModel.get(self._id)
+        self.assertEqual(model.field1, 0)
+        self.assertEqual(len(self.collection.calls), 1)
+        self.assertEqual(CacheModel.__cache__.stats()["hits"], 1)
+        model.field1 = 5
+        self.assertEqual(
+            CacheModel.__cache__.get("cache_model:%s" % self._id)["field1"], 0
+        )
+
+    def test_get_many_cached(self):
+        ids = [d["_id"] for d in self.collection.documents]
+        CacheModel.get_many(ids[:2])
+        self.session.identity_map.clear()
+        models = CacheModel.get_many(ids[:2])
+        self.assertEqual([m.field1 for m in models], [0, 1])
+        self.assertEqual(len(self.collection.calls), 1)
+
+    def test_get_by_not_cached(self):
+        CacheModel.get_by(field1=0)
+        self.assertEqual(len(CacheModel.__cache__), 0)
+
+    def test_invalidate(self):
+        CacheModel.get(self._id)
+        invalidate(CacheModel, {"_id": {"$in": [self._id]}})
+        self.assertEqual(len(CacheModel.__cache__), 0)
+        CacheModel.get(self.collection.documents[1]["_id"])
+        invalidate(CacheModel, {"field1": 1})
+        self.assertEqual(len(CacheModel.__cache__), 0)
+
+    def _read_during(self, write):
+        """
+        get the document while the write is sent, as a concurrent reader
+        """
+        def _(*args, **kwargs):
+            CacheModel.get(self._id)
+            return write(*args, **kwargs)
+        return _
+
+    def test_invalidate_after_write(self):
+        self.collection.update = self._read_during(self.collection.update)
+        CacheModel.query(_id=self._id).update(field1=3)
+        self.assertEqual(len(CacheModel.__cache__), 0)
+        self.collection.remove = self._read_during(self.collection.remove)
+        CacheModel.query(field1=0).delete()
+        self.assertEqual(len(CacheModel.__cache__), 0)
+        model = CacheModel.get(self.collection.documents[0]["_id"])
+        self._id = model._id
+        model.delete()
+        self.assertEqual(len(CacheModel.__cache__), 0)
+
+    def test_upsert_invalidate_after_write(self):
+        bulk_op = self.collection.initialize_unordered_bulk_op
+
+        def _():
+            bulk = bulk_op()
+            bulk.execute = self._read_during(bulk.execute)
+            return bulk
+        self.collection.initialize_unordered_bulk_op = _
+        CacheModel.upsert_many([dict(field1=0)], key=("field1",))
+        self.assertEqual(len(CacheModel.__cache__), 0)
+
+    def test_flush_invalidate(self):
+        model = CacheModel.get(self._id)
+        model.field1 = 3
+        flush()
+        self.assertEqual(len(CacheModel.__cache__), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
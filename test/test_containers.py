@@ -0,0 +1,84 @@
+# coding: utf8
+
+import unittest
+
+from mongotoy.libs.containers import ToyList, ToySet
+
+
+class Lord(object):
+    def __init__(self):
+        self.changes = []
+
+    def _mark_changed(self, path, op="$set", values=None):
+        self.changes.append((path, op, values))
+
+
+class TestToyList(unittest.TestCase):
+
+    def setUp(self):
+        self.lord = Lord()
+        self.l = ToyList(self.lord, [3, 1, 2], "field")
+
+    def test_push(self):
+        self.l.append(4)
+        self.l.extend([5, 6])
+        self.l += [7]
+        self.assertEqual(self.l, [3, 1, 2, 4, 5, 6, 7])
+        self.assertEqual(self.lord.changes, [
+            ("field", "$push", [4]), ("field", "$push", [5, 6]),
+            ("field", "$push", [7])
+        ])
+
+    def test_extend_nothing(self):
+        self.l.extend([])
+        self.assertEqual(self.lord.changes, [])
+
+    def test_mutators(self):
+        self.l[0] = 0
+        self.l[0:1] = [3]
+        del self.l[0]
+        self.l.insert(0, 3)
+        self.l.pop()
+        self.l.remove(3)
+        self.l.sort()
+        self.l.reverse()
+        self.l *= 2
+        self.assertEqual(self.l, [1, 1])
+        self.assertEqual(self.lord.changes, [("field", "$set", None)] * 9)
+
+    def test_class_lord(self):
+        l = ToyList(Lord, [], "field")
+        l.append(1)
+        self.assertEqual(l, [1])
+
+
+class TestToySet(unittest.TestCase):
+
+    def setUp(self):
+        self.lord = Lord()
+        self.s = ToySet(self.lord, [1, 2, 3], "field")
+
+    def test_unchanged(self):
+        self.s.add(1)
+        self.s.discard(4)
+        self.s.update([2, 3])
+        self.s.difference_update([5])
+        self.s |= set([1])
+        self.s -= set([6])
+        self.s &= set([1, 2, 3])
+        self.assertEqual(self.s, set([1, 2, 3]))
+        self.assertEqual(self.lord.changes, [])
+
+    def test_mutators(self):
+        self.s.add(4)
+        self.s.discard(4)
+        self.s.remove(3)
+        self.s.difference_update([2])
+        self.s |= set([5])
+        self.s ^= set([1, 6])
+        self.assertEqual(self.s, set([5, 6]))
+        self.assertEqual(self.lord.changes, [("field", "$set", None)] * 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+# coding: utf8
+
+import time
+import logging
+import threading
+import unittest
+
+from bson.objectid import ObjectId
+
+from mongotoy.libs import session as session_module
+from mongotoy.libs.executor import Executor, FutureTimeout
+from mongotoy.libs.models import Model
+from mongotoy.libs.fields import IntField
+from mongotoy.libs.queue import flush_queue
+from mongotoy.libs.session import (
+    start_executor, submit, aflush, unit_of_work
+)
+
+from fakes import FakeSession
+
+
+class AsyncModel(Model):
+    field1 = IntField(0)
+
+
+class TestExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = Executor(workers=2, max_in_flight=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_result(self):
+        future = self.executor.submit(lambda a, b=0: a + b, 1, b=2)
+        self.assertEqual(future.result(1), 3)
+        self.assertTrue(future.done())
+        done = []
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future])
+
+    def test_exception(self):
+        future = self.executor.submit(int, "a")
+        self.assertIsInstance(future.exception(1), ValueError)
+        with self.assertRaises(ValueError):
+            future.result(1)
+
+    def test_callback_exception(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger("mongotoy")
+        logger.addHandler(handler)
+        try:
+            executor = Executor(workers=1, max_in_flight=1)
+            event = threading.Event()
+            future = executor.submit(event.wait)
+            done = []
+            future.add_done_callback(lambda future: 1 / 0)
+            future.add_done_callback(done.append)
+            event.set()
+            self.assertEqual(executor.submit(int, "1").result(1), 1)
+            self.assertEqual(done, [future])
+            future.add_done_callback(lambda future: 1 / 0)
+            executor.shutdown()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(records), 2)
+        self.assertIs(records[0].exc_info[0], ZeroDivisionError)
+
+    def test_max_in_flight(self):
+        event = threading.Event()
+        futures = [self.executor.submit(event.wait) for i in range(2)]
+        submitted = []
+        thread = threading.Thread(
+            target=lambda: submitted.append(self.executor.submit(int, "1"))
+        )
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(submitted, [])
+        with self.assertRaises(FutureTimeout):
+            futures[0].result(0.01)
+        event.set()
+        thread.join(1)
+        self.assertEqual(submitted[0].result(1), 1)
+
+
+class TestAsyncSession(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["AsyncModel"]
+        )
+        self.collection = self.session.collections["async_model"]
+        self.collection.documents = [dict(_id=ObjectId(), field1=1)]
+        start_executor(workers=2)
+
+    def tearDown(self):
+        session_module.executor.shutdown()
+        session_module.executor = None
+        session_module.session = self.origin
+        flush_queue.clear()
+
+    def test_aget(self):
+        _id = self.collection.documents[0]["_id"]
+        self.assertEqual(AsyncModel.aget(_id).result(1).field1, 1)
+        models = AsyncModel.query().aall().result(1)
+        self.assertEqual([m.field1 for m in models], [1])
+
+    def test_aflush(self):
+        AsyncModel(field1=2)
+        result = aflush().result(1)
+        self.assertEqual(result["async_model"]["nInserted"], 1)
+
+    def test_unit_of_work(self):
+        with unit_of_work() as uow:
+            AsyncModel(field1=2)
+            self.assertEqual(len(uow.queue.get_all()), 1)
+            result = aflush().result(1)
+        self.assertEqual(result["async_model"]["nInserted"], 1)
+        self.assertEqual(uow.queue.get_all(), set())
+
+    def test_unit_of_work_changed_during_aflush(self):
+        writing, written = threading.Event(), threading.Event()
+        bulk_op = self.collection.initialize_ordered_bulk_op
+
+        def _():
+            bulk = bulk_op()
+            execute = bulk.execute
+
+            def slow():
+                writing.set()
+                written.wait(1)
+                return execute()
+            bulk.execute = slow
+            return bulk
+        self.collection.initialize_ordered_bulk_op = _
+        with unit_of_work() as uow:
+            first = AsyncModel(field1=2)
+            future = aflush()
+            writing.wait(1)
+            second = AsyncModel(field1=3)
+            written.set()
+            result = future.result(1)
+            self.assertEqual(result["async_model"]["nInserted"], 1)
+            self.assertTrue(first._id)
+            self.assertEqual(uow.queue.get_all(), set([second]))
+            result = uow.flush()
+        self.assertEqual(result["async_model"]["nInserted"], 1)
+        self.assertTrue(second._id)
+        self.assertEqual(uow.queue.get_all(), set())
+
+    def test_not_created(self):
+        session_module.executor.shutdown()
+        session_module.executor = None
+        with self.assertRaises(ValueError):
+            submit(int, "1")
+        start_executor(workers=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+# coding: utf8
+
+import unittest
+import warnings
+
+from mongotoy.libs import session as session_module
+from mongotoy.libs.models import Model, SubModel
+from mongotoy.libs.fields import IntField, StrField, ModelField
+from mongotoy.libs.consts import ASCENDING, DESCENDING
+from mongotoy.libs.operators import Gt, Or, Exists
+from mongotoy.libs.indexes import (
+    Index, UnindexedQueryWarning, set_index_check, WARN, RAISE
+)
+from mongotoy.libs.queue import flush_queue
+
+from fakes import FakeSession
+
+
+class IndexedSubModel(SubModel):
+    name = StrField("")
+
+
+class IndexedModel(Model):
+    __indexes__ = [
+        "field1",
+        Index([("field2", ASCENDING), ("field3.name", DESCENDING)],
+              unique=True),
+        Index("created", expire_after_seconds=3600),
+        Index("field2", partial={"field2": {"$gt": 0}}, name="partial"),
+    ]
+    field1 = IntField(0)
+    field2 = IntField(0)
+    field3 = ModelField(IndexedSubModel)
+    created = IntField(0)
+
+
+class TestDeclaration(unittest.TestCase):
+
+    def test_compiled(self):
+        indexes = IndexedModel.__indexes__
+        self.assertEqual(indexes[0].keys, [("field1", ASCENDING)])
+        self.assertEqual(indexes[1].name, "field2_1_field3.name_-1")
+        self.assertEqual(indexes[2].options(), dict(
+            key_or_list=[("created", ASCENDING)], name="created_1",
+            expireAfterSeconds=3600
+        ))
+        self.assertEqual(indexes[3].options()["partialFilterExpression"], {
+            "field2": {"$gt": 0}
+        })
+
+    def test_invalid(self):
+        declarations = [
+            (KeyError, ["missing"]),
+            (KeyError, ["field3.missing"]),
+            (ValueError, [Index(["field1", "field1"])]),
+            (ValueError, [Index(["field1", "field2"],
+                                expire_after_seconds=10)]),
+            (ValueError, [Index("field1", sparse=True, partial={"a": 1})]),
+            (ValueError, [Index([("field1", 2)])]),
+        ]
+        for error, indexes in declarations:
+            with self.assertRaises(error):
+                type("InvalidModel", (Model, ), dict(
+                    __indexes__=indexes, field1=IntField(0),
+                    field2=IntField(0), field3=ModelField(IndexedSubModel)
+                ))
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["IndexedModel"]
+        )
+        self.collection = self.session.collections["indexed_model"]
+
+    def tearDown(self):
+        session_module.session = self.origin
+        set_index_check(None)
+        flush_queue.clear()
+
+    def test_ensure_indexes(self):
+        self.assertEqual(session_module.ensure_indexes(), dict(
+            indexed_model=[
+                "field1_1", "field2_1_field3.name_-1", "created_1", "partial"
+            ]
+        ))
+        key, options = self.collection.indexes[1]
+        self.assertEqual(key, [("field2", ASCENDING), ("field3.name", -1)])
+        self.assertEqual(options["unique"], True)
+        self.assertEqual(len(IndexedModel.ensure_indexes()), 4)
+
+    def test_unknown_model(self):
+        session = FakeSession(db=["UndefinedModel"])
+        with self.assertRaises(ValueError):
+            session.ensure_indexes()
+
+    def assertCovered(self, query, covered=True):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            query.all()
+        self.assertEqual(
+            [w.category for w in caught],
+            [] if covered else [UnindexedQueryWarning]
+        )
+
+    def test_check(self):
+        set_index_check(WARN)
+        self.assertCovered(IndexedModel.query())
+        self.assertCovered(IndexedModel.query(field1=1, created=2))
+        self.assertCovered(IndexedModel.query(Gt("field1", 1)))
+        self.assertCovered(IndexedModel.query(field3=None), False)
+        self.assertCovered(IndexedModel.query().sort(field1=DESCENDING))
+        self.assertCovered(IndexedModel.query().sort(_id=DESCENDING))
+        self.assertCovered(
+            IndexedModel.query().sort(("field1", 1), ("created", 1)), False
+        )
+        self.assertCovered(
+            IndexedModel.query(field2=1).sort(("field3.name", ASCENDING))
+        )
+        self.assertCovered(
+            IndexedModel.query(Gt("field2", 1)).sort(
+                ("field3.name", ASCENDING)
+            ), False
+        )
+        self.assertCovered(IndexedModel.query(
+            Or(Gt("field1", 1), Gt("created", 1))
+        ))
+        self.assertCovered(IndexedModel.query(
+            Or(Gt("field1", 1), Exists("field3", True))
+        ), False)
+
+    def test_raise(self):
+        set_index_check(RAISE)
+        with self.assertRaises(ValueError):
+            IndexedModel.query(field3=None).all()
+        with self.assertRaises(ValueError):
+            IndexedModel.query(field3=None).delete()
+        IndexedModel.get_by(field1=1)
+        with self.assertRaises(ValueError):
+            set_index_check("fail")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+# coding: utf8
+
+import logging
+import unittest
+
+from bson import BSON
+from bson.objectid import ObjectId
+
+from mongotoy.libs import session as session_module
+from mongotoy.libs.models import Model
+from mongotoy.libs.fields import IntField
+from mongotoy.libs.operators import Gt, In, Or
+from mongotoy.libs.queue import flush_queue
+from mongotoy.libs.session import flush
+from mongotoy.libs.instrument import (
+    add_listener, remove_listener, redact, listeners, TracedCursor,
+    SlowOperationLogger, MetricsRegistry
+)
+
+from fakes import FakeSession
+
+
+class InstrumentModel(Model):
+    field1 = IntField(0)
+
+
+class _Handler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestInstrument(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["InstrumentModel"]
+        )
+        self.collection = self.session.collections["instrument_model"]
+        self.collection.documents = [
+            dict(_id=ObjectId(), field1=i) for i in range(3)
+        ]
+        self.events = []
+        self.listener = self.events.append
+        add_listener(self.listener)
+
+    def tearDown(self):
+        for listener in list(listeners):
+            remove_listener(listener)
+        session_module.session = self.origin
+        flush_queue.clear()
+
+    def test_no_listener(self):
+        remove_listener(self.listener)
+        cursor = self.session.execute("instrument_model", "find", dict())
+        self.assertNotIsInstance(cursor, TracedCursor)
+        InstrumentModel.query().all()
+        self.assertEqual(self.events, [])
+
+    def test_query(self):
+        models = InstrumentModel.query(Gt("field1", 0)).all()
+        kinds = [event["kind"] for event in self.events]
+        self.assertEqual(kinds, ["hydrate", "hydrate", "execute"])
+        event = self.events[-1]
+        self.assertEqual(event["collection"], "instrument_model")
+        self.assertEqual(event["operation"], "find")
+        self.assertEqual(event["spec"], {"field1": {"$gt": "?"}})
+        self.assertEqual(event["documents"], 2)
+        self.assertIsNone(event["bytes"])
+        self.assertIsNone(event["error"])
+        self.assertGreaterEqual(event["duration"], 0)
+        self.assertEqual(len(models), 2)
+
+    def test_get_and_count(self):
+        InstrumentModel.get(self.collection.documents[0]["_id"])
+        self.assertEqual(
+            [(e["operation"], e["documents"]) for e in self.events],
+            [("hydrate", 1), ("find", 1)]
+        )
+        self.events[:] = []
+        InstrumentModel.query(field1=1).count(fast=True)
+        self.assertEqual(self.events[0]["operation"], "count")
+        self.assertEqual(self.events[0]["spec"], {"field1": "?"})
+
+    def test_bytes(self):
+        metrics = MetricsRegistry(measure_bytes=True)
+        add_listener(metrics)
+        InstrumentModel.query().as_dicts().all()
+        self.assertEqual(self.events[-1]["bytes"], sum(
+            len(BSON.encode(document))
+            for document in self.collection.documents
+        ))
+        remove_listener(metrics)
+        InstrumentModel.query().as_dicts().all()
+        self.assertIsNone(self.events[-1]["bytes"])
+
+    def test_flush(self):
+        InstrumentModel(field1=5)
+        flush()
+        self.assertEqual(
+            [(e["kind"], e["operation"], e["documents"]) for e in self.events],
+            [("execute", "bulk_write", 1), ("flush", "flush", 1)]
+        )
+
+    def test_error(self):
+        def _find(**kwargs):
+            raise ValueError("find failed")
+        self.collection.find = _find
+        with self.assertRaises(ValueError):
+            InstrumentModel.query().all()
+        self.assertEqual(len(self.events), 1)
+        self.assertIsInstance(self.events[0]["error"], ValueError)
+
+    def test_listener_error(self):
+        def _fail(event):
+            raise RuntimeError()
+        add_listener(_fail)
+        logging.getLogger("mongotoy").disabled = True
+        try:
+            self.assertEqual(len(InstrumentModel.query().all()), 3)
+        finally:
+            logging.getLogger("mongotoy").disabled = False
+        self.assertEqual(len(self.events), 4)
+
+    def test_redact(self):
+        spec = Or(In("field1", [1, 2]), Gt("field1", 5)).compile()
+        self.assertEqual(redact(spec), {"$or": [
+            {"field1": {"$in": "?"}}, {"field1": {"$gt": "?"}}
+        ]})
+        self.assertEqual(redact([{"$match": {"a": 1}}]), [
+            {"$match": {"a": "?"}}
+        ])
+
+    def test_slow_logger(self):
+        logger = logging.getLogger("mongotoy.test_slow")
+        handler = _Handler()
+        logger.addHandler(handler)
+        add_listener(SlowOperationLogger(threshold=0, logger=logger))
+        add_listener(SlowOperationLogger(threshold=10000, logger=logger))
+        InstrumentModel.query(field1=1).as_dicts().all()
+        self.assertEqual(len(handler.messages), 1)
+        self.assertTrue(handler.messages[0].startswith(
+            "slow execute instrument_model.find"
+        ))
+        self.assertIn("spec={'field1': '?'}", handler.messages[0])
+
+    def test_metrics(self):
+        metrics = MetricsRegistry(buckets=(10000, ))
+        add_listener(metrics)
+        InstrumentModel.query().all()
+        InstrumentModel.query().as_dicts().all()
+        snapshot = metrics.snapshot()
+        find = snapshot[("execute", "instrument_model", "find")]
+        self.assertEqual(find["count"], 2)
+        self.assertEqual(find["documents"], 6)
+        self.assertEqual(find["histogram"], [2, 0])
+        self.assertEqual(
+            snapshot[("hydrate", "instrument_model", "hydrate")]["count"], 3
+        )
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
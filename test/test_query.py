@@ -0,0 +1,408 @@
+# coding: utf8
+
+import gc
+import unittest
+
+from bson.objectid import ObjectId
+
+from mongotoy.libs import session as session_module
+from mongotoy.libs.models import Model, SubModel
+from mongotoy.libs.fields import IntField, StrField, ModelField
+from mongotoy.libs.consts import ASCENDING, DESCENDING
+from mongotoy.libs.operators import Gt, Param
+from mongotoy.libs.queue import flush_queue
+
+from fakes import FakeSession
+
+
+class QueryModel(Model):
+
+    class Sub(SubModel):
+        name = StrField("")
+
+    field1 = IntField(0)
+    field2 = ModelField(Sub)
+
+
+class BaseTestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["QueryModel"]
+        )
+        self.collection = self.session.collections["query_model"]
+        self.collection.documents = [
+            dict(_id=ObjectId(), field1=i, field2=dict(name=u"n%d" % i))
+            for i in range(5)
+        ]
+
+    def tearDown(self):
+        session_module.session = self.origin
+        flush_queue.clear()
+
+
+class TestResultModes(BaseTestQuery):
+
+    def test_models(self):
+        models = QueryModel.query().all()
+        self.assertEqual([m.field1 for m in models], range(5))
+        self.assertIsInstance(models[0], QueryModel)
+
+    def test_as_dicts(self):
+        documents = QueryModel.query().skip(1).limit(2).as_dicts().all()
+        self.assertEqual(documents, self.collection.documents[1:3])
+
+    def test_values_list(self):
+        query = QueryModel.query().sort(field1=DESCENDING).values_list(
+            "field1", "field2.name"
+        )
+        self.assertEqual(list(query)[:2], [(4, u"n4"), (3, u"n3")])
+        kwargs = self.collection.calls[-1][1]
+        self.assertEqual(kwargs["fields"], {"field1": 1, "field2.name": 1})
+        self.assertEqual(kwargs["sort"], [("field1", DESCENDING)])
+
+    def test_scalar(self):
+        ids = list(QueryModel.query().scalar("_id"))
+        self.assertEqual(ids, [d["_id"] for d in self.collection.documents])
+        self.assertEqual(flush_queue.get_all(), set())
+
+
+class TestIdentityMap(BaseTestQuery):
+
+    def setUp(self):
+        super(TestIdentityMap, self).setUp()
+        session_module.use_identity_map()
+
+    def test_disabled_by_default(self):
+        session_module.use_identity_map(False)
+        _id = self.collection.documents[2]["_id"]
+        self.assertIsNot(QueryModel.get(_id), QueryModel.get(_id))
+        self.assertEqual(len(self.collection.calls), 2)
+
+    def test_get_without_round_trip(self):
+        _id = self.collection.documents[2]["_id"]
+        model = QueryModel.get(_id)
+        self.assertEqual(model.field1, 2)
+        self.assertIs(QueryModel.get(str(_id)), model)
+        self.assertEqual(len(self.collection.calls), 1)
+
+    def test_query_reuse_instance(self):
+        model = QueryModel.get_by(field1=1)
+        model.field1 = 10
+        models = QueryModel.query().all()
+        self.assertIs(models[1], model)
+        self.assertEqual(models[1].field1, 10)
+        self.assertIs(QueryModel.get_by(field1=1), model)
+
+    def test_partial_completed(self):
+        model = QueryModel.query().only("field1").all()[0]
+        self.assertIs(QueryModel.get(model._id), model)
+        self.assertFalse(model.__partial__)
+        self.assertEqual(model.field2.name, "n0")
+        model = QueryModel.query().only("field1").all()[1]
+        model.field1 = 10
+        self.assertIsNot(QueryModel.get(model._id), model)
+
+    def test_weak_reference(self):
+        _id = QueryModel.get_by(field1=1)._id
+        gc.collect()
+        self.assertIsNone(
+            self.session.identity_map.get("query_model", _id)
+        )
+
+    def test_query_refresh_instance(self):
+        model = QueryModel.get_by(field1=1)
+        self.collection.documents[1]["field2"] = dict(name=u"changed")
+        self.assertIs(QueryModel.query().all()[1], model)
+        self.assertEqual(model.field2.name, "changed")
+        model.field2.name = "local"
+        self.assertEqual(model.__changes__.keys(), ["field2.name"])
+        self.collection.documents[1]["field1"] = 10
+        self.assertIs(QueryModel.get_by(field1=10), model)
+        self.assertEqual(model.field1, 1)
+        self.assertEqual(model.field2.name, "local")
+
+    def test_partial_query_refresh_projected_fields(self):
+        model = QueryModel.get_by(field1=1)
+        self.collection.documents[1]["field1"] = 10
+        self.collection.documents[1]["field2"] = dict(name=u"changed")
+        QueryModel.query().only("field1").all()
+        self.assertEqual(model.field1, 10)
+        self.assertEqual(model.field2.name, "n1")
+        self.assertFalse(model.__partial__)
+
+    def test_expire_on_update(self):
+        _id = self.collection.documents[1]["_id"]
+        model = QueryModel.get(_id)
+        QueryModel.query(_id=_id).update(field1=10)
+        self.collection.documents[1]["field1"] = 10
+        self.assertIs(QueryModel.get(_id), model)
+        self.assertEqual(model.field1, 10)
+        self.assertEqual(len(self.collection.calls), 3)
+        self.assertIs(QueryModel.get(_id), model)
+        self.assertEqual(len(self.collection.calls), 3)
+
+    def test_expire_on_delete(self):
+        model = QueryModel.get_by(field1=1)
+        QueryModel.query(field1=1).delete()
+        self.assertIsNone(QueryModel.get(model._id))
+
+    def test_refresh(self):
+        model = QueryModel.get_by(field1=1)
+        model.field1 = 5
+        self.collection.documents[1]["field2"] = dict(name=u"changed")
+        self.assertIs(model.refresh(), model)
+        self.assertEqual(model.field1, 1)
+        self.assertEqual(model.field2.name, "changed")
+        self.assertEqual(model.__changes__, dict())
+        self.assertEqual(flush_queue.get_all(), set())
+        model.field2.name = "again"
+        self.assertEqual(flush_queue.get_all(), set([model]))
+        del self.collection.documents[1]
+        self.assertRaises(ValueError, model.refresh)
+        self.assertIsNone(
+            self.session.identity_map.get("query_model", model._id)
+        )
+
+    def test_expire(self):
+        model = QueryModel.get_by(field1=1)
+        self.collection.documents[1]["field1"] = 10
+        self.assertEqual(QueryModel.get(model._id).field1, 1)
+        model.expire()
+        self.assertIs(QueryModel.get(model._id), model)
+        self.assertEqual(model.field1, 10)
+
+
+class TestGetMany(BaseTestQuery):
+
+    def test_ordered(self):
+        ids = [d["_id"] for d in self.collection.documents]
+        missing = ObjectId()
+        models = QueryModel.get_many(
+            [ids[3], str(ids[1]), missing, ids[3]], chunk_size=2
+        )
+        self.assertEqual(models[0].field1, 3)
+        self.assertEqual(models[1].field1, 1)
+        self.assertIsNone(models[2])
+        self.assertIs(models[3], models[0])
+        self.assertEqual(len(self.collection.calls), 2)
+        self.assertEqual(
+            self.collection.calls[0][1]["spec"],
+            {"_id": {"$in": [ids[3], ids[1]]}}
+        )
+
+    def test_use_identity_map(self):
+        session_module.use_identity_map()
+        ids = [d["_id"] for d in self.collection.documents]
+        model = QueryModel.get(ids[0])
+        models = QueryModel.get_many(ids[:2], ordered=False)
+        self.assertEqual(len(models), 2)
+        self.assertIn(model, models)
+        self.assertEqual(
+            self.collection.calls[1][1]["spec"], {"_id": {"$in": [ids[1]]}}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class TestKeysetPagination(BaseTestQuery):
+
+    def setUp(self):
+        super(TestKeysetPagination, self).setUp()
+        for i, document in enumerate(self.collection.documents):
+            document["field1"] = i // 2
+
+    def test_pages(self):
+        query = QueryModel.query().sort(field1=DESCENDING)
+        models, token = query.paginate_after(None, 2)
+        self.assertEqual([m.field1 for m in models], [2, 1])
+        models, token = query.paginate_after(token, 2)
+        self.assertEqual([m.field1 for m in models], [1, 0])
+        models, token = query.paginate_after(token, 2)
+        self.assertEqual([m.field1 for m in models], [0])
+        self.assertIsNone(token)
+        kwargs = self.collection.calls[-1][1]
+        self.assertEqual(kwargs["skip"], 0)
+        self.assertEqual(
+            kwargs["sort"], [("field1", DESCENDING), ("_id", DESCENDING)]
+        )
+
+    def test_iter_pages(self):
+        pages = list(QueryModel.query().iter_pages(2))
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(
+            [m._id for page in pages for m in page],
+            [d["_id"] for d in self.collection.documents]
+        )
+
+    def test_after_model(self):
+        query = QueryModel.query(field1=1).as_dicts()
+        model = QueryModel._from_bson(self.collection.documents[2])
+        documents, token = query.paginate_after(model, 2)
+        self.assertEqual(documents, self.collection.documents[3:4])
+        self.assertIsNone(token)
+        self.assertEqual(
+            query.paginate_after(self.collection.documents[2]["_id"], 2)[0],
+            documents
+        )
+
+    def test_values_list_token(self):
+        query = QueryModel.query().sort(field1=DESCENDING).scalar(
+            "field2.name"
+        )
+        names, token = query.paginate_after(None, 3)
+        self.assertEqual(names, [u"n4", u"n3", u"n2"])
+        self.assertEqual(query.paginate_after(token, 3)[0], [u"n1", u"n0"])
+
+    def test_null_sort_keys(self):
+        documents = self.collection.documents
+        documents[1]["field1"] = None
+        del documents[3]["field1"]
+        for direction in (ASCENDING, DESCENDING):
+            query = QueryModel.query().sort(
+                ("field1", direction), ("_id", direction)
+            ).as_dicts()
+            pages = list(query.iter_pages(1))
+            expected = query.all()
+            self.assertEqual([page[0] for page in pages], expected)
+            self.assertEqual(len(expected), 5)
+        self.assertEqual(
+            [d.get("field1") for d in expected], [2, 1, 0, None, None]
+        )
+
+    def test_token_of_another_sort(self):
+        token = QueryModel.query().paginate_after(None, 1)[1]
+        with self.assertRaises(ValueError):
+            QueryModel.query().sort(field1=DESCENDING).paginate_after(token)
+        with self.assertRaises(ValueError):
+            QueryModel.query().paginate_after("garbage")
+
+
+class TestStreaming(BaseTestQuery):
+
+    def test_cursor_options(self):
+        query = QueryModel.query().batch_size(2).max_time_ms(100)
+        list(query)
+        self.assertEqual(
+            query.cursor.options, dict(batch_size=2, max_time_ms=100)
+        )
+
+    def test_iter_chunks(self):
+        query = QueryModel.query().as_dicts()
+        chunks = list(query.iter_chunks(2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(chunks[0], self.collection.documents[:2])
+        self.assertEqual(query.cursor.options["batch_size"], 2)
+
+    def test_stream(self):
+        ids = []
+        for models in QueryModel.query().stream().iter_chunks(2):
+            for model in models:
+                self.assertIsInstance(model, QueryModel)
+                model.field1 = 10
+                model.field2.name = "changed"
+                ids.append(model._id)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(flush_queue.get_all(), set())
+        gc.collect()
+        self.assertIsNone(
+            self.session.identity_map.get("query_model", ids[0])
+        )
+
+
+class TestCompiledQuery(BaseTestQuery):
+
+    def test_commands_cache(self):
+        query = QueryModel.query(field1=1)
+        commands = query.get_commands()
+        self.assertIs(query.get_commands(), commands)
+        query.sort(field1=DESCENDING).limit(2)
+        self.assertIsNot(query.get_commands(), commands)
+        self.assertEqual(query.get_commands()["limit"], 2)
+        self.assertEqual(
+            query.get_commands()["sort"], [("field1", DESCENDING)]
+        )
+
+    def test_valid_paths(self):
+        QueryModel.assert_valid_field("field2.name")
+        self.assertIn("field2.name", QueryModel.__valid_paths__)
+        self.assertIn("name", QueryModel.Sub.__valid_paths__)
+        with self.assertRaises(KeyError):
+            QueryModel.assert_valid_field("field2.missing")
+        self.assertNotIn("field2.missing", QueryModel.__valid_paths__)
+
+    def test_prepare(self):
+        models = QueryModel.prepare(field1=Param("value"))(value="3").all()
+        self.assertEqual([m.field1 for m in models], [3])
+        by_low = QueryModel.prepare(Gt("field1", Param("low")))
+        self.assertEqual(by_low.bind(low=2), {"field1": {"$gt": 2}})
+        self.assertEqual(len(by_low(low=2).all()), 2)
+        self.assertEqual(len(by_low(low=3).all()), 1)
+        model = QueryModel.prepare(field1=Param("value")).get(value=4)
+        self.assertEqual(model.field1, 4)
+        with self.assertRaises(KeyError):
+            by_low.bind()
+        with self.assertRaises(KeyError):
+            QueryModel.prepare(missing=Param("value"))
+
+
+class TestFastPaths(BaseTestQuery):
+
+    def setUp(self):
+        super(TestFastPaths, self).setUp()
+        self.built = []
+        origin = QueryModel._from_bson.im_func
+
+        def _from_bson(cls, *args, **kwargs):
+            self.built.append(args)
+            return origin(cls, *args, **kwargs)
+        QueryModel._from_bson = classmethod(_from_bson)
+
+    def tearDown(self):
+        del QueryModel._from_bson
+        super(TestFastPaths, self).tearDown()
+
+    def test_exists(self):
+        self.assertTrue(QueryModel.query(field1=3).exists())
+        name, kwargs = self.collection.calls[-1]
+        self.assertEqual(kwargs["fields"], {"_id": 1})
+        self.assertEqual(kwargs["limit"], -1)
+        self.assertFalse(QueryModel.query(field1=7).exists())
+        self.assertEqual(self.built, [])
+
+    def test_count(self):
+        self.assertEqual(QueryModel.query(Gt("field1", 0)).count(), 4)
+        self.assertEqual(
+            QueryModel.query(Gt("field1", 0)).count(fast=True), 4
+        )
+        query = QueryModel.query(Gt("field1", 0)).max_time_ms(10)
+        self.assertEqual(query.count(True, limit=2, hint=[("field1", 1)]), 2)
+        name, options = self.collection.calls[-1]
+        self.assertEqual(name, "count")
+        self.assertEqual(options["hint"].items(), [("field1", 1)])
+        self.assertEqual(options["maxTimeMS"], 10)
+        self.assertEqual(
+            QueryModel.query().skip(1).limit(3).count(fast=True), 3
+        )
+        self.assertEqual(QueryModel.query().count(estimated=True), 5)
+        self.assertEqual(self.collection.calls[-1], ("count", {}))
+        with self.assertRaises(ValueError):
+            QueryModel.query(field1=1).count(estimated=True)
+        self.assertEqual(self.built, [])
+
+    def test_distinct(self):
+        self.collection.documents[0]["field2"]["name"] = u"n1"
+        self.assertEqual(
+            QueryModel.query(Gt("field1", -1)).distinct("field2.name"),
+            [u"n1", u"n2", u"n3", u"n4"]
+        )
+        self.assertEqual(
+            self.collection.calls[-1][1]["query"], {"field1": {"$gt": -1}}
+        )
+        with self.assertRaises(KeyError):
+            QueryModel.query().distinct("missing")
+        self.assertEqual(self.built, [])
+
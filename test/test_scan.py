@@ -0,0 +1,108 @@
+# coding: utf8
+
+import unittest
+
+from bson.objectid import ObjectId
+
+from mongotoy.libs import session as session_module
+from mongotoy.libs.models import Model, SubModel
+from mongotoy.libs.fields import IntField, ModelField
+from mongotoy.libs.consts import DESCENDING
+from mongotoy.libs.queue import flush_queue
+
+from fakes import FakeSession
+
+
+class ScanSubModel(SubModel):
+    count = IntField(0)
+
+
+class ScanModel(Model):
+    field1 = IntField(0)
+    field2 = ModelField(ScanSubModel)
+
+
+class TestParallelScan(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["ScanModel"]
+        )
+        self.collection = self.session.collections["scan_model"]
+        self.collection.documents = [
+            dict(_id=ObjectId(), field1=i, field2=dict(count=i))
+            for i in range(20)
+        ]
+
+    def tearDown(self):
+        session_module.session = self.origin
+        flush_queue.clear()
+
+    def test_split(self):
+        ids = [d["_id"] for d in self.collection.documents]
+        queries = ScanModel.query()._split(4, True)
+        self.assertEqual([q.commands["spec"] for q in queries], [
+            {"_id": {"$lt": ids[5]}},
+            {"_id": {"$gte": ids[5], "$lt": ids[10]}},
+            {"_id": {"$gte": ids[10], "$lt": ids[15]}},
+            {"_id": {"$gte": ids[15]}},
+        ])
+        queries = ScanModel.query(field1=1)._split(4, False)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(queries[0].commands["spec"], {"$and": [
+            {"field1": 1}, {"_id": {"$lt": ids[1]}}
+        ]})
+        self.assertIsNone(queries[0].commands["sort"])
+
+    def test_thread_ordered(self):
+        session_module.use_identity_map()
+        scan = ScanModel.query().parallel_scan(workers=3, chunk_size=4)
+        models = list(scan)
+        self.assertEqual([m.field1 for m in models], range(20))
+        self.assertEqual([m.field2.count for m in models], range(20))
+        self.assertEqual(
+            [stats["documents"] for stats in scan.stats], [6, 7, 7]
+        )
+        self.assertIs(ScanModel.get(models[3]._id), models[3])
+
+    def test_thread_unordered(self):
+        session_module.use_identity_map()
+        loaded = ScanModel.get(self.collection.documents[3]["_id"])
+        models = list(ScanModel.query().parallel_scan(
+            workers=4, ordered=False, chunk_size=3, queue_size=1
+        ))
+        self.assertEqual(sorted(m.field1 for m in models), range(20))
+        self.assertIn(loaded, models)
+
+    def test_process(self):
+        scan = ScanModel.query().parallel_scan(workers=2, mode="process")
+        models = list(scan)
+        self.assertEqual([m.field1 for m in models], range(20))
+        self.assertIs(models[0].field2.__lord__, models[0])
+        self.assertEqual(models[0].compile_changes(), {})
+        self.assertEqual(len(scan.stats), 2)
+        rows = list(ScanModel.query().as_dicts().parallel_scan(
+            workers=2, mode="process", ordered=False
+        ))
+        self.assertEqual(len(rows), 20)
+
+    def test_early_stop(self):
+        for mode in ("thread", "process"):
+            scan = iter(ScanModel.query().parallel_scan(
+                workers=2, mode=mode, chunk_size=1, queue_size=1
+            ))
+            self.assertEqual(next(scan).field1, 0)
+            scan.close()
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            ScanModel.query().limit(1).parallel_scan()
+        with self.assertRaises(ValueError):
+            ScanModel.query().sort(field1=DESCENDING).parallel_scan()
+        with self.assertRaises(ValueError):
+            ScanModel.query().parallel_scan(mode="fiber")
+
+
+if __name__ == "__main__":
+    unittest.main()
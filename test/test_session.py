@@ -0,0 +1,370 @@
+# coding: utf8
+
+import threading
+import unittest
+
+from bson.objectid import ObjectId
+
+from mongotoy.libs import session as session_module
+from mongotoy.libs.models import Model
+from mongotoy.libs.fields import IntField
+from mongotoy.libs.queue import flush_queue, get_unit_of_work
+from mongotoy.libs.session import flush, unit_of_work
+from mongotoy.libs.operators import Set, Inc
+
+from fakes import FakeSession
+
+
+class SessionModel(Model):
+    field1 = IntField(0)
+    field2 = IntField(0)
+    field3 = IntField(0)
+
+
+class TestFlush(unittest.TestCase):
+
+    def setUp(self):
+        flush_queue.clear()
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["SessionModel"]
+        )
+
+    def tearDown(self):
+        flush_queue.clear()
+        session_module.session = self.origin
+
+    def _load(self):
+        return SessionModel(__persistence__=True, _id=ObjectId())
+
+    def test_flush_in_batches(self):
+        new_models = [SessionModel(field1=i) for i in range(3)]
+        models = [self._load() for i in range(4)]
+        for model in models:
+            model.field2 = 5
+        result = flush(batch_size=3, ordered=False)
+        self.assertEqual(result["session_model"], dict(
+            nInserted=3, nMatched=4, nModified=4, nUpserted=0,
+            writeErrors=[]
+        ))
+        bulks = self.session.collections["session_model"].bulks
+        self.assertEqual([len(b.operations) for b in bulks], [3, 3, 1])
+        self.assertFalse(any(b.ordered for b in bulks))
+        self.assertTrue(all(m._id for m in new_models))
+        self.assertEqual(
+            bulks[1].operations[0][2], {"$set": {"field2": 5}}
+        )
+        self.assertEqual(flush_queue.get_all(), set())
+        self.assertEqual(models[0].compile_changes(), {})
+
+    def test_flush_errors(self):
+        models = [self._load() for i in range(3)]
+        for model in models:
+            model.field1 = 1
+        self.session.collections["session_model"].missing.update(m._id for m in models)
+        result = flush(batch_size=2, ordered=True)["session_model"]
+        self.assertEqual(len(self.session.collections["session_model"].bulks), 1)
+        self.assertEqual(result["nMatched"], 0)
+        self.assertEqual(len(result["writeErrors"]), 1)
+        self.assertEqual(len(flush_queue.get_all()), 3)
+        self.assertEqual(
+            models[0].compile_changes(), {"$set": {"field1": 1}}
+        )
+
+    def test_flush_unordered_errors(self):
+        models = [self._load() for i in range(3)]
+        for model in models:
+            model.field1 = 1
+        self.session.collections["session_model"].missing.add(models[0]._id)
+        result = flush(batch_size=2, ordered=False)["session_model"]
+        self.assertEqual(result["nMatched"], 2)
+        self.assertEqual(len(result["writeErrors"]), 1)
+        self.assertEqual(flush_queue.get_all(), set([models[0]]))
+
+    def test_flush_compile_error(self):
+        new_model = SessionModel(field1=1)
+        models = [self._load() for i in range(3)]
+        for model in models:
+            model.field1 = 5
+
+        def compile_changes(changes=None):
+            raise ValueError("partially loaded")
+        models[1].compile_changes = compile_changes
+        self.assertRaises(ValueError, flush)
+        self.assertEqual(self.session.collections["session_model"].bulks, [])
+        self.assertIsNone(new_model._id)
+        for model in [new_model] + models:
+            self.assertIn("field1", model.__changes__)
+        del models[1].compile_changes
+        result = flush()
+        self.assertEqual(result["session_model"]["nInserted"], 1)
+        self.assertEqual(result["session_model"]["nMatched"], 3)
+
+    def test_flush_skip_clean_models(self):
+        model = self._load()
+        flush_queue.push(model)
+        self.assertEqual(flush(), {})
+        self.assertEqual(self.session.collections["session_model"].bulks, [])
+
+
+class TestUnitOfWork(TestFlush):
+
+    def test_scoped_tracking(self):
+        model = self._load()
+        other = self._load()
+        with unit_of_work() as uow:
+            self.assertIs(get_unit_of_work(), uow)
+            model.field1 = 1
+            self.assertEqual(uow.queue.get_all(), set([model]))
+        other.field1 = 2
+        self.assertIsNone(get_unit_of_work())
+        self.assertEqual(flush_queue.get_all(), set([other]))
+        result = uow.flush()
+        self.assertEqual(result["session_model"]["nMatched"], 1)
+        self.assertEqual(uow.queue.get_all(), set())
+        self.assertEqual(flush_queue.get_all(), set([other]))
+
+    def test_identity_map(self):
+        with unit_of_work() as uow:
+            model = SessionModel(field1=1)
+            uow.flush()
+        self.assertIs(
+            uow.identity_map.get("session_model", model._id), model
+        )
+        self.assertEqual(len(self.session.identity_map.models), 0)
+
+    def test_thread_isolation(self):
+        models = [self._load() for i in range(2)]
+        units = []
+
+        def work(model):
+            with unit_of_work() as uow:
+                model.field1 = 3
+                units.append(uow)
+        threads = [
+            threading.Thread(target=work, args=(m,)) for m in models
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            sorted(len(u.queue.get_all()) for u in units), [1, 1]
+        )
+        self.assertEqual(flush_queue.get_all(), set())
+
+    def test_nested(self):
+        with unit_of_work() as outer:
+            with unit_of_work() as inner:
+                self.assertIs(get_unit_of_work(), inner)
+            self.assertIs(get_unit_of_work(), outer)
+
+
+class BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        flush_queue.clear()
+        self.origin = session_module.session
+        self.session = session_module.session = FakeSession(
+            db=["SessionModel"]
+        )
+        self.collection = self.session.collections["session_model"]
+
+    def tearDown(self):
+        flush_queue.clear()
+        session_module.session = self.origin
+
+
+class TestInsertMany(BulkTestCase):
+
+    def test_chunks(self):
+        result = SessionModel.insert_many(
+            (dict(field1=i) for i in xrange(5)), chunk_size=2
+        )
+        self.assertEqual(result["nInserted"], 5)
+        self.assertEqual(len(set(result["insertedIds"])), 5)
+        self.assertEqual(result["writeErrors"], [])
+        bulks = self.collection.bulks
+        self.assertEqual([len(b.operations) for b in bulks], [2, 2, 1])
+        self.assertFalse(any(b.ordered for b in bulks))
+        self.assertEqual(bulks[0].operations[1][1], dict(
+            _id=result["insertedIds"][1], field1=1, field2=0, field3=0
+        ))
+        self.assertEqual(flush_queue.get_all(), set())
+
+    def test_without_validation(self):
+        record = dict(field1="1", other=2)
+        result = SessionModel.insert_many([record], validate=False)
+        self.assertEqual(result["nInserted"], 1)
+        document = self.collection.bulks[0].operations[0][1]
+        self.assertEqual(document, dict(
+            _id=result["insertedIds"][0], field1="1", other=2
+        ))
+        self.assertNotIn("_id", record)
+
+    def test_models(self):
+        model = SessionModel(field1=1)
+        result = SessionModel.insert_many([model])
+        self.assertEqual(result["insertedIds"], [model._id])
+        self.assertEqual(model.compile_changes(), {})
+        self.assertEqual(flush_queue.get_all(), set())
+
+    def test_model_errors(self):
+        duplicate = ObjectId()
+        self.collection.documents = [dict(_id=duplicate)]
+        models = [
+            SessionModel(field1=1), SessionModel(_id=duplicate, field1=2)
+        ]
+        result = SessionModel.insert_many(models)
+        self.assertEqual(result["insertedIds"], [models[0]._id])
+        self.assertEqual(flush_queue.get_all(), set([models[1]]))
+        self.assertEqual(models[1].__changes__["field1"], ("$set", None))
+        self.collection.initialize_unordered_bulk_op = None
+        self.assertRaises(
+            TypeError, SessionModel.insert_many, [SessionModel(field1=3)]
+        )
+        self.assertEqual(len(flush_queue.get_all()), 2)
+
+    def test_errors(self):
+        duplicate = ObjectId()
+        self.collection.documents = [dict(_id=duplicate)]
+        records = [
+            dict(field1=1), dict(field1="a"), dict(missing=1),
+            dict(_id=duplicate), dict(field1=4)
+        ]
+        result = SessionModel.insert_many(records, chunk_size=2)
+        self.assertEqual(result["nInserted"], 2)
+        self.assertEqual(
+            [error["index"] for error in result["writeErrors"]], [1, 2, 3]
+        )
+        self.assertEqual(result["writeErrors"][2]["code"], 11000)
+        self.assertTrue(
+            result["writeErrors"][1]["errmsg"].startswith("KeyError")
+        )
+        result = SessionModel.insert_many(records, ordered=True)
+        self.assertEqual(result["nInserted"], 1)
+        self.assertEqual(
+            [error["index"] for error in result["writeErrors"]], [1]
+        )
+        result = SessionModel.insert_many(
+            [records[0], records[3], records[4]], ordered=True
+        )
+        self.assertEqual(result["nInserted"], 1)
+        self.assertEqual(
+            [error["index"] for error in result["writeErrors"]], [1]
+        )
+
+
+class TestUpsertMany(BulkTestCase):
+
+    def setUp(self):
+        super(TestUpsertMany, self).setUp()
+        self.collection.documents = [
+            dict(_id=ObjectId(), field1=i, field2=i) for i in range(3)
+        ]
+
+    def _operations(self):
+        return [
+            operation for bulk in self.collection.bulks
+            for operation in bulk.operations
+        ]
+
+    def test_upsert(self):
+        records = [dict(field1=i, field2=str(i * 10)) for i in range(5)]
+        result = SessionModel.upsert_many(
+            records, key="field1", chunk_size=2,
+            on_insert=lambda record: dict(field2=0, field3=record["field1"])
+        )
+        self.assertEqual(result, dict(
+            nUpserted=2, nMatched=3, nModified=3, writeErrors=[]
+        ))
+        self.assertEqual(
+            [len(bulk.operations) for bulk in self.collection.bulks],
+            [2, 2, 1]
+        )
+        self.assertEqual(self._operations()[4], ("upsert", {"field1": 4}, {
+            "$set": {"field2": 40}, "$setOnInsert": {"field3": 4}
+        }))
+        self.assertEqual(flush_queue.get_all(), set())
+
+    def test_on_update(self):
+        SessionModel.upsert_many(
+            [dict(field1=1, field2=2, field3=3)], key=("field1", "field2"),
+            on_update=lambda record: [Inc(field3=record["field3"])]
+        )
+        self.assertEqual(self._operations(), [(
+            "upsert", {"field1": 1, "field2": 2}, {"$inc": {"field3": 3}}
+        )])
+        SessionModel.upsert_many([dict(field1=5)], key="field1")
+        self.assertEqual(self._operations()[-1], (
+            "upsert", {"field1": 5}, {"$setOnInsert": {"field1": 5}}
+        ))
+
+    def test_errors(self):
+        self.collection.rejected.append({"field1": 3})
+        records = [
+            dict(field1=1), dict(field2=1), dict(field1=2, field2="a"),
+            dict(field1=3), dict(field1=4), "record"
+        ]
+        result = SessionModel.upsert_many(records, key="field1", chunk_size=2)
+        self.assertEqual(
+            [error["index"] for error in result["writeErrors"]], [1, 2, 3, 5]
+        )
+        self.assertEqual(result["writeErrors"][2]["code"], 2)
+        self.assertEqual((result["nMatched"], result["nUpserted"]), (1, 1))
+        result = SessionModel.upsert_many(records, key="field1", ordered=True)
+        self.assertEqual(
+            [error["index"] for error in result["writeErrors"]], [1]
+        )
+        self.assertEqual(result["nMatched"], 1)
+        with self.assertRaises(KeyError):
+            SessionModel.upsert_many(records, key="missing")
+        with self.assertRaises(ValueError):
+            SessionModel.upsert_many(records, ordered=True, workers=2)
+
+    def test_workers(self):
+        records = [dict(field1=i) for i in range(10)]
+        result = SessionModel.upsert_many(
+            records, key="field1", chunk_size=3, workers=3
+        )
+        self.assertEqual((result["nMatched"], result["nUpserted"]), (3, 7))
+        self.assertEqual(len(self.collection.bulks), 4)
+
+    def test_expire_loaded_models(self):
+        ids = [d["_id"] for d in self.collection.documents]
+        session_module.use_identity_map()
+        model = SessionModel.get(ids[0])
+        SessionModel.upsert_many([dict(_id=ids[0], field1=7)])
+        self.assertTrue(self.session.identity_map.is_expired(model))
+        self.collection.documents[0]["field1"] = 7
+        self.assertEqual(SessionModel.get(ids[0]).field1, 7)
+        with unit_of_work() as uow:
+            models = [SessionModel.get(_id) for _id in ids]
+            SessionModel.upsert_many(
+                [dict(_id=ids[1], field1=7)], workers=2
+            )
+            self.assertEqual(
+                [uow.identity_map.is_expired(m) for m in models],
+                [False, True, False]
+            )
+            SessionModel.upsert_many([dict(field1=0)], key="field1")
+            self.assertTrue(all(
+                uow.identity_map.is_expired(m) for m in models
+            ))
+
+    def test_update_operators(self):
+        model_query = SessionModel.query(field1=1)
+        model_query.update(Inc(field2=1), field3="2", multi=False)
+        self.assertEqual(self.collection.calls[-1][1], dict(
+            spec={"field1": 1},
+            document={"$inc": {"field2": 1}, "$set": {"field3": 2}},
+            multi=False, upsert=False
+        ))
+        with self.assertRaises(KeyError):
+            model_query.update(Set(missing=1))
+        with self.assertRaises(SyntaxError):
+            model_query.update(Set(field1="a"))
+
+
+if __name__ == "__main__":
+    unittest.main()